@@ -1,25 +1,19 @@
 import os
 import sys
+import importlib
 sys.path.append(os.path.dirname(os.path.realpath(__file__)))
 
-import utils
-import search_devseed
-try:
-    import search_scihub
-except SystemExit:
-    pass
-try:
-    import search_planet
-except SystemExit:
-    pass
+import backends
 
-import get_landsat
-import get_sentinel2
-try:
-    import get_sentinel1
-except SystemExit:
-    pass
-try:
-    import get_planet
-except SystemExit:
-    pass
+# the modules are imported on first access, so that importing the package
+# doesn't load GDAL, the Planet SDK... nor check any credentials
+__all__ = list(backends.MODULES)
+
+
+def __getattr__(name):
+    if name in backends.MODULES:
+        module = importlib.import_module(name)
+        globals()[name] = module
+        return module
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+                                                                    name))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Lazy loading of the TSD modules and of their heavy dependencies.
+
+GDAL, tifffile, bs4, requests and the Planet SDK take a noticeable time to
+import, which is paid by each short command line call or worker process. The
+modules thus import them with lazy_import: the actual import happens on first
+attribute access. The search and download modules are listed in registries
+and imported on first use as well.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+import types
+import importlib
+import threading
+
+
+# registries of the search and download modules
+SEARCH_APIS = {
+    'devseed': 'search_devseed',
+    'scihub': 'search_scihub',
+    'planet': 'search_planet',
+    'federated': 'search_federated'
+}
+DOWNLOADERS = {
+    'Sentinel-1': 'get_sentinel1',
+    'Sentinel-2': 'get_sentinel2',
+    'Landsat-8': 'get_landsat',
+    'Planet': 'get_planet'
+}
+MODULES = (['utils', 'parallel', 'retry', 'http_session', 's2_tiling_grid',
+            'search_cache', 'range_cache', 'download', 'manifest',
+            'landsat_index'] +
+           sorted(SEARCH_APIS.values()) + sorted(DOWNLOADERS.values()))
+
+
+class LazyModule(types.ModuleType):
+    """
+    Proxy importing a module on first attribute access.
+    """
+    def __init__(self, name, init=None):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_init'] = init
+        self.__dict__['_lazy_module'] = None
+        self.__dict__['_lazy_lock'] = threading.Lock()
+
+    def _load(self):
+        m = self.__dict__['_lazy_module']
+        if m is None:
+            with self.__dict__['_lazy_lock']:
+                m = self.__dict__['_lazy_module']
+                if m is None:
+                    m = importlib.import_module(self.__name__)
+                    if self.__dict__['_lazy_init'] is not None:
+                        self.__dict__['_lazy_init'](m)
+                    self.__dict__['_lazy_module'] = m
+        return m
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def lazy_import(name, init=None):
+    """
+    Return a module which will actually be imported on first use.
+
+    Args:
+        name: absolute name of the module, eg 'osgeo.gdal'
+        init (optional): function called with the module right after its
+            import, eg to configure it
+    """
+    return LazyModule(name, init)
+
+
+def search_module(api):
+    """
+    Import the search module of an API (devseed, scihub, planet, federated).
+    """
+    return importlib.import_module(SEARCH_APIS[api])
+
+
+def downloader(satellite):
+    """
+    Import the download module of a satellite (Sentinel-1, Sentinel-2,
+    Landsat-8 or Planet).
+    """
+    return importlib.import_module(DOWNLOADERS[satellite])
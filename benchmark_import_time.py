@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Measure the time needed to import the TSD package.
+
+Each measure is made in a fresh python process, so that nothing is cached by
+a previous import. The lazy import of the package is compared with an eager
+import of all its modules, which loads GDAL, the Planet SDK...
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import os
+import sys
+import argparse
+import subprocess
+
+import backends
+
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+
+def import_time(statement, cwd):
+    """
+    Time the execution of an import statement in a new python process.
+
+    Returns:
+        elapsed time in seconds, or None if the import failed
+    """
+    code = ('import time; t0 = time.time(); {}; '
+            'print(time.time() - t0)').format(statement)
+    p = subprocess.Popen([sys.executable, '-c', code], cwd=cwd,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode:
+        print('WARNING: {} failed: {}'.format(statement,
+                                              err.decode().strip().split('\n')[-1]),
+              file=sys.stderr)
+        return
+    return float(out.decode().strip())
+
+
+def main(repeat=3):
+    """
+    Print the import times of the package and of each of its modules.
+    """
+    parent, package = os.path.split(here)
+
+    def best(statement, cwd):
+        t = [import_time(statement, cwd) for _ in range(repeat)]
+        return None if None in t else min(t)
+
+    def show(label, t):
+        print('{:30} {}'.format(label, 'failed' if t is None else
+                                '{:.3f} s'.format(t)))
+
+    show('import {} (lazy)'.format(package), best('import {}'.format(package),
+                                                   parent))
+    show('all modules (eager)', best('; '.join('import {}'.format(m) for m in
+                                               backends.MODULES), here))
+    for m in backends.MODULES:
+        show('  {}'.format(m), best('import {}'.format(m), here))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Measure the import time of '
+                                                  'the TSD modules'))
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='number of measures, the best one is kept')
+    args = parser.parse_args()
+    main(args.repeat)
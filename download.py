@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+In-process download of large files, in parallel range segments.
+
+A file is split in SEGMENTS byte ranges downloaded concurrently, each on its
+own connection of the shared HTTP session, and written at its offset in a
+partial file (the final path with a '.part' suffix). The progress of each
+segment is saved in a json state file next to it, hence an interrupted
+download is resumed from the bytes already written. Servers that don't
+support range requests are read in a single stream. Once complete, the file
+is verified against its size and, if given, its checksum, then renamed to its
+final path.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import threading
+import multiprocessing.pool
+
+import retry
+import backends
+import http_session
+
+requests = backends.lazy_import('requests')
+
+
+# number of parallel range segments per file
+SEGMENTS = int(os.environ.get('TSD_DOWNLOAD_SEGMENTS', 4))
+
+# files smaller than this (bytes) are downloaded in a single segment
+MIN_SEGMENT_SIZE = 16 * 1024**2
+
+# size (bytes) of the chunks read from the responses
+CHUNK_SIZE = 1024**2
+
+# the state file is saved every STATE_INTERVAL bytes written by a segment
+STATE_INTERVAL = 16 * 1024**2
+
+
+def probe(url, auth=None):
+    """
+    Get the size of a remote file and tell if it supports range requests.
+
+    A one byte range request is used rather than a HEAD request, which some
+    servers (eg the SciHub OData API) don't answer properly.
+
+    Returns:
+        dict with keys 'size' (None if unknown), 'ranges' (bool) and 'etag',
+        or None if the file is not available
+    """
+    try:
+        r = http_session.get(url, auth=auth, headers={'Range': 'bytes=0-0'},
+                             stream=True)
+    except requests.exceptions.RequestException as e:
+        print('WARNING: request {} failed: {}'.format(url, e), file=sys.stderr)
+        return
+    r.close()
+    if not r.ok:
+        print('WARNING: {} returned {}'.format(url, r.status_code),
+              file=sys.stderr)
+        return
+    etag = r.headers.get('ETag', r.headers.get('Last-Modified', ''))
+    m = re.match(r'bytes 0-0/(\d+)$', r.headers.get('Content-Range', ''))
+    if r.status_code == 206 and m:
+        return {'size': int(m.group(1)), 'ranges': True, 'etag': etag}
+    size = r.headers.get('Content-Length')
+    return {'size': int(size) if size else None, 'ranges': False, 'etag': etag}
+
+
+def file_checksum(path, algorithm='md5'):
+    """
+    Compute the checksum (hex digest) of a file.
+    """
+    h = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_state(path, info):
+    """
+    Read the state of a partial download, if it matches the remote file.
+
+    Returns:
+        list of [start, end, done] segments, or None
+    """
+    try:
+        with open('{}.part.json'.format(path), 'r') as f:
+            d = json.load(f)
+    except (IOError, OSError, ValueError):
+        return
+    if (d['size'] != info['size'] or d['etag'] != info['etag'] or
+            not os.path.isfile('{}.part'.format(path))):
+        return
+    return d['segments']
+
+
+def write_state(path, info, segments):
+    """
+    Atomically save the state of a partial download.
+    """
+    p = '{}.part.json'.format(path)
+    with open('{}.tmp'.format(p), 'w') as f:
+        json.dump({'size': info['size'], 'etag': info['etag'],
+                   'segments': segments}, f)
+    os.rename('{}.tmp'.format(p), p)
+
+
+def split(size, n):
+    """
+    Split a file size in n [start, end, done] segments.
+    """
+    n = max(1, min(n, size // MIN_SEGMENT_SIZE))
+    bounds = [size * i // n for i in range(n + 1)]
+    return [[bounds[i], bounds[i + 1] - 1, 0] for i in range(n)]
+
+
+def fetch_segment(url, path, info, segments, i, lock, auth=None):
+    """
+    Download the remaining bytes of a segment into the partial file.
+
+    Raises:
+        requests.exceptions.RequestException on network errors, or if the
+        server doesn't answer the range request
+    """
+    start, end, done = segments[i]
+    if start + done > end:
+        return
+    r = http_session.get(url, auth=auth, stream=True, headers={
+        'Range': 'bytes={}-{}'.format(start + done, end)})
+    if r.status_code != 206:
+        r.close()
+        raise requests.exceptions.HTTPError('range request returned '
+                                            '{}'.format(r.status_code))
+    unsaved = 0
+    with open('{}.part'.format(path), 'r+b') as f:
+        f.seek(start + done)
+        for chunk in r.iter_content(CHUNK_SIZE):
+            chunk = chunk[:end + 1 - start - done]
+            f.write(chunk)
+            http_session.count_read(url, len(chunk))
+            done += len(chunk)
+            unsaved += len(chunk)
+            if unsaved >= STATE_INTERVAL:
+                f.flush()
+                with lock:
+                    segments[i][2] = done
+                    write_state(path, info, segments)
+                unsaved = 0
+            if start + done > end:
+                break
+    r.close()
+    with lock:
+        segments[i][2] = done
+        write_state(path, info, segments)
+    if start + done <= end:
+        raise requests.exceptions.ConnectionError('segment {} of {} is '
+                                                  'incomplete'.format(i, url))
+
+
+def fetch_stream(url, path, auth=None):
+    """
+    Download a file in a single stream, into the partial file.
+    """
+    r = http_session.get(url, auth=auth, stream=True)
+    r.raise_for_status()
+    with open('{}.part'.format(path), 'wb') as f:
+        for chunk in r.iter_content(CHUNK_SIZE):
+            f.write(chunk)
+            http_session.count_read(url, len(chunk))
+    r.close()
+
+
+def download(url, path, auth=None, checksum=None, segments=SEGMENTS):
+    """
+    Download a file in parallel range segments, resuming a partial download.
+
+    Args:
+        url: url of the file
+        path: path to the output file
+        auth (optional): (login, password) tuple for HTTP basic authentication
+        checksum (optional): (algorithm, hex digest) tuple, eg ('md5', '...'),
+            the downloaded file is checked against
+        segments: number of parallel range segments
+
+    Returns:
+        True if the file was downloaded and verified, False otherwise
+    """
+    info = probe(url, auth)
+    if info is None:
+        return False
+    d = os.path.dirname(path)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    part = '{}.part'.format(path)
+    host = http_session.host(url)
+
+    try:
+        if info['ranges'] and info['size']:
+            state = read_state(path, info)
+            if state is None:
+                state = split(info['size'], segments)
+                with open(part, 'wb') as f:
+                    f.truncate(info['size'])
+                write_state(path, info, state)
+            else:
+                print('resuming {} ({} of {} bytes already downloaded)'.format(
+                    os.path.basename(path), sum(s[2] for s in state),
+                    info['size']))
+            lock = threading.Lock()
+            pool = multiprocessing.pool.ThreadPool(len(state))
+            results = [pool.apply_async(retry.call, (fetch_segment,
+                                                     (url, path, info, state,
+                                                      i, lock, auth), host))
+                       for i in range(len(state))]
+            pool.close()
+            pool.join()
+            reasons = [r.get()[1] for r in results]  # raises segments errors
+            complete = all(x[0] + x[2] > x[1] for x in state)
+        else:
+            reasons = [retry.call(fetch_stream, (url, path, auth), host)[1]]
+            complete = info['size'] in (None, os.path.getsize(part))
+    except (requests.exceptions.RequestException, IOError, OSError) as e:
+        print('WARNING: download of {} failed: {}'.format(url, e),
+              file=sys.stderr)
+        return False
+
+    if not complete:
+        print('WARNING: download of {} is incomplete: {}'.format(url, ', '.join(
+            r for r in reasons if r is not None)), file=sys.stderr)
+        return False
+    if checksum is not None and file_checksum(part, checksum[0]) != checksum[1].lower():
+        print('WARNING: wrong {} checksum for {}, removing it'.format(checksum[0],
+                                                                      path),
+              file=sys.stderr)
+        for p in [part, '{}.json'.format(part)]:
+            if os.path.exists(p):
+                os.remove(p)
+        return False
+
+    os.rename(part, path)
+    if os.path.exists('{}.json'.format(part)):
+        os.remove('{}.json'.format(part))
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Download a file in parallel '
+                                                  'range segments'))
+    parser.add_argument('url', help='url of the file')
+    parser.add_argument('-o', '--output', help='path to the output file')
+    parser.add_argument('-n', '--segments', type=int, default=SEGMENTS,
+                        help='number of parallel segments')
+    parser.add_argument('--md5', help='expected md5 checksum of the file')
+    args = parser.parse_args()
+
+    out = args.output or os.path.basename(args.url.split('?')[0])
+    ok = download(args.url, out, checksum=('md5', args.md5) if args.md5 else None,
+                  segments=args.segments)
+    sys.exit(0 if ok else 1)
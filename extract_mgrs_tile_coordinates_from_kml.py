@@ -1,9 +1,108 @@
 #!/usr/bin/env python
-import sys
-import re
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
 
+"""
+Compile the Sentinel-2 MGRS tiling grid kml file into a binary tiling grid.
 
-def main(kml_filename):
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import argparse
+import xml.etree.ElementTree as ET
+import numpy as np
+import shapely.geometry
+
+import s2_tiling_grid
+
+
+def local_name(tag):
+    """
+    Remove the namespace from an xml tag.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_coordinates(s):
+    """
+    Parse the content of a kml 'coordinates' element.
+
+    Returns:
+        numpy array of shape (k, 2) with the lon, lat of the k vertices
+    """
+    return np.array([list(map(float, p.split(',')[:2])) for p in s.split()])
+
+
+def split_on_antimeridian(ring):
+    """
+    Split a lon, lat polygon crossing the antimeridian into polygons that don't.
+
+    Args:
+        ring: numpy array of shape (k, 2) with the lon, lat of the vertices
+
+    Returns:
+        list of numpy arrays of shape (k, 2)
+    """
+    if np.ptp(ring[:, 0]) <= 180:
+        return [ring]
+
+    # move all the vertices to the [0, 360] range, then cut at 180 degrees
+    unwrapped = ring.copy()
+    unwrapped[unwrapped[:, 0] < 0, 0] += 360
+    polygon = shapely.geometry.Polygon(unwrapped)
+    out = []
+    for lon_min, lon_max, shift in [(0, 180, 0), (180, 360, -360)]:
+        part = polygon.intersection(shapely.geometry.box(lon_min, -90,
+                                                         lon_max, 90))
+        for p in getattr(part, 'geoms', [part]):
+            if isinstance(p, shapely.geometry.Polygon) and p.area > 0:
+                xy = np.array(p.exterior.coords)
+                xy[:, 0] += shift
+                out.append(xy)
+    return out
+
+
+def iter_tiles(kml_filename):
+    """
+    Iterate over the tiles of the kml file with a streaming parser.
+
+    Only one Placemark element is kept in memory at a time.
+
+    Yields:
+        mgrs_id, list of numpy arrays with the lon, lat vertices of the tile
+        footprint polygons
+    """
+    stack = []
+    for event, elem in ET.iterparse(kml_filename, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+
+        stack.pop()
+        if local_name(elem.tag) != 'Placemark':
+            continue
+
+        mgrs_id = None
+        rings = []
+        for e in elem.iter():
+            tag = local_name(e.tag)
+            if tag == 'name' and mgrs_id is None:
+                mgrs_id = e.text.strip()
+            elif tag == 'Polygon':
+                for c in e.iter():
+                    if local_name(c.tag) == 'coordinates':
+                        rings.append(parse_coordinates(c.text))
+                        break  # only the outer boundary
+        if mgrs_id and rings:
+            yield mgrs_id, rings
+
+        # free the memory used by the processed Placemark
+        if stack:
+            stack[-1].remove(elem)
+
+
+def main(kml_filename, out_prefix=s2_tiling_grid.s2_mgrs_footprints):
     """
     Extract information from the kml file distributed by ESA to describe the
     Sentinel-2 MGRS tiling grid.
@@ -11,29 +110,30 @@ def main(kml_filename):
     This file is distributed on ESA Sentinel website at:
 
     https://sentinel.esa.int/documents/247904/1955685/S2A_OPER_GIP_TILPAR_MPC__20151209T095117_V20150622T000000_21000101T000000_B00.kml
+
+    The tiles footprints polygons and bounding boxes are written in the binary
+    format of the s2_tiling_grid module, with the given prefix. Footprints
+    crossing the antimeridian are split in two parts.
     """
-    float_pattern = '(-?[0-9]+\.?[0-9]*)'  # regex to match a float
-    ll_pattern = '{0},{0},0'.format(float_pattern)  # regex to match lon,lat,0
-    looking_for_mgrs_id = True
-
-    with open(kml_filename, 'r') as f:
-        for line in f:
-            if looking_for_mgrs_id:
-                mgrs_id = re.search('<name>([0-9]{2}[A-Z]{3})</name>', line)
-                if mgrs_id:
-                    print mgrs_id.group(1),
-                    looking_for_mgrs_id = False
-            else:
-                ll_bbx = re.search(' '.join([ll_pattern]*5), line)
-                if ll_bbx:
-                    lons = map(float, ll_bbx.groups()[0::2])
-                    lats = map(float, ll_bbx.groups()[1::2])
-                    print min(lons), max(lons), min(lats), max(lats)
-                    looking_for_mgrs_id = True
+    ids = []
+    rings = []
+    for mgrs_id, polygons in iter_tiles(kml_filename):
+        for p in polygons:
+            for r in split_on_antimeridian(p):
+                ids.append(mgrs_id)
+                rings.append(r)
+
+    s2_tiling_grid.save_grid(s2_tiling_grid.build_grid(ids, rings), out_prefix)
+    print('{} tiles written to {}.*.npy'.format(len(set(ids)), out_prefix))
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print "\t Usage: %s input.kml > output.txt" % sys.argv[0]
-    else:
-        main(sys.argv[1])
+    parser = argparse.ArgumentParser(description=('Compile the Sentinel-2 MGRS '
+                                                  'tiling grid kml file'))
+    parser.add_argument('kml', help='path to the ESA kml file')
+    parser.add_argument('-o', '--out-prefix',
+                        default=s2_tiling_grid.s2_mgrs_footprints,
+                        help=('prefix of the output .npy files, default '
+                              '{}'.format(s2_tiling_grid.s2_mgrs_footprints)))
+    args = parser.parse_args()
+    main(args.kml, args.out_prefix)
@@ -5,24 +5,39 @@
 """
 Automatic crop and download of Landsat timeseries.
 
+The images are available on the AWS and Google Cloud mirrors. Each crop is
+read from the mirror with the best time-to-first-byte and throughput, measured
+by small range requests refreshed every PROBE_INTERVAL seconds, and from the
+other mirror if the first one lacks the image. The mirror used and the timings
+are recorded with each crop in the manifest.
+
 Copyright (C) 2016-17, Carlo de Franchis <carlo.de-franchis@m4x.org>
 """
 
 from __future__ import print_function
 import os
 import sys
+import time
 import shutil
+import functools
 import argparse
 import datetime
+import threading
+import multiprocessing.pool
 import numpy as np
 import utm
 import dateutil.parser
-import requests
-import tifffile
 
 import search_devseed
 import utils
 import parallel
+import manifest
+import backends
+import http_session
+import landsat_index
+
+tifffile = backends.lazy_import('tifffile')
+requests = backends.lazy_import('requests')
 
 
 aws_url = 'http://landsat-pds.s3.amazonaws.com'  # https://landsatonaws.com/
@@ -31,12 +46,29 @@ aws_url = 'http://landsat-pds.s3.amazonaws.com'  # https://landsatonaws.com/
 all_bands = ['1', '2', '3', '4', '5', '6', '7', '8', '9',
              '10', '11', '12']
 
+# mirrors of the images, in order of preference for equally fast mirrors
+MIRRORS = ['aws', 'google']
+
+# mirrors measurements: size (bytes) of the range requests, and max age (s)
+# of a measurement. The expected duration of a crop is estimated as the
+# time-to-first-byte plus PROBE_SIZE / throughput.
+PROBE_SIZE = 1024**2
+PROBE_INTERVAL = 60
+
+# time-to-first-byte (s), throughput (bytes/s), time of the last measurement
+# (or of the measurement in progress) and number of crops of each mirror
+mirror_stats = {}
+_mirror_lock = threading.Lock()
+
 def google_url_from_metadata_dict_backend(d, api='devseed'):
     """
     Build the Google url of a Landsat image from it's metadata.
     """
     if api == 'devseed':
-        return d['download_links']['google'][0].rsplit('_', 1)[0]
+        try:
+            return d['download_links']['google'][0].rsplit('_', 1)[0]
+        except (KeyError, IndexError):  # not available on Google
+            return
 
 
 def google_url_from_metadata_dict(d, api='devseed', band=None):
@@ -50,6 +82,128 @@ def google_url_from_metadata_dict(d, api='devseed', band=None):
         return baseurl
 
 
+def probe_mirror(mirror, url):
+    """
+    Measure the time-to-first-byte and throughput of a mirror.
+
+    The first PROBE_SIZE bytes of a file are read with a range request.
+
+    Returns:
+        True if the file could be read from the mirror
+    """
+    t0 = time.time()
+    try:
+        r = http_session.get(url, stream=True, retries=0,
+                             headers={'Range': 'bytes=0-{}'.format(PROBE_SIZE - 1)})
+        if not r.ok:
+            r.close()
+            return False
+        chunks = r.iter_content(64 * 1024)
+        n = len(next(chunks, b''))
+        t1 = time.time()
+        n += sum(len(c) for c in chunks)
+        t2 = time.time()
+    except requests.exceptions.RequestException:
+        return False
+    with _mirror_lock:
+        s = mirror_stats.setdefault(mirror, {'crops': 0})
+        s['ttfb'] = t1 - t0
+        s['throughput'] = n / max(t2 - t0, 1e-3)
+        s['probed'] = t2
+    return True
+
+
+def mirror_score(mirror):
+    """
+    Expected duration (s) of a crop read from a mirror, from its last
+    measurement. Unmeasured mirrors get a zero score, so they are tried.
+    """
+    s = mirror_stats.get(mirror)
+    if s is None or 'ttfb' not in s:
+        return 0
+    return s['ttfb'] + PROBE_SIZE / max(s['throughput'], 1.)
+
+
+def crop_from_mirrors(crop, outpath, mirror_urls, *args):
+    """
+    Crop an image from the fastest mirror, falling back to the others.
+
+    Args:
+        crop: crop function called as crop(outpath, inpath, *args), eg
+            utils.crop_with_gdal_translate or utils.crop_bands_with_vrt
+        outpath: path to the output (cropped) image file
+        mirror_urls: list of the input url (or list of urls) on each of the
+            MIRRORS, None where the image isn't available
+        args: other arguments of the crop function (crop window...)
+
+    Returns:
+        dict with the mirror used and the timings, or the failure reason
+        string of the last mirror tried
+    """
+    mirrors = [(m, u) for m, u in zip(MIRRORS, mirror_urls) if u]
+    unreachable = set()
+    for m, u in mirrors:  # refresh the old measurements, one thread at a time
+        with _mirror_lock:
+            s = mirror_stats.setdefault(m, {'crops': 0})
+            stale = time.time() - s.get('probed', 0) > PROBE_INTERVAL
+            if stale:  # the other threads use the previous measurement
+                s['probed'] = time.time()
+        if stale and not probe_mirror(m, u[0] if isinstance(u, list) else u):
+            unreachable.add(m)  # probably lacks the image: try it last
+
+    # stable sort: equally fast mirrors keep the MIRRORS order
+    mirrors.sort(key=lambda x: (x[0] in unreachable, mirror_score(x[0])))
+
+    reason = 'not available on any mirror'
+    tried = []
+    for m, u in mirrors:
+        t0 = time.time()
+        reason = crop(outpath, u, *args)
+        tried.append(m)
+        if reason is None:
+            with _mirror_lock:
+                s = mirror_stats.setdefault(m, {'crops': 0})
+                s['crops'] += 1
+            return {'mirror': m, 'tried': tried, 'seconds': round(time.time() - t0, 3),
+                    'ttfb': round(s.get('ttfb', 0), 3),
+                    'throughput': int(s.get('throughput', 0))}
+        print('WARNING: crop from the {} mirror failed: {}'.format(m, reason))
+        if m == 'aws' and reason == 'not available':
+            forget_aws_url(u)
+    return reason
+
+
+def print_mirror_stats():
+    """
+    Print the number of crops read from each mirror and its last measurement.
+    """
+    for m in MIRRORS:
+        s = mirror_stats.get(m)
+        if s and 'ttfb' in s:
+            print('{}: {} crops, time-to-first-byte {:.2f} s, {:.1f} MB/s'.format(
+                m, s['crops'], s['ttfb'], s['throughput'] / 1024**2))
+
+
+def crop_source(name, bands):
+    """
+    Identifier of the source of a crop in the manifest: the scene and bands,
+    whatever the mirror they are read from.
+    """
+    return ['{}_B{}'.format(name, b) for b in bands]
+
+
+def forget_aws_url(url):
+    """
+    Drop from the scene urls index the scene of a band url found missing.
+
+    Args:
+        url: url of a band on AWS, or list of urls of the bands of a scene
+    """
+    if isinstance(url, list):
+        url = url[0]
+    landsat_index.forget(url.rsplit('_B', 1)[0])
+
+
 def aws_url_from_metadata_dict_backend(d, api='devseed'):
     """
     Build the AWS url of a Landsat image from it's metadata.
@@ -59,17 +213,34 @@ def aws_url_from_metadata_dict_backend(d, api='devseed'):
         assert(d['aws_index'].endswith('index.html'))
         url = d['aws_index'][:-1-len('index.html')]
         if url.endswith(d['sceneID']):
+            u = landsat_index.lookup(d['sceneID'])
+            if u is not None:
+                return u
+
+            # ugly hack for images before 2017-05-01, waiting for developmentseed
+            # fix: the candidate scene IDs are probed concurrently
             path = d['path']
             row = d['row']
-            for i in range(4):  # ugly hack for images before 2017-05-01, waiting for developmentseed fix
-                scene_id = '{}{}'.format(d['sceneID'][:-1], i)
-                u = '{0}/L8/{1:03d}/{2:03d}/{3}/{3}'.format(aws_url, path, row, scene_id)
-                if requests.head('{}_B8.TIF'.format(u)).ok:
-                    break
+            candidates = ['{0}/L8/{1:03d}/{2:03d}/{3}/{3}'.format(aws_url, path, row,
+                                                                  '{}{}'.format(d['sceneID'][:-1], i))
+                          for i in range(4)]
+            candidates.append('{0}/c1/L8/{1:03d}/{2:03d}/{3}/{3}'.format(aws_url, path,
+                                                                         row,
+                                                                         d['product_id']))
+            pool = multiprocessing.pool.ThreadPool(len(candidates))
+            exists = pool.map(utils.is_available,
+                              ['{}_B8.TIF'.format(c) for c in candidates])
+            pool.close()
+            for u, e in zip(candidates, exists):
+                if e:
+                    landsat_index.store(d['sceneID'], u)
+                    return u
+            if None in exists:
+                print('WARNING: AWS url of {} unknown, some probes failed: '
+                      'trying {}'.format(d['sceneID'], candidates[-1]))
             else:
-                product_id = d['product_id']
-                u = '{0}/c1/L8/{1:03d}/{2:03d}/{3}/{3}'.format(aws_url, path, row, product_id)
-            return u
+                print('WARNING: {} not found on AWS'.format(d['sceneID']))
+            return candidates[-1]
         else:
             product_id = d['product_id']
             return '{}/{}'.format(url, product_id)
@@ -91,17 +262,26 @@ def aws_url_from_metadata_dict(d, api='devseed', band=None):
         return baseurl
 
 
+def date_from_metadata_dict(d, api='devseed'):
+    """
+    Return the acquisition date of a Landsat image from it's metadata.
+    """
+    if api == 'devseed':
+        date_str = d['date']
+    elif api == 'planet':
+        date_str = d['properties']['acquired']
+    return dateutil.parser.parse(date_str).date()
+
+
 def filename_from_metadata_dict(d, api='devseed'):
     """
     Build a string using the image acquisition date and identifier.
     """
     if api == 'devseed':
         scene_id = d['sceneID']
-        date_str = d['date']
     elif api == 'planet':
         scene_id = d['id']
-        date_str = d['properties']['acquired']
-    date = dateutil.parser.parse(date_str).date()
+    date = date_from_metadata_dict(d, api)
     return '{}_scene_{}'.format(date.isoformat(), scene_id)
 
 
@@ -127,7 +307,7 @@ def metadata_from_metadata_dict(d, api='devseed'):
     }
 
 
-def is_image_cloudy(qa_band_file, p=.5):
+def is_image_cloudy(qa_band_file, p=.5, band=None):
     """
     Tell if a Landsat-8 image crop is cloud-covered according to the QA band.
 
@@ -137,33 +317,49 @@ def is_image_cloudy(qa_band_file, p=.5):
     Args:
         qa_band_file: path to a Landsat-8 QA band crop
         p: fraction threshold
+        band (optional): index (starting from 1) of the QA band, if the crop
+            is a multi-band file
     """
-    x = tifffile.imread(qa_band_file)
+    if band is None:
+        x = tifffile.imread(qa_band_file)
+    else:
+        x = utils.gdal.Open(qa_band_file).GetRasterBand(band).ReadAsArray()
     bqa_cloud_yes = [61440, 59424, 57344, 56320, 53248]
     bqa_cloud_maybe = [39936, 36896, 36864]
     mask = np.in1d(x, bqa_cloud_yes + bqa_cloud_maybe).reshape(x.shape)
     return np.count_nonzero(mask) > p * x.size
 
 
-def bands_files_are_valid(img, bands, search_api, directory):
+def bands_filenames(name, bands, stack=False):
+    """
+    Return the names of the files of an image: one per band, or a single
+    multi-band file in stack mode.
+    """
+    if stack:
+        return ['{}.tif'.format(name)]
+    return ['{}_band_{}.tif'.format(name, b) for b in bands]
+
+
+def bands_files_are_valid(img, bands, search_api, directory, stack=False):
     """
     Check if all bands images files are valid.
+
+    Files recorded as complete in the manifest are checked with a stat call
+    only, the others are opened with gdal.
     """
     name = filename_from_metadata_dict(img, search_api)
-    filenames = ['{}_band_{}.tif'.format(name, b) for b in bands]
+    filenames = bands_filenames(name, bands, stack)
     paths = [os.path.join(directory, f) for f in filenames]
-    return all(utils.is_valid(p) for p in paths)
+    return all(manifest.crop_is_complete(p) or utils.is_valid(p) for p in paths)
 
 
-def get_time_series(aoi, start_date=None, end_date=None, bands=[8],
-                    out_dir='', search_api='devseed', parallel_downloads=100,
-                    debug=False):
+def search(aoi, start_date=None, end_date=None, search_api='devseed'):
     """
-    Main function: crop and download a time series of Landsat-8 images.
-    """
-    utils.print_elapsed_time.t0 = datetime.datetime.now()
+    List the Landsat-8 images available on an AOI, one per acquisition date.
 
-    # list available images
+    Returns:
+        list of metadata dicts, sorted by acquisition date
+    """
     seen = set()
     if search_api == 'devseed':
         images = search_devseed.search(aoi, start_date, end_date,
@@ -188,69 +384,296 @@ def get_time_series(aoi, start_date=None, end_date=None, bands=[8],
         images = [x for x in images if not (x['properties']['acquired'] in seen
                                             or  # seen.add() returns None
                                             seen.add(x['properties']['acquired']))]
-    print('Found {} images'.format(len(images)))
-    utils.print_elapsed_time()
+    return images
 
-    # build urls
-    urls = parallel.run_calls(aws_url_from_metadata_dict, list(images),
-                              extra_args=(search_api,), pool_type='threads',
-                              nb_workers=parallel_downloads, verbose=False)
 
-    # build gdal urls and filenames
-    gdal_urls = []
-    fnames = []
-    for img, url in zip(images, urls):
-        name = filename_from_metadata_dict(img, search_api)
-        for b in set(bands + ['QA']):  # the QA band is needed for cloud detection
-            gdal_urls.append('{}_B{}.TIF'.format(url, b))
-            fnames.append(os.path.join(out_dir, '{}_band_{}.tif'.format(name, b)))
+def bands_with_qa(bands):
+    """
+    Add the QA band, needed for cloud detection, to a list of bands.
+    """
+    return bands + ['QA'] if 'QA' not in bands else bands
 
-    # convert aoi coordinates to utm
-    ulx, uly, lrx, lry, utm_zone, lat_band = utils.utm_bbx(aoi)
 
-    # download crops
-    utils.mkdir_p(out_dir)
-    print('Downloading {} crops ({} images with {} bands)...'.format(len(gdal_urls),
-                                                                     len(images),
-                                                                     len(bands) + 1),
-         end=' ')
-    parallel.run_calls(utils.crop_with_gdal_translate, list(zip(fnames, gdal_urls)),
-                       extra_args=(ulx, uly, lrx, lry, utm_zone, lat_band),
-                       pool_type='threads', nb_workers=parallel_downloads)
-    utils.print_elapsed_time()
+def finalize_crops(images, bands, search_api, out_dir, stack=False,
+                   parallel_downloads=100, reasons=None):
+    """
+    Check the downloaded crops of an AOI, set aside the cloudy ones and embed
+    metadata in the others.
+
+    Args:
+        images: list of metadata dicts of the downloaded images
+        bands: list of requested bands, without the QA band
+        reasons (optional): dict mapping image names to the failure reasons of
+            their crops (None if they succeeded). It is completed in place
+            with the images whose crops are invalid.
+
+    Returns:
+        list of names of the valid images, and list of acquisition dates of
+        the images that failed to download
+    """
+    if reasons is None:
+        reasons = {}
+    crop_bands = bands_with_qa(bands)
 
     # discard images that failed to download
-    images = [x for x in images if bands_files_are_valid(x, bands + ['QA'],
-                                                         search_api, out_dir)]
+    valid = [bands_files_are_valid(x, crop_bands, search_api, out_dir, stack) for
+             x in images]
+    failed_dates = [date_from_metadata_dict(x, search_api) for x, v in
+                    zip(images, valid) if not v]
+    for x, v in zip(images, valid):
+        name = filename_from_metadata_dict(x, search_api)
+        if not v and reasons.get(name) is None:
+            reasons[name] = 'crop timed out or invalid'
+    images = [x for x, v in zip(images, valid) if v]
+    processed = [filename_from_metadata_dict(x, search_api) for x in images]
     # discard images that are totally covered by clouds
     utils.mkdir_p(os.path.join(out_dir, 'cloudy'))
     names = [filename_from_metadata_dict(img, search_api) for img in images]
-    qa_names = [os.path.join(out_dir, '{}_band_QA.tif'.format(f)) for f in names]
-    cloudy = parallel.run_calls(is_image_cloudy, qa_names,
+    if stack:
+        qa_names = [os.path.join(out_dir, '{}.tif'.format(f)) for f in names]
+        qa_band = crop_bands.index('QA') + 1
+    else:
+        qa_names = [os.path.join(out_dir, '{}_band_QA.tif'.format(f)) for f in names]
+        qa_band = None
+    qa_names = [manifest.crop_path(f) for f in qa_names]  # may be set aside
+    cloudy = parallel.run_calls(is_image_cloudy, qa_names, extra_args=(.5, qa_band),
                                 pool_type='processes',
                                 nb_workers=parallel_downloads, verbose=False)
     for name, cloud in zip(names, cloudy):
         if cloud:
-            for b in bands + ['QA']:
-                f = '{}_band_{}.tif'.format(name, b)
-                shutil.move(os.path.join(out_dir, f),
-                            os.path.join(out_dir, 'cloudy', f))
+            for f in bands_filenames(name, crop_bands, stack):
+                src = os.path.join(out_dir, f)
+                if os.path.isfile(src):  # not set aside by a previous run
+                    dst = os.path.join(out_dir, 'cloudy', f)
+                    shutil.move(src, dst)
+                    manifest.update_crop(src, moved_to=dst)
     print('{} cloudy images out of {}'.format(sum(cloudy), len(images)))
     images = [i for i, c in zip(images, cloudy) if not c]
-    utils.print_elapsed_time()
 
     # group band crops per image
     crops = []  # list of lists: [[crop1_b1, crop1_b2 ...], [crop2_b1 ...] ...]
     for img in images:
         name = filename_from_metadata_dict(img, search_api)
-        crops.append([os.path.join(out_dir, '{}_band_{}.tif'.format(name, b))
-                      for b in bands])
+        crops.append([os.path.join(out_dir, f) for f in
+                      bands_filenames(name, bands, stack)])
 
     # embed some metadata in the remaining image files
-    for bands_fnames in crops:
+    for img, bands_fnames in zip(images, crops):
         for f in bands_fnames:  # embed some metadata as gdal geotiff tags
             for k, v in metadata_from_metadata_dict(img, search_api).items():
                 utils.set_geotif_metadata_item(f, k, v)
+            manifest.update_crop(f)
+
+    return processed, failed_dates
+
+
+def get_time_series(aoi, start_date=None, end_date=None, bands=[8],
+                    out_dir='', search_api='devseed', parallel_downloads=100,
+                    debug=False, incremental=False, lookback=manifest.LOOKBACK,
+                    stack=False, adaptive=False, mirrors=MIRRORS):
+    """
+    Main function: crop and download a time series of Landsat-8 images.
+
+    Each crop is read from the fastest of the given mirrors (subset of
+    MIRRORS) having the image.
+
+    With adaptive=True, the number of parallel crops downloads is adjusted
+    per host to what the servers sustain, up to parallel_downloads.
+
+    In stack mode, the requested bands of each image are cropped in one pass
+    and written in a single multi-band file, instead of one file per band. The
+    QA band, needed for cloud detection, is the last band of that file.
+
+    In incremental mode, only the images acquired after the watermark of the
+    previous run (minus a lookback window for late-arriving products) and not
+    processed yet are downloaded.
+    """
+    utils.print_elapsed_time.t0 = datetime.datetime.now()
+
+    if incremental:
+        start_date = manifest.incremental_start_date(out_dir, aoi, start_date,
+                                                     lookback)
+
+    # list available images
+    images = search(aoi, start_date, end_date, search_api)
+    print('Found {} images'.format(len(images)))
+    if incremental:
+        done = manifest.processed_acquisitions(out_dir, aoi)
+        images = [x for x in images if filename_from_metadata_dict(x, search_api)
+                  not in done]
+        print('{} new images'.format(len(images)))
+    utils.print_elapsed_time()
+
+    # build urls, on each mirror
+    urls = {m: [None] * len(images) for m in MIRRORS}
+    if 'aws' in mirrors:
+        urls['aws'] = parallel.run_calls(aws_url_from_metadata_dict, list(images),
+                                         extra_args=(search_api,),
+                                         pool_type='threads',
+                                         nb_workers=parallel_downloads,
+                                         verbose=False)
+    if 'google' in mirrors:
+        urls['google'] = [google_url_from_metadata_dict_backend(x, search_api)
+                          for x in images]
+
+    # build gdal urls (one per mirror) and filenames
+    crop_bands = bands_with_qa(bands)  # QA is needed for cloud detection
+    gdal_urls = []
+    sources = []
+    fnames = []
+    names = []
+    for i, img in enumerate(images):
+        name = filename_from_metadata_dict(img, search_api)
+        bases = [urls[m][i] for m in MIRRORS]
+        if stack:
+            gdal_urls.append([['{}_B{}.TIF'.format(u, b) for b in crop_bands] if
+                              u else None for u in bases])
+            sources.append(crop_source(name, crop_bands))
+            fnames.append(os.path.join(out_dir, '{}.tif'.format(name)))
+            names.append(name)
+        else:
+            for b in crop_bands:
+                gdal_urls.append(['{}_B{}.TIF'.format(u, b) if u else None for u
+                                  in bases])
+                sources.append(crop_source(name, [b]))
+                fnames.append(os.path.join(out_dir, '{}_band_{}.tif'.format(name, b)))
+                names.append(name)
+
+    # convert aoi coordinates to utm
+    ulx, uly, lrx, lry, utm_zone, lat_band = utils.utm_bbx(aoi)
+
+    # download crops
+    utils.mkdir_p(out_dir)
+    print('Downloading {} crops ({} images with {} bands)...'.format(len(gdal_urls),
+                                                                     len(images),
+                                                                     len(bands) + 1),
+         end=' ')
+    # crops already completed by a previous run, from any mirror, are skipped
+    if stack:
+        crop = functools.partial(crop_from_mirrors, utils.crop_bands_with_vrt)
+        outputs = parallel.run_calls(functools.partial(manifest.run_crop_with_source,
+                                                       crop),
+                                     list(zip(fnames, sources, gdal_urls)),
+                                     extra_args=(ulx, uly, lrx, lry, utm_zone,
+                                                 lat_band, None, crop_bands),
+                                     pool_type='adaptive' if adaptive else 'threads',
+                                     nb_workers=parallel_downloads)
+    else:
+        crop = functools.partial(crop_from_mirrors, utils.crop_with_gdal_translate)
+        outputs = parallel.run_calls(functools.partial(manifest.run_crop_with_source,
+                                                       crop),
+                                     list(zip(fnames, sources, gdal_urls)),
+                                     extra_args=(ulx, uly, lrx, lry, utm_zone,
+                                                 lat_band),
+                                     pool_type='adaptive' if adaptive else 'threads',
+                                     nb_workers=parallel_downloads)
+    utils.print_elapsed_time()
+    print_mirror_stats()
+
+    # failure reason of each image: the first failure of its crops
+    reasons = dict.fromkeys(names)
+    for name, reason in zip(names, outputs):
+        if reasons[name] is None:
+            reasons[name] = reason
+
+    processed, failed_dates = finalize_crops(images, bands, search_api, out_dir,
+                                             stack, parallel_downloads, reasons)
+    manifest.record_failures(out_dir, reasons)
+    manifest.print_failures(reasons)
+    utils.print_elapsed_time()
+
+    if incremental:
+        manifest.update(out_dir, aoi, end_date, processed, failed_dates)
+
+
+def get_time_series_batch(aois, out_dirs, start_date=None, end_date=None,
+                          bands=[8], search_api='devseed',
+                          parallel_downloads=100, adaptive=False):
+    """
+    Crop and download time series of Landsat-8 images on many AOIs.
+
+    The AOIs are grouped by scene (WRS path/row and acquisition date). Each
+    band of each scene is read once on the union of the windows of its AOIs,
+    then the AOIs crops are cut from this local copy, hence the remote reads
+    grow with the number of distinct scenes, not with the number of AOIs.
+
+    Args:
+        aois: list of geojson.Polygon objects
+        out_dirs: list of output directories, one per AOI
+    """
+    utils.print_elapsed_time.t0 = datetime.datetime.now()
+
+    # search the images of all the AOIs concurrently, then group the AOIs by scene
+    found = parallel.run_calls(search, aois, extra_args=(start_date, end_date,
+                                                         search_api),
+                               pool_type='threads',
+                               nb_workers=parallel_downloads, verbose=False)
+    images = [x or [] for x in found]
+    scenes = {}
+    for i, x in enumerate(images):
+        for img in x:
+            name = filename_from_metadata_dict(img, search_api)
+            scenes.setdefault(name, (img, []))[1].append(i)
+    names = sorted(scenes)
+    print('Found {} scenes for {} AOIs'.format(len(names), len(aois)))
+    utils.print_elapsed_time()
+
+    # one remote read per band of each scene, on the union window of its AOIs
+    urls = parallel.run_calls(aws_url_from_metadata_dict,
+                              [scenes[n][0] for n in names],
+                              extra_args=(search_api,), pool_type='threads',
+                              nb_workers=parallel_downloads, verbose=False)
+    windows = [utils.utm_bbx(aoi) for aoi in aois]
+    jobs = []
+    job_names = []
+    job_sources = []
+    job_dirs = []  # output directory of each crop of each job
+    for name, url in zip(names, urls):
+        idx = scenes[name][1]
+        w = [windows[i] for i in idx]
+        union = utils.union_window(w, w[0][4], w[0][5])
+        for b in bands_with_qa(bands):
+            u = '{}_B{}.TIF'.format(url, b)
+            todo = [(os.path.join(out_dirs[i], '{}_band_{}.tif'.format(name, b)),
+                     windows[i], out_dirs[i]) for i in idx]
+            source = crop_source(name, [b])
+            todo = [(p, x, d) for p, x, d in todo if not
+                    manifest.crop_is_complete(p, source, x)]
+            if todo:
+                jobs.append((u, [p for p, x, d in todo],
+                             [x for p, x, d in todo], union))
+                job_names.append(name)
+                job_sources.append(source)
+                job_dirs.append([d for p, x, d in todo])
+    for d in set(out_dirs):
+        utils.mkdir_p(d)
+    print('Downloading {} crops for {} AOIs...'.format(len(jobs), len(aois)),
+          end=' ')
+    outputs = parallel.run_calls(utils.crop_aois_from_scene, jobs,
+                                 pool_type='adaptive' if adaptive else 'threads',
+                                 nb_workers=parallel_downloads)
+    reasons = {d: {} for d in out_dirs}  # failure reasons per output directory
+    for (u, outpaths, w, _), name, source, dirs, reason in zip(jobs, job_names,
+                                                              job_sources,
+                                                              job_dirs, outputs):
+        if reason == 'not available':
+            forget_aws_url(u)
+        for p, x, d in zip(outpaths, w, dirs):
+            if os.path.isfile(p) and utils.is_valid(p):
+                manifest.record_crop(p, source, x)
+            elif reasons[d].get(name) is None:
+                reasons[d][name] = reason
+    utils.print_elapsed_time()
+
+    for x, d in zip(images, out_dirs):
+        for img in x:
+            reasons[d].setdefault(filename_from_metadata_dict(img, search_api))
+        finalize_crops(x, bands, search_api, d,
+                       parallel_downloads=parallel_downloads, reasons=reasons[d])
+    for d in reasons:
+        manifest.record_failures(d, reasons[d])
+        manifest.print_failures(reasons[d])
+    utils.print_elapsed_time()
 
 
 if __name__ == '__main__':
@@ -281,6 +704,24 @@ if __name__ == '__main__':
                         default='devseed', help='search API')
     parser.add_argument('--parallel-downloads', type=int, default=100,
                         help='max number of parallel crops downloads')
+    parser.add_argument('--incremental', action='store_true',
+                        help=('only download the images acquired since the '
+                              'last run'))
+    parser.add_argument('--lookback-days', type=int,
+                        default=manifest.LOOKBACK.days,
+                        help=('look-back window (days) of the incremental '
+                              'mode, for late-arriving products'))
+    parser.add_argument('--adaptive', action='store_true',
+                        help=('adjust the number of parallel downloads per '
+                              'host to what the servers sustain, up to '
+                              '--parallel-downloads'))
+    parser.add_argument('--stack', action='store_true',
+                        help=('crop all the bands in one pass and save them '
+                              'in a single multi-band file per image'))
+    parser.add_argument('--mirrors', nargs='*', choices=MIRRORS,
+                        default=MIRRORS,
+                        help=('mirrors to read the images from, the fastest '
+                              'is used'))
     args = parser.parse_args()
 
     if args.geom and (args.lat or args.lon):
@@ -297,4 +738,8 @@ if __name__ == '__main__':
     get_time_series(aoi, start_date=args.start_date, end_date=args.end_date,
                     bands=args.band, out_dir=args.outdir, debug=args.debug,
                     search_api=args.api,
-                    parallel_downloads=args.parallel_downloads)
+                    parallel_downloads=args.parallel_downloads,
+                    incremental=args.incremental,
+                    lookback=datetime.timedelta(days=args.lookback_days),
+                    stack=args.stack, adaptive=args.adaptive,
+                    mirrors=args.mirrors)
@@ -5,6 +5,17 @@
 """
 Automatic download and crop Planet images.
 
+The assets of all the images of a search are activated at once. Their status
+is then polled in rounds, with an increasing delay between rounds, and each
+asset is cropped or downloaded as soon as it turns active. The download
+threads are thus never blocked waiting for an activation.
+
+Whole assets (basic scenes, xml and rpc files) are downloaded in-process with
+the download module: parallel range segments, resume of partial files and
+md5 check. The bytes actually read from the responses bodies are counted
+per host, by the download module and, for the crops, by the range cache,
+and the throughput is printed at the end.
+
 Copyright (C) 2016-17, Carlo de Franchis <carlo.de-franchis@m4x.org>
 """
 
@@ -12,20 +23,37 @@ from __future__ import print_function
 import os
 import sys
 import time
+import uuid
 import shutil
+import datetime
 import argparse
+import threading
 import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import utm
 import dateutil.parser
 
-import planet
 
 import utils
 import parallel
+import manifest
+import download
+import http_session
 import search_planet
 
 ITEM_TYPES = search_planet.ITEM_TYPES
+# activation polling: initial delay (s) between two rounds, growth factor and
+# max delay, number of simultaneous status requests, and give-up delay (s)
+POLL_DELAY = 2.
+POLL_FACTOR = 1.5
+MAX_POLL_DELAY = 30.
+POLL_WORKERS = 10
+ACTIVATION_TIMEOUT = 3600
+
+# delay (s) after which a running download is given up
+DOWNLOAD_TIMEOUT = 600
+
 ASSETS = ['udm',
           'visual',
           'visual_xml',
@@ -40,7 +68,6 @@ ASSETS = ['udm',
           'basic_analytic_dn',
           'basic_analytic_dn_xml',
           'basic_analytic_dn_rpc']
-client = search_planet.client
     
 
 def fname_from_metadata(d):
@@ -70,62 +97,257 @@ def metadata_from_metadata_dict(d):
     return out
 
 
-def get_download_url(item, asset_type):
+def poll_asset(item, asset_type, activate=True):
     """
+    Read the status of an asset of an item, and request its activation if it
+    is inactive.
+
+    Returns:
+        status ('active', 'activating', or a failure reason) and asset dict
     """
-    assets = client.get_assets(item).get()
+    client = search_planet.get_client()
+    try:
+        assets = client.get_assets(item).get()
+    except Exception:  # transient API errors: the asset is polled again
+        return 'activating', None
 
     if asset_type not in assets:
         print("WARNING: no permission to get asset '{}' of {}".format(asset_type,
                                                                      item['_links']['_self']))
         print("\tPermissions for this item are:", item['_permissions'])
-        return
+        return 'no permission', None
 
     asset = assets[asset_type]
-    if asset['status'] == 'inactive':
-        activation = client.activate(asset)
-        r = activation.response.status_code
-        if r != 202:
+    if asset['status'] == 'inactive' and activate:
+        try:
+            r = client.activate(asset).response.status_code
+        except Exception:
+            return 'activating', asset
+        if r not in (202, 204):
             print('activation of item {} asset {} returned {}'.format(item['id'],
                                                                       asset_type,
                                                                       r))
-        else:
-            return get_download_url(item, asset_type)
+            return 'activation returned {}'.format(r), asset
+        return 'activating', asset
+    elif asset['status'] in ('inactive', 'activating'):
+        return 'activating', asset
+    elif asset['status'] == 'active':
+        return 'active', asset
+    return asset['status'], asset
 
-    elif asset['status'] == 'activating':
-        time.sleep(3)
-        return get_download_url(item, asset_type)
 
-    elif asset['status'] == 'active':
-        return asset['location']
+def get_download_url(item, asset_type, timeout=ACTIVATION_TIMEOUT):
+    """
+    Activate an asset if needed, wait until it is active and return its url.
+
+    Returns:
+        url of the asset, or None if it couldn't be activated
+    """
+    delay = POLL_DELAY
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        status, asset = poll_asset(item, asset_type)
+        if status == 'active':
+            return asset['location']
+        elif status != 'activating':
+            return
+        time.sleep(delay)
+        delay = min(MAX_POLL_DELAY, delay * POLL_FACTOR)
+
+
+def download_asset(outfile, url, asset, ulx, uly, lrx, lry, utm_zone=None,
+                   lat_band=None, md5=None):
+    """
+    Download an active asset: crop it, or download the whole file for the
+    metadata and basic (unrectified) assets.
+
+    The output is written to a temporary file renamed on success, hence a
+    download given up on timeout never leaves a partial output file.
+
+    Args:
+        md5 (optional): md5 digest of the asset, checked on whole downloads
+
+    Returns:
+        None if the download succeeded, a failure reason string otherwise
+    """
+    if asset.endswith(('_xml', '_rpc')) or asset.startswith('basic'):
+        # download writes to a partial file itself
+        if not download.download(url, outfile,
+                                 checksum=('md5', md5) if md5 else None):
+            return 'download failed'
+        return
+
+    tmp = os.path.join(os.path.dirname(outfile),
+                       'tmp{}.tif'.format(uuid.uuid4().hex))
+    try:
+        reason = utils.crop_with_gdal_translate(tmp, url, ulx, uly, lrx, lry,
+                                                utm_zone, lat_band)
+        if reason is not None:
+            return reason
+        os.rename(tmp, outfile)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
 
 
 def download_crop(outfile, item, asset, ulx, uly, lrx, lry, utm_zone=None,
                   lat_band=None):
     """
+    Activate an asset, wait for it, then crop or download it.
     """
     url = get_download_url(item, asset)
-    if url is not None:
-        if asset.endswith(('_xml', '_rpc')):
-            os.system('wget {} -O {}'.format(url, outfile))
-        elif asset.startswith('basic'):
-            os.system('wget {} -O {}'.format(url, outfile))
-        else:
-            utils.crop_with_gdal_translate(outfile, url, ulx, uly, lrx, lry,
-                                           utm_zone, lat_band)
+    if url is None:
+        return 'activation failed'
+    return download_asset(outfile, url, asset, ulx, uly, lrx, lry, utm_zone,
+                          lat_band)
+
+
+def activate_and_download(items, asset_type, fun, extra_args=(),
+                          parallel_downloads=multiprocessing.cpu_count(),
+                          timeout=ACTIVATION_TIMEOUT,
+                          download_timeout=DOWNLOAD_TIMEOUT, verbose=True):
+    """
+    Activate the assets of several items at once, and process each one as
+    soon as it turns active.
+
+    The statuses of all the pending assets are polled in rounds of
+    simultaneous requests, with an exponentially increasing delay between
+    rounds. Active assets are handed over to a pool of parallel_downloads
+    threads, which only download. A download running for more than
+    download_timeout seconds is given up: its thread can't be interrupted,
+    but the function returns without waiting for it. The progress of the
+    downloads and the throughput of each host are printed if verbose.
+
+    Args:
+        items: list of item dicts, as returned by search_planet.search
+        asset_type: eg 'analytic'
+        fun: function called as fun(i, asset, *extra_args) on the active
+            assets, where i is the index of the item and asset the asset dict
+            (with its 'location' url). It returns None on success, a failure
+            reason string otherwise.
+        extra_args: tuple of extra arguments passed to fun
+        parallel_downloads: number of simultaneous calls of fun
+        timeout: delay (s) after which the assets still activating are given up
+        download_timeout: delay (s) after which a running call of fun is
+            given up
+
+    Returns:
+        list of failure reasons (None on success), one per item
+    """
+    reasons = [None] * len(items)
+    pending = list(range(len(items)))
+    results = {}
+    started = {}  # start time of the running calls of fun
+    counted = set()  # items already counted in the progress
+    lock = threading.Lock()
+
+    def tick(i):
+        with lock:
+            if verbose and i not in counted:
+                counted.add(i)
+                parallel.show_progress(None)
+
+    def run(i, asset):
+        started[i] = time.time()
+        return fun(i, asset, *extra_args)
+
+    poll_pool = multiprocessing.pool.ThreadPool(POLL_WORKERS)
+    download_pool = multiprocessing.pool.ThreadPool(parallel_downloads)
+    delay = POLL_DELAY
+    t0 = time.time()
+    bytes0 = {h: s['read'] for h, s in list(http_session.host_stats.items())}
+    if verbose:
+        parallel.show_progress.counter = 0
+        parallel.show_progress.total = len(items)
+    while pending:
+        statuses = poll_pool.map(lambda i: poll_asset(items[i], asset_type),
+                                 pending)
+        still_pending = []
+        for i, (status, asset) in zip(pending, statuses):
+            if status == 'active':
+                done = lambda _, i=i: tick(i)
+                results[i] = download_pool.apply_async(run, (i, asset),
+                                                       callback=done,
+                                                       error_callback=done)
+            elif status == 'activating':
+                still_pending.append(i)
+            else:
+                reasons[i] = status
+                tick(i)
+        pending = still_pending
+        if pending:
+            if time.time() - t0 > timeout:
+                for i in pending:
+                    reasons[i] = 'activation timed out'
+                    tick(i)
+                break
+            time.sleep(delay)
+            delay = min(MAX_POLL_DELAY, delay * POLL_FACTOR)
+    poll_pool.close()
+    download_pool.close()
+
+    # wait for the downloads, giving up those running for too long
+    timed_out = set()
+    while True:
+        now = time.time()
+        running = [i for i, r in results.items() if not r.ready() and i not in
+                   timed_out]
+        if not running:
+            break
+        for i in running:
+            if i in started and now - started[i] > download_timeout:
+                print('WARNING: download of item {} timed out'.format(i),
+                      file=sys.stderr)
+                timed_out.add(i)
+                tick(i)
+        time.sleep(1)
+    if timed_out:  # don't wait for the hung threads
+        download_pool.terminate()
+    else:
+        download_pool.join()
+    for i, r in results.items():
+        if i in timed_out:
+            reasons[i] = 'download timed out'
+            continue
+        try:
+            reasons[i] = r.get()
+        except Exception as e:
+            reasons[i] = str(e)
+
+    if verbose:
+        dt = time.time() - t0
+        for h, s in list(http_session.host_stats.items()):
+            n = s['read'] - bytes0.get(h, 0)
+            if n:
+                print('{}: {:.1f} MB received, {:.1f} MB/s'.format(h, n / 1e6,
+                                                                 n / dt / 1e6))
+    return reasons
 
 
 def get_time_series(aoi, start_date=None, end_date=None,
                     item_types=['PSScene3Band'], asset_type='analytic',
                     out_dir='',
-                    parallel_downloads=multiprocessing.cpu_count()):
+                    parallel_downloads=multiprocessing.cpu_count(),
+                    incremental=False, lookback=manifest.LOOKBACK):
     """
     Main function: download and crop of Planet images.
+
+    In incremental mode, only the images acquired after the watermark of the
+    previous run (minus a lookback window for late-arriving products) and not
+    processed yet are downloaded.
     """
+    if incremental:
+        start_date = manifest.incremental_start_date(out_dir, aoi, start_date,
+                                                     lookback)
+
     # list available images
     images = search_planet.search(aoi, start_date, end_date,
                                   item_types=item_types)
     print('Found {} images'.format(len(images)))
+    if incremental:
+        done = manifest.processed_acquisitions(out_dir, aoi)
+        images = [x for x in images if fname_from_metadata(x) not in done]
+        print('{} new images'.format(len(images)))
 
     # build filenames
     fnames = [os.path.join(out_dir, '{}.tif'.format(fname_from_metadata(x)))
@@ -134,21 +356,35 @@ def get_time_series(aoi, start_date=None, end_date=None,
     # convert aoi coordinates to utm
     ulx, uly, lrx, lry, utm_zone, lat_band = utils.utm_bbx(aoi)
 
-    # activate images and download crops
+    # activate all the assets, then download the crops as assets turn active
     utils.mkdir_p(out_dir)
-    print('Downloading {} crops...'.format(len(images)), end=' ')
-    parallel.run_calls(download_crop, list(zip(fnames, images)),
-                       extra_args=(asset_type, ulx, uly, lrx, lry, utm_zone,
-                                   lat_band),
-                       pool_type='threads', nb_workers=parallel_downloads,
-                       timeout=300)
+    print('Activating and downloading {} crops...'.format(len(images)))
+
+    def fetch(i, asset):
+        return download_asset(fnames[i], asset['location'], asset_type, ulx,
+                              uly, lrx, lry, utm_zone, lat_band,
+                              asset.get('md5_digest'))
+
+    reasons = activate_and_download(images, asset_type, fetch,
+                                    parallel_downloads=parallel_downloads)
+    # a download given up on timeout may still write its file afterwards,
+    # hence the valid images are those whose download returned in time
+    valid = [r is None for r in reasons]
+    reasons = {fname_from_metadata(x): r for x, r in zip(images, reasons)}
+    manifest.record_failures(out_dir, reasons)
+    manifest.print_failures(reasons)
 
     # embed some metadata in the image files
-    for f, img in zip(fnames, images):  # embed some metadata as gdal geotiff tags
-        if os.path.isfile(f):
+    for f, img, ok in zip(fnames, images, valid):  # as gdal geotiff tags
+        if ok:
             for k, v in metadata_from_metadata_dict(img).items():
                 utils.set_geotif_metadata_item(f, k, v)
 
+    if incremental:
+        manifest.update(out_dir, aoi, end_date,
+                        [fname_from_metadata(x) for x, v in zip(images, valid) if v],
+                        [x['properties']['acquired'] for x, v in zip(images, valid)
+                         if not v])
     return
 
 
@@ -185,6 +421,13 @@ if __name__ == '__main__':
                                                                     'images'))
     parser.add_argument('--parallel-downloads', type=int, default=10,
                         help='max number of parallel crops downloads')
+    parser.add_argument('--incremental', action='store_true',
+                        help=('only download the images acquired since the '
+                              'last run'))
+    parser.add_argument('--lookback-days', type=int,
+                        default=manifest.LOOKBACK.days,
+                        help=('look-back window (days) of the incremental '
+                              'mode, for late-arriving products'))
     args = parser.parse_args()
 
     if args.geom and (args.lat or args.lon):
@@ -200,4 +443,6 @@ if __name__ == '__main__':
                                             args.height)
     get_time_series(aoi, start_date=args.start_date, end_date=args.end_date,
                     item_types=args.item_types, asset_type=args.asset,
-                    out_dir=args.outdir, parallel_downloads=args.parallel_downloads)
+                    out_dir=args.outdir, parallel_downloads=args.parallel_downloads,
+                    incremental=args.incremental,
+                    lookback=datetime.timedelta(days=args.lookback_days))
@@ -5,21 +5,44 @@
 """
 Automatic download of Sentinel-1 images.
 
+Several SAFE products are downloaded concurrently, each in parallel range
+segments (see the download module), and each product is unzipped as soon as
+it is downloaded, while the next ones are still downloading.
+
+In crop mode, only a crop of the measurement of one polarization is made on
+the AOI, directly from the remote SAFE zip file: its central directory, the
+annotation file and the measurement tiles covering the AOI are read with range
+requests, through the range cache.
+
 Copyright (C) 2016-17, Carlo de Franchis <carlo.de-franchis@ens-cachan.fr>
 """
 from __future__ import print_function
+import re
 import os
+import json
+import shutil
+import struct
 import zipfile
+import functools
 import argparse
-import subprocess
+import datetime
+import multiprocessing.pool
+import numpy as np
 import dateutil.parser
-
-import bs4
-import requests
+import shapely.geometry
 
 import utils
+import parallel
+import manifest
+import backends
+import download
+import range_cache
+import http_session
 import search_scihub
 
+bs4 = backends.lazy_import('bs4')
+requests = backends.lazy_import('requests')
+
 
 scihub_url = 'https://scihub.copernicus.eu/dhus'
 peps_url_search = 'https://peps.cnes.fr/resto/api/collections'
@@ -27,25 +50,54 @@ peps_url_download = 'https://peps.cnes.fr/resto/collections'
 codede_url = 'https://code-de.org/Sentinel1'
 
 
-def query_data_hub(output_filename, url, verbose=False,
-                   user=search_scihub.login,
-                   password=search_scihub.password):
+# SciHub allows only two simultaneous downloads per account
+SCIHUB_SEGMENTS = 1
+
+# crop mode: number of geolocation grid points used to locate the AOI, and
+# margin (pixels) added around it
+GRID_POINTS = 16
+PIXEL_MARGIN = 10
+
+
+def query_data_hub(output_filename, url, verbose=False, user=None,
+                   password=None, checksum=None, segments=SCIHUB_SEGMENTS):
     """
     Download a file from the Copernicus data hub.
+
+    Returns:
+        True if the file was downloaded (and verified, if checksum is given)
+    """
+    if user is None:
+        user, password = search_scihub.credentials()
+    if verbose:
+        print('downloading {}'.format(url))
+    return download.download(url, output_filename, auth=(user, password),
+                             checksum=checksum, segments=segments)
+
+
+def scihub_checksum(image):
     """
-    verbosity = '--verbose' if verbose else '--no-verbose'  # intermediate verbosity with --quiet
-    subprocess.call(['wget',
-                     verbosity,
-                     '--no-check-certificate',
-                     '--auth-no-challenge',
-                     '--user=%s' % user,
-                     '--password=%s' % password,
-                     '--output-document=%s' % output_filename,
-                     url])
+    Read the MD5 checksum of a product from the Copernicus data hub.
 
+    Returns:
+        ('md5', hex digest) tuple, or None if it couldn't be retrieved
+    """
+    url = "{}/odata/v1/Products('{}')/Checksum/Value/$value".format(scihub_url,
+                                                                     image['id'])
+    try:
+        r = http_session.get(url, auth=search_scihub.credentials())
+    except requests.exceptions.RequestException:
+        return
+    if r.ok and r.text.strip():
+        return 'md5', r.text.strip()
 
-def download_safe_from_peps(safe_name, out_dir=''):
+
+def download_safe_from_peps(safe_name, out_dir='', segments=download.SEGMENTS):
     """
+    Download a SAFE zip file from PEPS.
+
+    Returns:
+        True if the file was downloaded
     """
     try:
         login, password = os.environ['PEPS_LOGIN'], os.environ['PEPS_PASSWORD']
@@ -55,28 +107,56 @@ def download_safe_from_peps(safe_name, out_dir=''):
               "credentials for https://peps.cnes.fr/. Create an account if",
               "you don't have one (it's free) then edit the relevant configuration",
               "files (eg .bashrc) to define these environment variables.")
-        return
+        return False
 
     query = '{}/S1/search.atom?identifier={}'.format(peps_url_search, safe_name)
-    r = requests.get(query)
+    r = http_session.get(query)
 
     if not r.ok:
         print('WARNING: request {} failed'.format(query))
-        return
+        return False
 
     img = bs4.BeautifulSoup(r.text, 'xml').find_all('entry')[0]
     peps_id = img.find('id').text
     url = "{}/S1/{}/download".format(peps_url_download, peps_id)
     zip_path = os.path.join(out_dir, '{}.SAFE.zip'.format(safe_name))
-    cmd = "curl -k --basic -u {}:{} {} -o {}".format(login, password,
-                                                     url, zip_path)
-    print(cmd)
-    os.system(cmd)
+    print('downloading {}'.format(url))
+    return download.download(url, zip_path, auth=(login, password),
+                             segments=segments)
 
 
-def download_sentinel_image(image, out_dir='', mirror='code-de'):
+def archive_url(image, mirror='code-de'):
+    """
+    Url of the SAFE zip file of an image on the code-de or SciHub mirror.
+
+    Returns:
+        url, or None for the other mirrors (PEPS urls need a search request)
+    """
+    if mirror == 'code-de':
+        date = [x['content'] for x in image['date'] if x['name'] == 'beginposition']
+        date = dateutil.parser.parse(date[0])
+        return '{}/{:04d}/{:02d}/{:02d}/{}.SAFE.zip'.format(codede_url, date.year,
+                                                            date.month, date.day,
+                                                            image['title'])
+    elif mirror == 'scihub':
+        return "{}/odata/v1/Products('{}')/$value".format(scihub_url, image['id'])
+
+
+def download_sentinel_image(image, out_dir='', mirror='code-de',
+                            segments=download.SEGMENTS):
     """
     Download a Sentinel image.
+
+    The mirrors are tried in this order: code-de, PEPS, then SciHub.
+
+    Args:
+        image: metadata dict of the image, as returned by search_scihub.search
+        out_dir: path to the output directory
+        mirror: first mirror to try
+        segments: number of parallel range segments per file
+
+    Returns:
+        path to the downloaded zip file
     """
     # create output directory
     if out_dir:
@@ -84,53 +164,526 @@ def download_sentinel_image(image, out_dir='', mirror='code-de'):
 
     # download zip file
     zip_path = os.path.join(out_dir, '{}.SAFE.zip'.format(image['title']))
-    date = [x['content'] for x in image['date'] if x['name'] == 'beginposition']
-    date = dateutil.parser.parse(date[0])
     if not zipfile.is_zipfile(zip_path) or os.stat(zip_path).st_size == 0:
         if mirror == 'code-de':
-            url = '{}/{:04d}/{:02d}/{:02d}/{}.SAFE.zip'.format(codede_url,
-                                                               date.year,
-                                                               date.month,
-                                                               date.day,
-                                                               image['title'])
-            if requests.head(url).ok:  # download the file
-                subprocess.call(['wget', url])
-            else:  # switch to PEPS
+            url = archive_url(image, mirror)
+            if not download.download(url, zip_path, segments=segments):
                 print('WARNING: {} not available, trying from PEPS...'.format(url))
-                download_sentinel_image(image, out_dir, mirror='peps')
+                download_sentinel_image(image, out_dir, 'peps', segments)
         elif mirror == 'peps':
             try:
-                download_safe_from_peps(image['title'], out_dir=out_dir)
+                ok = download_safe_from_peps(image['title'], out_dir, segments)
             except Exception:
                 print('WARNING: failed request to {}/S1/search.atom?identifier={}'.format(peps_url_search, image['title']))
+                ok = False
+            if not ok:
                 print('WARNING: will download from scihub mirror...')
-                download_sentinel_image(image, out_dir, mirror='scihub')
+                download_sentinel_image(image, out_dir, 'scihub', segments)
         elif mirror == 'scihub':
-            url = "{}/odata/v1/Products('{}')/$value".format(scihub_url, image['id'])
-            query_data_hub(zip_path, url, verbose=True)
+            url = archive_url(image, mirror)
+            query_data_hub(zip_path, url, verbose=True,
+                           checksum=scihub_checksum(image),
+                           segments=min(segments, SCIHUB_SEGMENTS))
         else:
             print('ERROR: unknown mirror {}'.format(mirror))
 
     return zip_path
 
 
+def file_kind(member):
+    """
+    Kind of a file of a SAFE archive, from its path in the archive.
+
+    Returns:
+        one of 'measurement', 'calibration' (calibration and noise tables),
+        'annotation', 'preview', 'manifest' or 'other'
+    """
+    parts = member.split('/')
+    if parts[-1] == 'manifest.safe':
+        return 'manifest'
+    for k in ['measurement', 'calibration', 'annotation', 'preview']:
+        if k in parts[1:-1]:
+            return k
+    return 'other'
+
+
+def file_polarization(member):
+    """
+    Polarization of a file of a SAFE archive, or None if it has none.
+    """
+    m = re.search(r'-(hh|hv|vh|vv)-', os.path.basename(member).lower())
+    return m.group(1) if m else None
+
+
+def selected_members(names, polarizations=None, kinds=None):
+    """
+    Select the files of a SAFE archive to extract.
+
+    Args:
+        names: list of paths of the files in the archive
+        polarizations (optional): list of polarizations to keep, eg ['vv']
+        kinds (optional): list of file kinds to keep, eg ['measurement',
+            'calibration'], see file_kind. The manifest is always kept.
+
+    Returns:
+        list of paths of the selected files
+    """
+    pols = [p.lower() for p in polarizations] if polarizations else None
+    out = []
+    for n in names:
+        if n.endswith('/'):  # directory
+            continue
+        k = file_kind(n)
+        if k == 'manifest':
+            out.append(n)
+        elif kinds and k not in kinds:
+            continue
+        elif pols and file_polarization(n) not in pols + [None]:
+            continue
+        else:
+            out.append(n)
+    return out
+
+
+def selection_covers(selection, polarizations=None, kinds=None):
+    """
+    Tell if the files selected by some filters include those selected by
+    other filters.
+
+    Args:
+        selection: dict with keys 'polarizations' and 'kinds', filters of a
+            previous extraction (None values mean all the files)
+        polarizations, kinds: requested filters, see selected_members
+    """
+    for k, v in [('polarizations', polarizations), ('kinds', kinds)]:
+        done = selection.get(k)
+        if done is None:
+            continue
+        if v is None or not set(x.lower() for x in v) <= set(done):
+            return False
+    return True
+
+
+def extracted_selections(title, out_dir=''):
+    """
+    Read the filters of the completed extractions of a SAFE archive.
+
+    They are recorded in a .tsd_extracted.json file in the SAFE directory.
+
+    Returns:
+        list of dicts with keys 'polarizations' and 'kinds'
+    """
+    try:
+        with open(os.path.join(out_dir, '{}.SAFE'.format(title),
+                               '.tsd_extracted.json'), 'r') as f:
+            return json.load(f)['selections']
+    except (IOError, OSError, ValueError, KeyError):
+        return []
+
+
+def is_extracted(title, out_dir='', polarizations=None, kinds=None):
+    """
+    Tell if the files of a SAFE archive selected by the given filters were
+    extracted, by a single extraction or several ones.
+
+    The manifest of the archive must be present and one of the recorded
+    extractions must cover the filters.
+    """
+    if not os.path.isfile(os.path.join(out_dir, '{}.SAFE'.format(title),
+                                       'manifest.safe')):
+        return False
+    return any(selection_covers(x, polarizations, kinds) for x in
+               extracted_selections(title, out_dir))
+
+
+def record_extraction(title, out_dir='', polarizations=None, kinds=None):
+    """
+    Record the filters of a completed extraction of a SAFE archive.
+    """
+    selections = extracted_selections(title, out_dir)
+    selections.append({'polarizations': sorted(p.lower() for p in
+                                               polarizations) if polarizations
+                       else None,
+                       'kinds': sorted(kinds) if kinds else None})
+    p = os.path.join(out_dir, '{}.SAFE'.format(title), '.tsd_extracted.json')
+    with open('{}.tmp'.format(p), 'w') as f:
+        json.dump({'selections': selections}, f)
+    os.rename('{}.tmp'.format(p), p)
+
+
+def unzip(zip_path, out_dir='', polarizations=None, kinds=None,
+          delete_zip=False):
+    """
+    Extract a SAFE zip file, or a selection of its files.
+
+    Files are streamed from the archive to a temporary file renamed once its
+    CRC is checked. The manifest is extracted last, then the filters are
+    recorded in the SAFE directory, see is_extracted. Files whose path in the
+    archive points outside of out_dir are not extracted.
+
+    Args:
+        zip_path: path to the zip file
+        out_dir: path to the output directory
+        polarizations, kinds (optional): filters, see selected_members
+        delete_zip: remove the zip file once all the selected files are
+            extracted and verified
+
+    Returns:
+        True if the file was a valid zip file, extracted without error
+    """
+    if not zipfile.is_zipfile(zip_path):
+        return False
+    root = os.path.realpath(out_dir or '.')
+    tmp = None
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as z:
+            members = selected_members(z.namelist(), polarizations, kinds)
+            members.sort(key=lambda n: file_kind(n) == 'manifest')
+            for n in members:
+                path = os.path.realpath(os.path.join(root, *n.split('/')))
+                if not path.startswith(root + os.sep):
+                    print('WARNING: skipping {} of {}: its path is outside of '
+                          'the output directory'.format(n, zip_path))
+                    continue
+                utils.mkdir_p(os.path.dirname(path))
+                tmp = '{}.tmp'.format(path)
+                # reading the member to its end checks its CRC
+                with z.open(n) as src, open(tmp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, download.CHUNK_SIZE)
+                os.rename(tmp, path)
+        title = os.path.basename(zip_path)[:-len('.SAFE.zip')]
+        record_extraction(title, out_dir, polarizations, kinds)
+    except (zipfile.BadZipfile, IOError, OSError) as e:
+        print('WARNING: extraction of {} failed: {}'.format(zip_path, e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    if delete_zip:
+        os.remove(zip_path)
+    return True
+
+
+def read_geolocation_grid(annotation):
+    """
+    Parse the geolocation grid of a Sentinel-1 annotation file.
+
+    Args:
+        annotation: content of the annotation xml file
+
+    Returns:
+        numpy array with one (pixel, line, longitude, latitude) row per grid
+        point, and (width, height) of the image in pixels
+    """
+    soup = bs4.BeautifulSoup(annotation, 'xml')
+    grid = np.array([[float(p.pixel.text), float(p.line.text),
+                      float(p.longitude.text), float(p.latitude.text)] for p in
+                     soup.find_all('geolocationGridPoint')])
+    info = soup.find('imageInformation')
+    return grid, (int(info.numberOfSamples.text), int(info.numberOfLines.text))
+
+
+def pixel_window(grid, size, lon_min, lat_min, lon_max, lat_max,
+                 margin=PIXEL_MARGIN):
+    """
+    Find the pixel window of a Sentinel-1 image covering a lon, lat box.
+
+    The (lon, lat) -> (pixel, line) mapping is approximated by an affine map,
+    fitted on the GRID_POINTS geolocation grid points closest to the box.
+
+    Args:
+        grid, size: geolocation grid and image size, see read_geolocation_grid
+        lon_min, lat_min, lon_max, lat_max: bounding box of the AOI
+        margin: number of pixels added around the window
+
+    Returns:
+        xoff, yoff, xsize, ysize, or None if the box is outside of the image
+    """
+    center = [(lon_min + lon_max) / 2., (lat_min + lat_max) / 2.]
+    d = np.hypot(grid[:, 2] - center[0], grid[:, 3] - center[1])
+    near = grid[np.argsort(d)[:GRID_POINTS]]
+    a = np.column_stack([near[:, 2], near[:, 3], np.ones(len(near))])
+    coefs = np.linalg.lstsq(a, near[:, :2], rcond=-1)[0]
+    corners = np.array([[lon_min, lat_min, 1], [lon_min, lat_max, 1],
+                        [lon_max, lat_min, 1], [lon_max, lat_max, 1]])
+    p = corners.dot(coefs)
+    x0 = max(0, int(np.floor(p[:, 0].min())) - margin)
+    y0 = max(0, int(np.floor(p[:, 1].min())) - margin)
+    x1 = min(size[0], int(np.ceil(p[:, 0].max())) + margin)
+    y1 = min(size[1], int(np.ceil(p[:, 1].max())) + margin)
+    if x0 >= x1 or y0 >= y1:
+        return
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def zip_member_gdal_path(f, z, zip_path, name):
+    """
+    GDAL path of a file of a zip archive.
+
+    Stored (uncompressed) files, such as the measurements of the SAFE zips,
+    are read directly at their offset in the archive, with /vsisubfile/.
+
+    Args:
+        f: file object on the archive, eg a range_cache.RemoteFile object
+        z: zipfile.ZipFile object on f
+        zip_path: GDAL path of the archive, eg a /vsicurl/ path
+        name: path of the file in the archive
+    """
+    info = z.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return '/vsizip/{{{}}}/{}'.format(zip_path, name)
+    # the data starts after the local header and its variable length fields
+    f.seek(info.header_offset)
+    n, m = struct.unpack('<2H', f.read(30)[26:30])
+    offset = info.header_offset + 30 + n + m
+    return '/vsisubfile/{}_{},{}'.format(offset, info.file_size, zip_path)
+
+
+def crop_zipped_measurement(outpath, f, zip_path, polarization, lon_min,
+                            lat_min, lon_max, lat_max, urls=None):
+    """
+    Crop the measurement of a Sentinel-1 product from its SAFE zip.
+
+    The AOI is located in the measurement with the geolocation grid of its
+    annotation file. The crop is a GeoTIFF georeferenced with the GCPs of the
+    measurement, shifted to the crop.
+
+    Args:
+        outpath: path to the output (cropped) image file
+        f: file object on the SAFE zip file
+        zip_path: GDAL path of the SAFE zip file
+        polarization: eg 'vv'
+        lon_min, lat_min, lon_max, lat_max: bounding box of the AOI
+        urls (optional): urls read by the crop, if the zip is remote
+
+    Returns:
+        None if the crop succeeded, a failure reason string otherwise
+    """
+    try:
+        z = zipfile.ZipFile(f)
+        names = z.namelist()
+        tiffs = [n for n in names if file_kind(n) == 'measurement' and
+                 file_polarization(n) == polarization.lower()]
+        for tiff in tiffs:
+            xml = '{}.xml'.format(os.path.splitext(tiff)[0].replace('/measurement/',
+                                                                    '/annotation/'))
+            if xml not in names:
+                continue
+            grid, size = read_geolocation_grid(z.read(xml))
+            window = pixel_window(grid, size, lon_min, lat_min, lon_max, lat_max)
+            if window is not None:
+                path = zip_member_gdal_path(f, z, zip_path, tiff)
+                break
+        else:
+            return 'no {} measurement covering the AOI'.format(polarization)
+    except (zipfile.BadZipfile, IOError, OSError) as e:
+        print('WARNING: unable to read the archive {}: {}'.format(zip_path, e))
+        return 'unreadable archive: {}'.format(e)
+    return utils.retry_crop(utils.crop_pixel_window, (outpath, path) + window,
+                            urls or [])
+
+
+def crop_remote_measurement(outpath, url, polarization, lon_min, lat_min,
+                            lon_max, lat_max):
+    """
+    Crop the measurement of a Sentinel-1 product from its remote SAFE zip,
+    read through the range cache.
+
+    Args:
+        outpath: path to the output (cropped) image file
+        url: url of the SAFE zip file
+        polarization: eg 'vv'
+        lon_min, lat_min, lon_max, lat_max: bounding box of the AOI
+
+    Returns:
+        None if the crop succeeded, a failure reason string otherwise
+    """
+    try:
+        f = range_cache.RemoteFile(url)
+    except IOError as e:
+        print('WARNING: unable to read the remote archive {}: {}'.format(url, e))
+        return 'unreadable archive: {}'.format(e)
+    zip_path = '/vsicurl/{}'.format(range_cache.local_url(url))
+    return crop_zipped_measurement(outpath, f, zip_path, polarization, lon_min,
+                                   lat_min, lon_max, lat_max, [url])
+
+
+def crop_downloaded_measurement(outpath, image, mirror, polarization, lon_min,
+                                lat_min, lon_max, lat_max):
+    """
+    Crop the measurement of a Sentinel-1 product from its downloaded SAFE zip.
+
+    This is used when the range cache is disabled. The zip is downloaded next
+    to the crop, and removed once cropped.
+
+    Args:
+        outpath: path to the output (cropped) image file
+        image: metadata dict of the image, as returned by search_scihub.search
+        mirror: mirror to download the zip from
+        polarization: eg 'vv'
+        lon_min, lat_min, lon_max, lat_max: bounding box of the AOI
+
+    Returns:
+        None if the crop succeeded, a failure reason string otherwise
+    """
+    zip_path = download_sentinel_image(image, os.path.dirname(outpath), mirror)
+    if not zipfile.is_zipfile(zip_path):
+        return 'download failed'
+    try:
+        with open(zip_path, 'rb') as f:
+            return crop_zipped_measurement(outpath, f, zip_path, polarization,
+                                           lon_min, lat_min, lon_max, lat_max)
+    finally:
+        os.remove(zip_path)
+
+
+def get_crops_time_series(aoi, start_date=None, end_date=None, out_dir='',
+                          product_type='GRD', mirror='code-de',
+                          polarization='vv', parallel_downloads=4,
+                          incremental=False, lookback=manifest.LOOKBACK):
+    """
+    Crop a Sentinel-1 image time serie on an AOI, from the remote SAFE zips.
+
+    The crops are named {title}_{polarization}.tif. Only the code-de and
+    SciHub mirrors are supported. SciHub credentials are sent with the range
+    requests made by the range cache. If the cache is disabled, the whole SAFE
+    zips are downloaded, cropped and removed.
+    """
+    if mirror not in ['code-de', 'scihub']:
+        print('ERROR: crops can only be read from the code-de or scihub mirrors')
+        return
+    if mirror == 'scihub':
+        http_session.set_auth(http_session.host(scihub_url),
+                              search_scihub.credentials())
+
+    if incremental:
+        start_date = manifest.incremental_start_date(out_dir, aoi, start_date,
+                                                     lookback)
+
+    # list available images
+    images = search_scihub.search(aoi, start_date, end_date,
+                                  product_type=product_type)
+    if incremental:
+        done = manifest.processed_acquisitions(out_dir, aoi)
+        images = [x for x in images if x['title'] not in done]
+
+    # crop
+    utils.mkdir_p(out_dir)
+    bbox = shapely.geometry.shape(aoi).bounds
+    fnames = [os.path.join(out_dir, '{}_{}.tif'.format(x['title'], polarization))
+              for x in images]
+    urls = [archive_url(x, mirror) for x in images]
+    if range_cache.enabled:
+        crop = functools.partial(manifest.run_crop, crop_remote_measurement)
+        args = list(zip(fnames, urls))
+        extra_args = (polarization,) + tuple(bbox)
+        timeout = 600
+    else:
+        print('WARNING: the range cache is disabled, downloading the whole '
+              'products')
+        crop = functools.partial(manifest.run_crop_with_source,
+                                 crop_downloaded_measurement)
+        args = list(zip(fnames, urls, images))
+        extra_args = (mirror, polarization) + tuple(bbox)
+        timeout = None  # the whole products are downloaded
+    print('Cropping {} images...'.format(len(images)), end=' ')
+    outputs = parallel.run_calls(crop, args, extra_args=extra_args,
+                                 pool_type='threads',
+                                 nb_workers=parallel_downloads, timeout=timeout)
+    valid = [os.path.isfile(f) for f in fnames]
+    reasons = {x['title']: (None if v else r or 'crop timed out or invalid')
+               for x, v, r in zip(images, valid, outputs)}
+    manifest.record_failures(out_dir, reasons)
+    manifest.print_failures(reasons)
+
+    if incremental:
+        failed_dates = [[d['content'] for d in x['date'] if d['name'] ==
+                         'beginposition'][0] for x, v in zip(images, valid)
+                        if not v]
+        manifest.update(out_dir, aoi, end_date,
+                        [x['title'] for x, v in zip(images, valid) if v],
+                        failed_dates)
+
+
 def get_time_series(aoi, start_date=None, end_date=None, out_dir='',
-                    product_type='GRD', mirror='code-de'):
+                    product_type='GRD', mirror='code-de', incremental=False,
+                    lookback=manifest.LOOKBACK, parallel_downloads=2,
+                    segments=download.SEGMENTS, polarizations=None, kinds=None,
+                    delete_zip=False,
+                    parallel_extractions=multiprocessing.cpu_count()):
     """
     Main function: download a Sentinel-1 image time serie.
+
+    Up to parallel_downloads products are downloaded simultaneously, each in
+    segments parallel range requests. Each product is unzipped as soon as it
+    is downloaded, up to parallel_extractions archives at once.
+
+    Only the files with the given polarizations (eg ['vv']) and kinds (eg
+    ['measurement', 'calibration']) are extracted, if given. With
+    delete_zip=True the zip files are removed once extracted: the products
+    whose zip is gone and whose files selected by these filters were all
+    extracted aren't downloaded again.
+
+    In incremental mode, only the images acquired after the watermark of the
+    previous run (minus a lookback window for late-arriving products) and not
+    processed yet are downloaded.
     """
+    if incremental:
+        start_date = manifest.incremental_start_date(out_dir, aoi, start_date,
+                                                     lookback)
+
     # list available images
     images = search_scihub.search(aoi, start_date, end_date,
                                   product_type=product_type)
+    if incremental:
+        done = manifest.processed_acquisitions(out_dir, aoi)
+        images = [x for x in images if x['title'] not in done]
 
-    # download
-    zips = []
-    for image in images:
-        zips.append(download_sentinel_image(image, out_dir, mirror))
+    # download, and unzip the products as they arrive
+    def fetch(i):
+        title = images[i]['title']
+        zip_path = os.path.join(out_dir, '{}.SAFE.zip'.format(title))
+        if not os.path.exists(zip_path) and is_extracted(title, out_dir,
+                                                         polarizations, kinds):
+            return i, None, True
+        try:
+            return i, download_sentinel_image(images[i], out_dir, mirror,
+                                              segments), False
+        except Exception as e:
+            print('WARNING: download of {} failed: {}'.format(title, e))
+            return i, None, False
 
-    # unzip
-    for z in zips:
-        zipfile.ZipFile(z, 'r').extractall(path=out_dir)
+    def show(i, ok):
+        print('{}: {}'.format(images[i]['title'], 'done' if ok else 'failed'))
+
+    valid = [False] * len(images)
+    extractions = {}
+    unzip_pool = multiprocessing.pool.ThreadPool(max(1, parallel_extractions))
+    pool = multiprocessing.pool.ThreadPool(max(1, parallel_downloads))
+    for i, z, done in pool.imap_unordered(fetch, range(len(images))):
+        if done:
+            valid[i] = True
+            show(i, True)
+        elif z is None:
+            show(i, False)
+        else:
+            extractions[i] = unzip_pool.apply_async(unzip, (z, out_dir,
+                                                            polarizations,
+                                                            kinds, delete_zip),
+                                                    callback=functools.partial(show, i))
+    pool.close()
+    pool.join()
+    unzip_pool.close()
+    unzip_pool.join()
+    for i, r in extractions.items():
+        valid[i] = r.get()
+
+    if incremental:
+        failed_dates = [[d['content'] for d in x['date'] if d['name'] ==
+                         'beginposition'][0] for x, v in zip(images, valid)
+                        if not v]
+        manifest.update(out_dir, aoi, end_date,
+                        [x['title'] for x, v in zip(images, valid) if v],
+                        failed_dates)
 
 
 if __name__ == '__main__':
@@ -157,6 +710,33 @@ if __name__ == '__main__':
                         help='type of image: GRD, SLC, RAW', default='GRD')
     parser.add_argument('--mirror', help='download mirror: code-de, peps or scihub',
                         default='code-de')
+    parser.add_argument('--parallel-downloads', type=int, default=2,
+                        help='max number of simultaneous products downloads')
+    parser.add_argument('--segments', type=int, default=download.SEGMENTS,
+                        help=('number of parallel range requests per '
+                              'product download'))
+    parser.add_argument('--polarization', nargs='*',
+                        choices=['hh', 'hv', 'vh', 'vv'],
+                        help=('only extract the files of these polarizations '
+                              '(default: all)'))
+    parser.add_argument('--kind', nargs='*',
+                        choices=['measurement', 'annotation', 'calibration',
+                                 'preview', 'other'],
+                        help=('only extract these kinds of files (default: '
+                              'all). The manifest is always extracted.'))
+    parser.add_argument('--delete-zip', action='store_true',
+                        help='remove the zip files once extracted')
+    parser.add_argument('--crop', action='store_true',
+                        help=('crop the measurement of the first --polarization '
+                              '(default vv) on the AOI from the remote zip '
+                              'files, instead of downloading them'))
+    parser.add_argument('--incremental', action='store_true',
+                        help=('only download the images acquired since the '
+                              'last run'))
+    parser.add_argument('--lookback-days', type=int,
+                        default=manifest.LOOKBACK.days,
+                        help=('look-back window (days) of the incremental '
+                              'mode, for late-arriving products'))
     args = parser.parse_args()
 
     if args.geom and (args.lat or args.lon):
@@ -169,13 +749,29 @@ if __name__ == '__main__':
         parser.error('either --geom, {--lat, --lon} or --title must be defined')
 
     if args.title:
-        download_safe_from_peps(args.title, args.outdir)
+        download_safe_from_peps(args.title, args.outdir, args.segments)
     else:
         if args.geom:
             aoi = args.geom
         else:
             aoi = utils.geojson_geometry_object(args.lat, args.lon, args.width,
                                                 args.height)
-        get_time_series(aoi, start_date=args.start_date, end_date=args.end_date,
-                        out_dir=args.outdir, product_type=args.product_type,
-                        mirror=args.mirror)
+        if args.crop:
+            get_crops_time_series(aoi, start_date=args.start_date,
+                                  end_date=args.end_date, out_dir=args.outdir,
+                                  product_type=args.product_type,
+                                  mirror=args.mirror,
+                                  polarization=(args.polarization or ['vv'])[0],
+                                  parallel_downloads=args.parallel_downloads,
+                                  incremental=args.incremental,
+                                  lookback=datetime.timedelta(days=args.lookback_days))
+        else:
+            get_time_series(aoi, start_date=args.start_date,
+                            end_date=args.end_date, out_dir=args.outdir,
+                            product_type=args.product_type, mirror=args.mirror,
+                            incremental=args.incremental,
+                            lookback=datetime.timedelta(days=args.lookback_days),
+                            parallel_downloads=args.parallel_downloads,
+                            segments=args.segments,
+                            polarizations=args.polarization, kinds=args.kind,
+                            delete_zip=args.delete_zip)
@@ -13,20 +13,25 @@ import re
 import os
 import sys
 import shutil
+import functools
 import argparse
 import multiprocessing
 import dateutil.parser
 import datetime
-import requests
-import bs4
 import geojson
 import shapely.geometry
 
 import utils
+import backends
+import http_session
 import parallel
+import manifest
 import search_devseed
 
 
+requests = backends.lazy_import('requests')
+bs4 = backends.lazy_import('bs4')
+
 # http://sentinel-s2-l1c.s3-website.eu-central-1.amazonaws.com
 aws_url = 'http://sentinel-s2-l1c.s3.amazonaws.com'
 
@@ -109,8 +114,11 @@ def metadata_from_metadata_dict(d, api='planet'):
         sun_azimuth = d['properties']['sun_azimuth']
     elif api == 'scihub' or api == 'devseed':
         url = aws_url_from_metadata_dict(d, api)
-        r = requests.get('{}metadata.xml'.format(url))
-        if r.ok:
+        try:
+            r = http_session.get('{}metadata.xml'.format(url))
+        except requests.exceptions.RequestException:
+            r = None
+        if r is not None and r.ok:
             soup = bs4.BeautifulSoup(r.text, 'xml')
             sun_zenith = float(soup.Mean_Sun_Angle.ZENITH_ANGLE.text)
             sun_azimuth = float(soup.Mean_Sun_Angle.AZIMUTH_ANGLE.text)
@@ -124,21 +132,23 @@ def metadata_from_metadata_dict(d, api='planet'):
     }
 
 
-def is_image_cloudy_at_location(image_aws_url, aoi, p=.5):
+def read_cloud_mask(image_aws_url):
     """
-    Tell if the given area of interest is covered by clouds in a given image.
-
-    The location is considered covered if a fraction larger than p of its surface is
-    labeled as clouds in the sentinel-2 gml cloud masks.
+    Read the opaque clouds polygons of an image from its gml cloud mask.
 
     Args:
         image_aws_url: url of the image on AWS
-        aoi: geojson object
-        p: fraction threshold
+
+    Returns:
+        list of shapely polygons, or None if the mask couldn't be retrieved
     """
     polygons = []
     url = requests.compat.urljoin(image_aws_url, 'qi/MSK_CLOUDS_B00.gml')
-    r = requests.get(url)
+    try:
+        r = http_session.get(url)
+    except requests.exceptions.RequestException as e:
+        print("WARNING: couldn't retrieve cloud mask file", url, e)
+        return None
     if r.ok:
         soup = bs4.BeautifulSoup(r.text, 'xml')
         for polygon in soup.find_all('MaskFeature'):
@@ -146,7 +156,7 @@ def is_image_cloudy_at_location(image_aws_url, aoi, p=.5):
                 polygons.append(polygon)
     else:
         print("WARNING: couldn't retrieve cloud mask file", url)
-        return False
+        return None
 
     clouds = []
     for polygon in polygons:
@@ -156,6 +166,31 @@ def is_image_cloudy_at_location(image_aws_url, aoi, p=.5):
             clouds.append(shapely.geometry.Polygon(points))
         except IndexError:
             pass
+    return clouds
+
+
+def is_image_cloudy_at_location(image_aws_url, aoi, p=.5, clouds=None):
+    """
+    Tell if the given area of interest is covered by clouds in a given image.
+
+    The location is considered covered if a fraction larger than p of its surface is
+    labeled as clouds in the sentinel-2 gml cloud masks.
+
+    Args:
+        image_aws_url: url of the image on AWS
+        aoi: geojson object
+        p: fraction threshold
+        clouds (optional): clouds polygons of the image, as returned by
+            read_cloud_mask. If None, they are read from the image url.
+
+    Returns:
+        True if the AOI is cloudy. False if it isn't, or if the cloud mask
+        couldn't be retrieved.
+    """
+    if clouds is None:
+        clouds = read_cloud_mask(image_aws_url)
+        if clouds is None:
+            return False
 
     aoi_shape = shapely.geometry.shape(aoi)
     try:
@@ -165,26 +200,41 @@ def is_image_cloudy_at_location(image_aws_url, aoi, p=.5):
         return False
 
 
-def bands_files_are_valid(img, bands, search_api, directory):
+def bands_filenames(name, bands, stack=False):
+    """
+    Return the names of the files of an image: one per band, or a single
+    multi-band file in stack mode.
+    """
+    if stack:
+        return ['{}.tif'.format(name)]
+    return ['{}_band_{}.tif'.format(name, b) for b in bands]
+
+
+def bands_files_are_valid(img, bands, search_api, directory, stack=False):
     """
     Check if all bands images files are valid.
+
+    Files recorded as complete in the manifest are checked with a stat call
+    only, the others are opened with gdal.
     """
     name = filename_from_metadata_dict(img, search_api)
-    filenames = ['{}_band_{}.tif'.format(name, b) for b in bands]
+    filenames = bands_filenames(name, bands, stack)
     paths = [os.path.join(directory, f) for f in filenames]
-    return all(utils.is_valid(p) for p in paths)
+    return all(manifest.crop_is_complete(p) or utils.is_valid(p) for p in paths)
 
 
-
-def get_time_series(aoi, start_date=None, end_date=None, bands=['B04'],
-                    out_dir='', search_api='devseed',
-                    parallel_downloads=multiprocessing.cpu_count()):
+def search(aoi, start_date=None, end_date=None, search_api='devseed',
+           mgrs_id=None):
     """
-    Main function: crop and download a time series of Sentinel-2 images.
-    """
-    utils.print_elapsed_time.t0 = datetime.datetime.now()
+    List the Sentinel-2 images available on an AOI, one per acquisition date.
 
-    # list available images
+    Args:
+        mgrs_id (optional): keep only the images of this MGRS tile. They are
+            selected before the removal of the same day duplicates.
+
+    Returns:
+        list of (api, metadata dict) tuples, sorted by acquisition date
+    """
     if search_api == 'devseed':
         images = search_devseed.search(aoi, start_date, end_date,
                                        'Sentinel-2')['results']
@@ -196,27 +246,154 @@ def get_time_series(aoi, start_date=None, end_date=None, bands=['B04'],
         import search_planet
         images = search_planet.search(aoi, start_date, end_date,
                                       item_types=['Sentinel2L1C'])
+    if search_api == 'federated':
+        import search_federated
+        images = search_federated.search(aoi, start_date, end_date,
+                                         satellite='Sentinel-2')
+    else:
+        images = [(search_api, x) for x in images]
+
+    if mgrs_id is not None:
+        images = [(a, x) for a, x in images if
+                  date_and_mgrs_id_from_metadata_dict(x, a)[1].lstrip('0') ==
+                  mgrs_id.lstrip('0')]
 
     # sort images by acquisition date, then by mgrs id
-    images.sort(key=lambda k: date_and_mgrs_id_from_metadata_dict(k, search_api))
+    images.sort(key=lambda k: date_and_mgrs_id_from_metadata_dict(k[1], k[0]))
 
     # remove duplicates (same acquisition day, different mgrs tile id)
     seen = set()
-    images = [x for x in images if not (date_and_mgrs_id_from_metadata_dict(x, search_api)[0] in seen
-                                        or  # seen.add() returns None
-                                        seen.add(date_and_mgrs_id_from_metadata_dict(x, search_api)[0]))]
+    return [(a, x) for a, x in images if not (date_and_mgrs_id_from_metadata_dict(x, a)[0] in seen
+                                              or  # seen.add() returns None
+                                              seen.add(date_and_mgrs_id_from_metadata_dict(x, a)[0]))]
+
+
+def finalize_crops(images, aoi, bands, out_dir, stack=False,
+                   parallel_downloads=multiprocessing.cpu_count(), clouds=None,
+                   reasons=None):
+    """
+    Check the downloaded crops of an AOI, set aside the cloudy ones and embed
+    metadata in the others.
+
+    Args:
+        images: list of (api, metadata dict) tuples of the downloaded images
+        aoi: geojson.Polygon object
+        clouds (optional): dict giving the clouds polygons of each image url,
+            as returned by read_cloud_mask, to avoid reading the masks again
+        reasons (optional): dict mapping image names to the failure reasons of
+            their crops (None if they succeeded). It is completed in place
+            with the images whose crops are invalid and the images whose cloud
+            mask couldn't be retrieved (these images are kept).
+
+    Returns:
+        list of names of the valid images, and list of acquisition dates of
+        the images that failed to download
+    """
+    if reasons is None:
+        reasons = {}
+
+    # discard images that failed to download
+    valid = [bands_files_are_valid(x, bands, a, out_dir, stack) for a, x in images]
+    failed_dates = [date_and_mgrs_id_from_metadata_dict(x, a)[0] for
+                    (a, x), v in zip(images, valid) if not v]
+    for (a, x), v in zip(images, valid):
+        name = filename_from_metadata_dict(x, a)
+        if not v and reasons.get(name) is None:
+            reasons[name] = 'crop timed out or invalid'
+    images = [i for i, v in zip(images, valid) if v]
+    processed = [filename_from_metadata_dict(x, a) for a, x in images]
+    # discard images that are totally covered by clouds
+    utils.mkdir_p(os.path.join(out_dir, 'cloudy'))
+    urls = [aws_url_from_metadata_dict(img, api) for api, img in images]
+    utm_aoi = utils.geojson_lonlat_to_utm(aoi)
+    if clouds is None:
+        print('Reading {} cloud masks...'.format(len(urls)), end=' ')
+        masks = parallel.run_calls(read_cloud_mask, urls, pool_type='threads',
+                                   nb_workers=parallel_downloads, verbose=True)
+        clouds = dict(zip(urls, masks))
+    cloudy = [is_image_cloudy_at_location(u, utm_aoi, clouds=clouds[u])
+              if clouds.get(u) is not None else False for u in urls]
+    for (api, img), u in zip(images, urls):
+        if clouds.get(u) is None:
+            reasons[filename_from_metadata_dict(img, api)] = 'cloud mask unavailable'
+    for (api, img), cloud in zip(images, cloudy):
+        name = filename_from_metadata_dict(img, api)
+        if cloud:
+            for f in bands_filenames(name, bands, stack):
+                src = os.path.join(out_dir, f)
+                if os.path.isfile(src):  # not set aside by a previous run
+                    dst = os.path.join(out_dir, 'cloudy', f)
+                    shutil.move(src, dst)
+                    manifest.update_crop(src, moved_to=dst)
+    print('{} cloudy images out of {}'.format(sum(cloudy), len(images)))
+    images = [i for i, c in zip(images, cloudy) if not c]
+
+    # embed some metadata in the remaining image files
+    for api, img in images:
+        name = filename_from_metadata_dict(img, api)
+        metadata = metadata_from_metadata_dict(img, api)
+        # embed some metadata as gdal geotiff tags
+        for f in bands_filenames(name, bands, stack):
+            f = os.path.join(out_dir, f)
+            for k, v in metadata.items():
+                utils.set_geotif_metadata_item(f, k, v)
+            manifest.update_crop(f)
+    return processed, failed_dates
+
+
+def get_time_series(aoi, start_date=None, end_date=None, bands=['B04'],
+                    out_dir='', search_api='devseed',
+                    parallel_downloads=multiprocessing.cpu_count(),
+                    incremental=False, lookback=manifest.LOOKBACK,
+                    stack=False, adaptive=False):
+    """
+    Main function: crop and download a time series of Sentinel-2 images.
+
+    With adaptive=True, the number of parallel crops downloads is adjusted
+    per host to what the servers sustain, up to parallel_downloads.
+
+    In stack mode, the requested bands of each image are cropped in one pass
+    and written in a single multi-band file, instead of one file per band.
+
+    In incremental mode, only the images acquired after the watermark of the
+    previous run (minus a lookback window for late-arriving products) and not
+    processed yet are downloaded.
+
+    With search_api='federated', the devseed, scihub and planet APIs are
+    queried concurrently and their results are merged.
+    """
+    utils.print_elapsed_time.t0 = datetime.datetime.now()
+
+    if incremental:
+        start_date = manifest.incremental_start_date(out_dir, aoi, start_date,
+                                                     lookback)
+
+    # list available images, as (api, metadata) pairs
+    images = search(aoi, start_date, end_date, search_api)
     print('Found {} images'.format(len(images)))
+    if incremental:
+        done = manifest.processed_acquisitions(out_dir, aoi)
+        images = [(a, x) for a, x in images if filename_from_metadata_dict(x, a)
+                  not in done]
+        print('{} new images'.format(len(images)))
     utils.print_elapsed_time()
 
     # build urls and filenames
     urls = []
     fnames = []
-    for img in images:
-        url = aws_url_from_metadata_dict(img, search_api)
-        name = filename_from_metadata_dict(img, search_api)
-        for b in bands:
-            urls.append('{}{}.jp2'.format(url, b))
-            fnames.append(os.path.join(out_dir, '{}_band_{}.tif'.format(name, b)))
+    names = []
+    for api, img in images:
+        url = aws_url_from_metadata_dict(img, api)
+        name = filename_from_metadata_dict(img, api)
+        if stack:
+            urls.append(['{}{}.jp2'.format(url, b) for b in bands])
+            fnames.append(os.path.join(out_dir, '{}.tif'.format(name)))
+            names.append(name)
+        else:
+            for b in bands:
+                urls.append('{}{}.jp2'.format(url, b))
+                fnames.append(os.path.join(out_dir, '{}_band_{}.tif'.format(name, b)))
+                names.append(name)
 
     # convert aoi coordates to utm
     ulx, uly, lrx, lry, utm_zone, lat_band = utils.utm_bbx(aoi)
@@ -227,45 +404,153 @@ def get_time_series(aoi, start_date=None, end_date=None, bands=['B04'],
                                                                      len(images),
                                                                      len(bands)),
           end=' ')
-    parallel.run_calls(utils.crop_with_gdal_translate, list(zip(fnames, urls)),
-                       extra_args=(ulx, uly, lrx, lry, utm_zone, lat_band, 'UInt16'),
-                       pool_type='threads', nb_workers=parallel_downloads)
+    # crops already completed by a previous run are skipped
+    if stack:
+        outputs = parallel.run_calls(functools.partial(manifest.run_crop,
+                                                       utils.crop_bands_with_vrt),
+                                     list(zip(fnames, urls)),
+                                     extra_args=(ulx, uly, lrx, lry, utm_zone,
+                                                 lat_band, 'UInt16', bands),
+                                     pool_type='adaptive' if adaptive else 'threads',
+                                     nb_workers=parallel_downloads)
+    else:
+        outputs = parallel.run_calls(functools.partial(manifest.run_crop,
+                                                       utils.crop_with_gdal_translate),
+                                     list(zip(fnames, urls)),
+                                     extra_args=(ulx, uly, lrx, lry, utm_zone,
+                                                 lat_band, 'UInt16'),
+                                     pool_type='adaptive' if adaptive else 'threads',
+                                     nb_workers=parallel_downloads)
     utils.print_elapsed_time()
 
-    # discard images that failed to download
-    images = [x for x in images if bands_files_are_valid(x, bands, search_api,
-                                                         out_dir)]
-    # discard images that are totally covered by clouds
-    utils.mkdir_p(os.path.join(out_dir, 'cloudy'))
-    urls = [aws_url_from_metadata_dict(img, search_api) for img in images]
-    print('Reading {} cloud masks...'.format(len(urls)), end=' ')
-    cloudy = parallel.run_calls(is_image_cloudy_at_location, urls,
-                                extra_args=(utils.geojson_lonlat_to_utm(aoi),),
-                                pool_type='threads',
-                                nb_workers=parallel_downloads, verbose=True)
-    for img, cloud in zip(images, cloudy):
-        name = filename_from_metadata_dict(img, search_api)
-        if cloud:
-            for b in bands:
-                f = '{}_band_{}.tif'.format(name, b)
-                shutil.move(os.path.join(out_dir, f),
-                            os.path.join(out_dir, 'cloudy', f))
-    print('{} cloudy images out of {}'.format(sum(cloudy), len(images)))
-    images = [i for i, c in zip(images, cloudy) if not c]
+    # failure reason of each image: the first failure of its crops
+    reasons = dict.fromkeys(names)
+    for name, reason in zip(names, outputs):
+        if reasons[name] is None:
+            reasons[name] = reason
+
+    processed, failed_dates = finalize_crops(images, aoi, bands, out_dir, stack,
+                                             parallel_downloads, reasons=reasons)
+    manifest.record_failures(out_dir, reasons)
+    manifest.print_failures(reasons)
     utils.print_elapsed_time()
 
-    # group band crops per image
-    crops = []  # list of lists: [[crop1_b1, crop1_b2 ...], [crop2_b1 ...] ...]
-    for img in images:
-        name = filename_from_metadata_dict(img, search_api)
-        crops.append([os.path.join(out_dir, '{}_band_{}.tif'.format(name, b))
-                      for b in bands])
+    if incremental:
+        manifest.update(out_dir, aoi, end_date, processed, failed_dates)
 
-    # embed some metadata in the remaining image files
-    for bands_fnames in crops:
-        for f in bands_fnames:  # embed some metadata as gdal geotiff tags
-            for k, v in metadata_from_metadata_dict(img, search_api).items():
-                utils.set_geotif_metadata_item(f, k, v)
+
+def get_time_series_batch(aois, out_dirs, start_date=None, end_date=None,
+                          bands=['B04'], search_api='devseed',
+                          parallel_downloads=multiprocessing.cpu_count(),
+                          adaptive=False):
+    """
+    Crop and download time series of Sentinel-2 images on many AOIs.
+
+    The AOIs are grouped by MGRS tile, and the images of the tile covering
+    each AOI are searched, with one search per AOI. Each band of each
+    image is then read once on the union of the windows of the AOIs it
+    covers, and the AOIs crops are cut from this local copy, hence the remote
+    reads grow with the number of distinct images, not with the number of
+    AOIs.
+
+    Args:
+        aois: list of geojson.Polygon objects
+        out_dirs: list of output directories, one per AOI
+    """
+    utils.print_elapsed_time.t0 = datetime.datetime.now()
+
+    # group the AOIs by MGRS tile, preferring a tile containing the whole AOI
+    groups = {}
+    for i, tiles in enumerate(search_devseed.mgrs_tiles_of_aois(aois)):
+        if not tiles:
+            print('WARNING: AOI {} is not covered by any MGRS tile'.format(i))
+            continue
+        contained = [m for m, c, f in tiles if f]
+        groups.setdefault(contained[0] if contained else tiles[0][0], []).append(i)
+    print('{} AOIs in {} MGRS tiles'.format(len(aois), len(groups)))
+
+    # search the images of the tile of each AOI. An image may cover some AOIs
+    # of its tile only, hence the coverage is checked for each AOI.
+    tiles = sorted(groups)
+    tile_of = {i: t for t in tiles for i in groups[t]}
+    idx = sorted(tile_of)
+    found = parallel.run_calls(search, [(aois[i], start_date, end_date,
+                                         search_api, tile_of[i]) for i in idx],
+                               pool_type='threads',
+                               nb_workers=parallel_downloads, verbose=False)
+    aoi_images = {i: x or [] for i, x in zip(idx, found)}
+
+    # distinct images of each tile, and the AOIs they cover
+    images = {t: [] for t in tiles}
+    covered = {}
+    for i in idx:
+        for api, img in aoi_images[i]:
+            name = filename_from_metadata_dict(img, api)
+            if name not in covered:
+                covered[name] = []
+                images[tile_of[i]].append((api, img))
+            covered[name].append(i)
+    for t in tiles:
+        images[t].sort(key=lambda k: date_and_mgrs_id_from_metadata_dict(k[1], k[0]))
+    print('Found {} images'.format(sum(len(x) for x in images.values())))
+    utils.print_elapsed_time()
+
+    # one remote read per band of each image, on the union window of its AOIs
+    windows = [utils.utm_bbx(aoi) for aoi in aois]
+    jobs = []
+    names = []
+    job_dirs = []  # output directory of each crop of each job
+    for t in tiles:
+        for api, img in images[t]:
+            url = aws_url_from_metadata_dict(img, api)
+            name = filename_from_metadata_dict(img, api)
+            union = utils.union_window([windows[i] for i in covered[name]],
+                                       int(t[:-3]), t[-3])
+            for b in bands:
+                u = '{}{}.jp2'.format(url, b)
+                todo = [(os.path.join(out_dirs[i], '{}_band_{}.tif'.format(name, b)),
+                         windows[i], out_dirs[i]) for i in covered[name]]
+                todo = [(p, w, d) for p, w, d in todo if not
+                        manifest.crop_is_complete(p, u, w + ('UInt16',))]
+                if todo:
+                    jobs.append((u, [p for p, w, d in todo],
+                                 [w for p, w, d in todo], union))
+                    names.append(name)
+                    job_dirs.append([d for p, w, d in todo])
+    for d in set(out_dirs):
+        utils.mkdir_p(d)
+    print('Downloading {} crops for {} AOIs...'.format(len(jobs), len(aois)),
+          end=' ')
+    outputs = parallel.run_calls(utils.crop_aois_from_scene, jobs,
+                                 extra_args=('UInt16',),
+                                 pool_type='adaptive' if adaptive else 'threads',
+                                 nb_workers=parallel_downloads)
+    reasons = {d: {} for d in out_dirs}  # failure reasons per output directory
+    for (u, outpaths, w, _), name, dirs, reason in zip(jobs, names, job_dirs,
+                                                       outputs):
+        for p, x, d in zip(outpaths, w, dirs):
+            if os.path.isfile(p) and utils.is_valid(p):
+                manifest.record_crop(p, u, x + ('UInt16',))
+            elif reasons[d].get(name) is None:
+                reasons[d][name] = reason
+    utils.print_elapsed_time()
+
+    # read each cloud mask once, then check the crops of each AOI
+    urls = sorted(set(aws_url_from_metadata_dict(img, api) for t in tiles
+                      for api, img in images[t]))
+    print('Reading {} cloud masks...'.format(len(urls)), end=' ')
+    masks = parallel.run_calls(read_cloud_mask, urls, pool_type='threads',
+                               nb_workers=parallel_downloads)
+    clouds = dict(zip(urls, masks))
+    for i in idx:
+        for api, img in aoi_images[i]:
+            reasons[out_dirs[i]].setdefault(filename_from_metadata_dict(img, api))
+        finalize_crops(aoi_images[i], aois[i], bands, out_dirs[i],
+                       clouds=clouds, reasons=reasons[out_dirs[i]])
+    for d in reasons:
+        manifest.record_failures(d, reasons[d])
+        manifest.print_failures(reasons[d])
+    utils.print_elapsed_time()
 
 
 if __name__ == '__main__':
@@ -292,11 +577,26 @@ if __name__ == '__main__':
                               ' are {}'.format(', '.join(all_bands))))
     parser.add_argument('-o', '--outdir', type=str, help=('path to save the '
                                                           'images'), default='')
-    parser.add_argument('--api', type=str, choices=['devseed', 'planet', 'scihub'],
+    parser.add_argument('--api', type=str,
+                        choices=['devseed', 'planet', 'scihub', 'federated'],
                         default='devseed', help='search API')
     parser.add_argument('--parallel-downloads', type=int,
                         default=multiprocessing.cpu_count(),
                         help='max number of parallel crops downloads')
+    parser.add_argument('--incremental', action='store_true',
+                        help=('only download the images acquired since the '
+                              'last run'))
+    parser.add_argument('--lookback-days', type=int,
+                        default=manifest.LOOKBACK.days,
+                        help=('look-back window (days) of the incremental '
+                              'mode, for late-arriving products'))
+    parser.add_argument('--adaptive', action='store_true',
+                        help=('adjust the number of parallel downloads per '
+                              'host to what the servers sustain, up to '
+                              '--parallel-downloads'))
+    parser.add_argument('--stack', action='store_true',
+                        help=('crop all the bands in one pass and save them '
+                              'in a single multi-band file per image'))
     args = parser.parse_args()
 
     if args.geom and (args.lat or args.lon):
@@ -312,4 +612,7 @@ if __name__ == '__main__':
                                             args.height)
     get_time_series(aoi, start_date=args.start_date, end_date=args.end_date,
                     bands=args.band, out_dir=args.outdir, search_api=args.api,
-                    parallel_downloads=args.parallel_downloads)
+                    parallel_downloads=args.parallel_downloads,
+                    incremental=args.incremental,
+                    lookback=datetime.timedelta(days=args.lookback_days),
+                    stack=args.stack, adaptive=args.adaptive)
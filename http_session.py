@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Shared HTTP session used by all the TSD modules.
+
+A single requests.Session per process keeps connections alive, with one pool
+of connections per host. Thousands of small requests (searches, HEAD probes,
+metadata and cloud masks) thus reuse the same TCP and TLS connections. The
+session is recreated in child processes, since connections can't be shared
+across a fork.
+
+The pools sizes can be set with the TSD_HTTP_POOL_CONNECTIONS (number of
+hosts with a pool) and TSD_HTTP_POOL_MAXSIZE (connections kept per host)
+environment variables.
+
+Credentials can be registered per host with set_auth: they are then sent with
+all the requests to that host, including the range requests made on behalf of
+GDAL by the range cache.
+
+Requests failing with a connection error, a timeout or a 429/5xx status are
+retried with the policy of the retry module (backoff, budget and circuit
+breaker per host).
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+import os
+import threading
+import functools
+import collections
+import urllib.parse
+
+import retry
+import backends
+
+requests = backends.lazy_import('requests')
+
+
+# number of hosts with a connection pool, and connections kept per host
+POOL_CONNECTIONS = int(os.environ.get('TSD_HTTP_POOL_CONNECTIONS', 20))
+POOL_MAXSIZE = int(os.environ.get('TSD_HTTP_POOL_MAXSIZE', 100))
+
+# default timeout (s) of the requests
+TIMEOUT = 60
+
+# statuses of the responses worth a retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = {}
+_lock = threading.Lock()
+_auth = {}  # credentials per host
+
+# per host counters of the responses, used by the adaptive scheduler of
+# parallel.run_calls to detect throttling. 'bytes' are the announced sizes
+# (Content-Length) of the responses, 'read' the bytes actually read from the
+# bodies by the consumers that count them (see count_read).
+host_stats = collections.defaultdict(lambda: {'responses': 0, 'throttled': 0,
+                                              'bytes': 0, 'read': 0})
+
+
+def host(url):
+    """
+    Return the host (and port) of an url.
+    """
+    return urllib.parse.urlsplit(url).netloc
+
+
+def record_response(r, *args, **kwargs):
+    """
+    Response hook counting the responses, throttling answers (429 and 503)
+    and received bytes of each host.
+    """
+    with _lock:
+        s = host_stats[host(r.url)]
+        s['responses'] += 1
+        if r.status_code in (429, 503):
+            s['throttled'] += 1
+        s['bytes'] += int(r.headers.get('Content-Length', 0) or 0)
+
+
+def count_read(url, n):
+    """
+    Count bytes read from the body of a response of the host of an url.
+    """
+    with _lock:
+        host_stats[host(url)]['read'] += n
+
+
+def session():
+    """
+    Return the HTTP session of the current process, created on first use.
+
+    requests.Session objects can be used from several threads as long as
+    their configuration isn't modified: the connection pools are thread-safe.
+    """
+    pid = os.getpid()
+    s = _session.get(pid)
+    if s is None:
+        with _lock:
+            s = _session.get(pid)
+            if s is None:
+                s = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                                        pool_maxsize=POOL_MAXSIZE)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                s.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                  'Connection': 'keep-alive'})
+                s.hooks['response'].append(record_response)
+                _session.clear()  # sessions inherited from a parent process
+                _session[pid] = s
+    return s
+
+
+def set_auth(host_name, auth):
+    """
+    Register (login, password) credentials sent with the requests to a host.
+    """
+    _auth[host_name] = auth
+
+
+def request(method, url, retries=retry.RETRIES, **kwargs):
+    """
+    Send a request with the shared session.
+
+    Args:
+        method: HTTP method, eg 'GET'
+        url: url of the request
+        retries: max number of retries on connection errors, timeouts and
+            429/5xx statuses
+        kwargs: passed to requests.Session.request. The default timeout is
+            TIMEOUT seconds.
+
+    Returns:
+        requests.Response object. If all the attempts failed with a retryable
+        status, the last response is returned.
+
+    Raises:
+        requests.exceptions.RequestException if the last attempt raised it, or
+        if the circuit breaker of the host is open
+    """
+    kwargs.setdefault('timeout', TIMEOUT)
+    if kwargs.get('auth') is None and host(url) in _auth:
+        kwargs['auth'] = _auth[host(url)]
+
+    def is_failure(r):
+        if r.status_code in RETRY_STATUSES:
+            return 'HTTP {}'.format(r.status_code)
+
+    send = functools.partial(session().request, method, url, **kwargs)
+    r, reason = retry.call(send, host=host(url), retries=retries,
+                           is_failure=is_failure)
+    if r is None:
+        raise requests.exceptions.ConnectionError(reason)
+    return r
+
+
+def get(url, **kwargs):
+    """
+    Send a GET request with the shared session.
+    """
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    """
+    Send a HEAD request with the shared session.
+
+    As with requests.head, redirections are not followed by default.
+    """
+    kwargs.setdefault('allow_redirects', False)
+    return request('HEAD', url, **kwargs)
+
+
+def post(url, data=None, **kwargs):
+    """
+    Send a POST request with the shared session.
+    """
+    return request('POST', url, data=data, **kwargs)
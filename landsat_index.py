@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Persistent index of the AWS urls of Landsat-8 scenes.
+
+The AWS url of a pre-collection scene can't be derived from the metadata
+returned by the search APIs: the last digit of its scene ID has to be guessed
+by probing the candidate urls. The resolved urls are stored in an sqlite
+database, keyed on the scene ID without its last digit, so that each scene is
+resolved once. The index can also be bulk-loaded from the public AWS scene
+lists, so that no probe is needed at all. Urls found missing by the crops
+(eg scenes removed from the bucket) are forgotten, hence resolved again by
+the next run.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import os
+import io
+import csv
+import gzip
+import sqlite3
+import argparse
+import threading
+
+import backends
+import http_session
+
+requests = backends.lazy_import('requests')
+
+
+# the index can be disabled with TSD_LANDSAT_INDEX=0
+enabled = os.environ.get('TSD_LANDSAT_INDEX', '1') != '0'
+db_path = os.path.join(os.environ.get('TSD_CACHE_DIR',
+                                      os.path.join(os.path.expanduser('~'),
+                                                   '.cache', 'tsd')),
+                       'landsat', 'scene_urls.sqlite')
+
+# public lists of the Landsat-8 scenes available on AWS: pre-collection and
+# collection 1 scenes
+SCENE_LISTS = ['http://landsat-pds.s3.amazonaws.com/scene_list.gz',
+               'http://landsat-pds.s3.amazonaws.com/c1/L8/scene_list.gz']
+
+# number of rows inserted per transaction by bulk_load
+BATCH_SIZE = 10000
+
+_connections = {}
+_lock = threading.Lock()
+
+
+def connection():
+    """
+    Return the connection of the current process to the index, opened on
+    first use.
+
+    The connection is shared by the threads of the process, under _lock.
+    """
+    pid = os.getpid()
+    if pid not in _connections:
+        if not os.path.isdir(os.path.dirname(db_path)):
+            try:
+                os.makedirs(os.path.dirname(db_path))
+            except OSError:  # created by another process in the meantime
+                pass
+        c = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        c.execute('CREATE TABLE IF NOT EXISTS scenes (key TEXT PRIMARY KEY, '
+                  'url TEXT)')
+        c.commit()
+        _connections.clear()  # connections inherited from a parent process
+        _connections[pid] = c
+    return _connections[pid]
+
+
+def scene_key(scene_id):
+    """
+    Key of a scene in the index: its scene ID without the last digit.
+    """
+    return scene_id[:-1]
+
+
+def lookup(scene_id):
+    """
+    Return the url of a scene from the index, or None if it is missing.
+    """
+    if not enabled:
+        return
+    with _lock:
+        try:
+            row = connection().execute('SELECT url FROM scenes WHERE key = ?',
+                                       (scene_key(scene_id),)).fetchone()
+        except sqlite3.Error as e:
+            print('WARNING: landsat index lookup failed: {}'.format(e))
+            return
+    return row[0] if row else None
+
+
+def store(scene_id, url):
+    """
+    Record the url of a scene in the index.
+    """
+    if not enabled:
+        return
+    with _lock:
+        try:
+            c = connection()
+            c.execute('INSERT OR REPLACE INTO scenes VALUES (?, ?)',
+                      (scene_key(scene_id), url))
+            c.commit()
+        except sqlite3.Error as e:
+            print('WARNING: unable to update the landsat index: {}'.format(e))
+
+
+def forget(url):
+    """
+    Remove from the index the scenes with a given url, eg found missing.
+    """
+    if not enabled:
+        return
+    with _lock:
+        try:
+            c = connection()
+            c.execute('DELETE FROM scenes WHERE url = ?', (url,))
+            c.commit()
+        except sqlite3.Error as e:
+            print('WARNING: unable to update the landsat index: {}'.format(e))
+
+
+def url_from_scene_list_row(row):
+    """
+    Compute the index key and url of a scene from a row of an AWS scene list.
+
+    Args:
+        row: dict with the 'entityId' and 'download_url' fields, and the
+            'productId' field for collection 1 scenes
+
+    Returns:
+        key, url
+    """
+    base = row['download_url'].rsplit('/', 1)[0]  # strip index.html
+    name = row.get('productId') or row['entityId']
+    return scene_key(row['entityId']), '{}/{}'.format(base, name)
+
+
+def bulk_load(list_url, replace=True):
+    """
+    Load the urls of all the scenes of an AWS scene list in the index.
+
+    The gzipped csv list is streamed and inserted by batches.
+
+    Args:
+        list_url: url of the scene list, eg SCENE_LISTS[0]
+        replace: overwrite the urls already in the index
+
+    Returns:
+        number of scenes loaded
+    """
+    r = http_session.get(list_url, stream=True, timeout=600)
+    r.raise_for_status()
+    rows = csv.DictReader(io.TextIOWrapper(gzip.GzipFile(fileobj=r.raw)))
+    sql = 'INSERT OR {} INTO scenes VALUES (?, ?)'.format('REPLACE' if replace
+                                                          else 'IGNORE')
+    n = 0
+    batch = []
+    for row in rows:
+        batch.append(url_from_scene_list_row(row))
+        if len(batch) == BATCH_SIZE:
+            with _lock:
+                connection().executemany(sql, batch)
+                connection().commit()
+            n += len(batch)
+            batch = []
+    with _lock:
+        connection().executemany(sql, batch)
+        connection().commit()
+    return n + len(batch)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Load the AWS Landsat-8 scene '
+                                                  'lists in the scene urls index'))
+    parser.add_argument('lists', nargs='*', default=SCENE_LISTS,
+                        help='urls of the scene lists, default {}'.format(
+                            ' '.join(SCENE_LISTS)))
+    args = parser.parse_args()
+
+    # pre-collection urls, probed first by get_landsat, take precedence
+    for i, u in enumerate(args.lists):
+        print('{}: {} scenes'.format(u, bulk_load(u, replace=(i == 0))))
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Per output directory manifest of the downloaded time series.
+
+The manifest is a json file stored in the output directory. For each AOI
+downloaded in that directory, it keeps a watermark (the date up to which the
+time series is complete) and the list of acquisitions already processed. It
+is used by the incremental mode of the get_*.py scripts to search and fetch
+only the acquisitions that appeared since the last successful run.
+
+The manifest also records each completed crop (source url, crop window, file
+size, modification time and checksum). Interrupted runs are resumed by
+skipping the crops whose record matches the file on disk, which costs a stat
+call instead of opening the raster. The records are updated when the crops
+are finalized (metadata embedded, cloudy crops moved aside). Crops are written to a temporary file
+renamed on completion, so a partial file never has a crop file name. The
+crops records are appended, one json line each, to a log next to the
+manifest, which is merged in the manifest (compacted) each time the manifest
+is written, ie at the end of each run.
+
+The reasons of the failures of the last run (unavailable file, crop failed
+after all its retries...) are recorded per scene, for inspection.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import os
+import json
+import hashlib
+import datetime
+import tempfile
+import threading
+import uuid
+import dateutil.parser
+
+import utils
+import search_cache
+
+
+MANIFEST = '.tsd_manifest.json'
+CROPS_LOG = '.tsd_crops.jsonl'
+
+# products may be ingested by the archives a few days after their acquisition:
+# incremental searches start this long before the watermark
+LOOKBACK = datetime.timedelta(days=10)
+
+# serializes the read-modify-write cycles of the threads of a process
+_lock = threading.RLock()
+
+# parsed manifests, keyed on path, with the stat signature of the file
+_cache = {}
+
+# parsed crops logs, keyed on path, with the inode and parsed length of the
+# file: (inode, offset, records)
+_logs = {}
+
+
+def naive_datetime(d):
+    """
+    Convert a date, datetime or date string to a naive datetime.
+    """
+    if isinstance(d, str):
+        d = dateutil.parser.parse(d)
+    if not isinstance(d, datetime.datetime):
+        d = datetime.datetime.combine(d, datetime.time())
+    return d.replace(tzinfo=None)
+
+
+def aoi_key(aoi):
+    """
+    Identifier of an AOI in the manifest.
+    """
+    return hashlib.sha1(search_cache.normalize(aoi).encode()).hexdigest()
+
+
+def read(out_dir):
+    """
+    Read the manifest of an output directory.
+
+    The file is parsed again only if it changed since the last read.
+    """
+    p = os.path.join(out_dir, MANIFEST)
+    try:
+        s = os.stat(p)
+        sig = (s.st_ino, s.st_size, s.st_mtime_ns)
+        if p in _cache and _cache[p][0] == sig:
+            return _cache[p][1]
+        with open(p, 'r') as f:
+            d = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {'aois': {}, 'crops': {}, 'failures': {}}
+    d.setdefault('crops', {})
+    d.setdefault('failures', {})
+    _cache[p] = (sig, d)
+    return d
+
+
+def parse_crops_log(data):
+    """
+    Parse the complete lines of a crops log.
+
+    Returns:
+        dict of crops records keyed on file name, number of bytes parsed
+    """
+    end = data.rfind(b'\n') + 1  # the last line may be being written
+    crops = {}
+    for line in data[:end].splitlines():
+        try:
+            r = json.loads(line.decode())
+        except ValueError:
+            continue
+        crops[r.pop('name')] = r
+    return crops, end
+
+
+def read_crops_log(out_dir):
+    """
+    Read the crops records appended to the log of an output directory.
+
+    Only the lines appended since the last read are parsed.
+
+    Returns:
+        dict of crops records keyed on file name
+    """
+    p = os.path.join(out_dir, CROPS_LOG)
+    with _lock:
+        try:
+            s = os.stat(p)
+        except OSError:
+            _logs.pop(p, None)
+            return {}
+        ino, offset, crops = _logs.get(p, (None, 0, {}))
+        if ino != s.st_ino or s.st_size < offset:  # compacted meanwhile
+            offset, crops = 0, {}
+        if s.st_size > offset:
+            with open(p, 'rb') as f:
+                f.seek(offset)
+                new, n = parse_crops_log(f.read())
+            crops = dict(crops, **new)
+            offset += n
+        _logs[p] = (s.st_ino, offset, crops)
+        return crops
+
+
+def compact_crops_log(out_dir, d):
+    """
+    Move the crops records of the log of an output directory to a manifest.
+
+    The log is renamed before being read, so that the records appended
+    meanwhile by other processes go to a new log.
+    """
+    p = os.path.join(out_dir, CROPS_LOG)
+    tmp = '{}.{}.compact'.format(p, os.getpid())
+    try:
+        os.rename(p, tmp)
+    except OSError:  # no log
+        return
+    with open(tmp, 'rb') as f:
+        crops, _ = parse_crops_log(f.read() + b'\n')
+    d['crops'].update(crops)
+    os.remove(tmp)
+    _logs.pop(p, None)
+
+
+def write(out_dir, d):
+    """
+    Atomically write the manifest of an output directory, with the crops
+    records of its log.
+    """
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    compact_crops_log(out_dir, d)
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=out_dir or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(d, f, indent=2, sort_keys=True)
+    os.rename(tmp, os.path.join(out_dir, MANIFEST))
+
+
+def aoi_state(out_dir, aoi):
+    """
+    Return the watermark and processed acquisitions of an AOI.
+
+    Returns:
+        dict with keys 'watermark' (iso formatted date string or None) and
+        'acquisitions' (list of names of the processed acquisitions)
+    """
+    return read(out_dir)['aois'].get(aoi_key(aoi), {'watermark': None,
+                                                    'acquisitions': []})
+
+
+def incremental_start_date(out_dir, aoi, start_date=None, lookback=LOOKBACK):
+    """
+    Compute the start date of the search of an incremental run.
+
+    Args:
+        out_dir: path to the output directory
+        aoi: geojson.Polygon object
+        start_date: start date requested by the user, if any
+        lookback: datetime.timedelta, look-back window before the watermark
+
+    Returns:
+        datetime.datetime object, or start_date if there is no watermark
+    """
+    w = aoi_state(out_dir, aoi)['watermark']
+    if w is None:
+        return start_date
+    s = naive_datetime(w) - lookback
+    if start_date is not None:
+        s = max(s, naive_datetime(start_date))
+    return s
+
+
+def processed_acquisitions(out_dir, aoi):
+    """
+    Return the set of names of the acquisitions already processed for an AOI.
+    """
+    return set(aoi_state(out_dir, aoi)['acquisitions'])
+
+
+def update(out_dir, aoi, end_date=None, acquisitions=(), failed_dates=()):
+    """
+    Record a successful run in the manifest.
+
+    Args:
+        out_dir: path to the output directory
+        aoi: geojson.Polygon object
+        end_date: end date of the search, None means now
+        acquisitions: names of the acquisitions processed during the run
+        failed_dates: acquisition dates of the images that failed to download.
+            The watermark is kept before the earliest of them, so that they are
+            searched again in the next run.
+    """
+    with _lock:
+        d = read(out_dir)
+        k = aoi_key(aoi)
+        state = d['aois'].get(k, {'watermark': None, 'acquisitions': []})
+
+        w = naive_datetime(end_date or datetime.datetime.now())
+        if failed_dates:
+            w = min(w, min(naive_datetime(x) for x in failed_dates))
+        elif state['watermark'] is not None:  # never move the watermark backwards
+            w = max(w, naive_datetime(state['watermark']))
+        state['watermark'] = w.isoformat()
+        state['acquisitions'] = sorted(set(state['acquisitions']) | set(acquisitions))
+        d['aois'][k] = state
+        write(out_dir, d)
+
+
+def checksum(path):
+    """
+    Compute the sha256 checksum of a file.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def crop_source(url, window):
+    """
+    Canonical json value of the source url and window of a crop.
+    """
+    return json.loads(json.dumps(search_cache.normalize({'url': url,
+                                                         'window': window})))
+
+
+def crop_record(path):
+    """
+    Return the record of a crop file, from the crops log or the manifest.
+    """
+    d, name = os.path.dirname(path), os.path.basename(path)
+    r = read_crops_log(d).get(name)
+    if r is None:
+        r = read(d)['crops'].get(name)
+    return r
+
+
+def crop_path(path, r=None):
+    """
+    Return the current path of a crop file, which may have been moved since
+    it was recorded (eg set aside in a cloudy/ subdirectory).
+
+    Args:
+        path: path the crop was recorded at
+        r (optional): record of the crop, read from the manifest if not given
+    """
+    if r is None:
+        r = crop_record(path)
+    if r is None or 'moved_to' not in r:
+        return path
+    return os.path.join(os.path.dirname(path), r['moved_to'])
+
+
+def crop_is_complete(path, url=None, window=None):
+    """
+    Tell if a crop file is complete, with a single stat call.
+
+    The file is complete if it has a record in the manifest with the same
+    size and modification time, and if given, the same source url and window.
+    The file is looked for where it was last moved to, if it was.
+    """
+    r = crop_record(path)
+    if r is None:
+        return False
+    if url is not None and crop_source(url, window) != r['source']:
+        return False
+    try:
+        s = os.stat(crop_path(path, r))
+    except OSError:
+        return False
+    return s.st_size == r['size'] and s.st_mtime_ns == r['mtime_ns']
+
+
+def crop_is_intact(path):
+    """
+    Tell if a crop file still has the checksum recorded in the manifest.
+    """
+    r = crop_record(path)
+    try:
+        return r is not None and checksum(crop_path(path, r)) == r['sha256']
+    except (IOError, OSError):
+        return False
+
+
+def append_crop_record(path, r):
+    """
+    Append a crop record to the crops log of the directory of a crop.
+
+    The record is appended in a single write, hence records of concurrent
+    threads and processes don't interleave.
+    """
+    line = '{}\n'.format(json.dumps(r, sort_keys=True)).encode()
+    fd = os.open(os.path.join(os.path.dirname(path), CROPS_LOG),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def record_crop(path, url, window, details=None):
+    """
+    Record a completed crop in the crops log of its directory.
+
+    Args:
+        details (optional): json-serializable dict of details about the crop
+            (eg mirror used, timings), recorded with it
+    """
+    s = os.stat(path)
+    r = {'name': os.path.basename(path), 'source': crop_source(url, window),
+         'size': s.st_size, 'mtime_ns': s.st_mtime_ns, 'sha256': checksum(path)}
+    if details:
+        r['details'] = details
+    append_crop_record(path, r)
+
+
+def update_crop(path, moved_to=None):
+    """
+    Update the record of a crop file after it was edited (eg its metadata) or
+    moved, so that it stays complete. Unrecorded crops are ignored.
+
+    Args:
+        path: path the crop was recorded at
+        moved_to (optional): new path of the crop file
+    """
+    r = crop_record(path)
+    if r is None:
+        return
+    r = dict(r, name=os.path.basename(path))
+    if moved_to is not None:
+        r['moved_to'] = os.path.relpath(moved_to, os.path.dirname(path) or '.')
+    p = crop_path(path, r)
+    s = os.stat(p)
+    r.update(size=s.st_size, mtime_ns=s.st_mtime_ns, sha256=checksum(p))
+    append_crop_record(path, r)
+
+
+def run_crop(crop, outpath, inpath, *window):
+    """
+    Run a crop function unless the crop is already complete.
+
+    The crop is written to a temporary file, renamed and recorded in the
+    manifest once it is a valid image.
+
+    Args:
+        crop: function called as crop(outpath, inpath, *window), eg
+            utils.crop_with_gdal_translate. It returns None or a dict of
+            details recorded with the crop on success, a failure reason
+            string otherwise.
+        outpath: path to the output (cropped) image file
+        inpath: url of the input image, or list of urls
+        window: other arguments of the crop function (crop window...)
+
+    Returns:
+        None if the crop is complete, a failure reason string otherwise
+    """
+    return run_crop_with_source(crop, outpath, inpath, inpath, *window)
+
+
+def run_crop_with_source(crop, outpath, source, inpath, *window):
+    """
+    Run a crop function unless the crop is already complete, identifying its
+    source by a given value rather than by its input url.
+
+    This is used when the input can be read from several mirrors: the crop
+    stays complete whatever the mirror it was read from.
+
+    Args:
+        source: json-serializable identifier of the input image, eg a scene
+            and band name
+        crop, outpath, inpath, window: see run_crop
+    """
+    if crop_is_complete(outpath, source, window):
+        return
+    # the temporary file is created by the crop, hence with the permissions of
+    # the other output files (mkstemp files are private)
+    tmp = os.path.join(os.path.dirname(outpath),
+                       'tmp{}.tif'.format(uuid.uuid4().hex))
+    try:
+        out = crop(tmp, inpath, *window)
+        if out is not None and not isinstance(out, dict):
+            return out
+        if not (os.path.isfile(tmp) and os.path.getsize(tmp) > 0 and
+                utils.is_valid(tmp)):
+            return 'invalid output'
+        os.rename(tmp, outpath)
+        record_crop(outpath, source, window, out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def record_failures(out_dir, reasons):
+    """
+    Record the failure reasons of the scenes of a run in the manifest.
+
+    Args:
+        out_dir: path to the output directory
+        reasons: dict mapping scene names to failure reasons. Scenes mapped to
+            None succeeded: their previous failure is forgotten.
+    """
+    with _lock:
+        d = read(out_dir)
+        for name, reason in reasons.items():
+            if reason is None:
+                d['failures'].pop(name, None)
+            else:
+                d['failures'][name] = {'reason': reason,
+                                       'time': datetime.datetime.now().isoformat()}
+        write(out_dir, d)
+
+
+def print_failures(reasons):
+    """
+    Print a summary of the failure reasons of the scenes of a run.
+    """
+    failed = {k: v for k, v in reasons.items() if v is not None}
+    if failed:
+        print('{} scenes failed:'.format(len(failed)))
+        for name in sorted(failed):
+            print('    {}: {}'.format(name, failed[name]))
@@ -4,9 +4,22 @@
 from __future__ import print_function
 import os
 import sys
+import time
+import threading
+import collections
 import multiprocessing
 import multiprocessing.pool
 
+import http_session
+
+
+# parameters of the adaptive scheduler (pool_type='adaptive')
+AIMD_START = 4  # initial number of in-flight calls per host
+AIMD_LATENCY_FACTOR = 2  # no increase when latency exceeds this times its min
+AIMD_DECREASE = .5  # multiplicative decrease factor
+AIMD_THROUGHPUT_GAIN = .05  # min relative throughput gain of a higher limit
+AIMD_PLATEAU = 1.5  # limit growth allowed without throughput gain (factor)
+
 
 def show_progress(a):
     """
@@ -29,6 +42,199 @@ def show_progress(a):
     sys.stdout.flush()
 
 
+def task_host(args):
+    """
+    Return the host of the first url found in the arguments of a call.
+
+    Lists of urls (eg multi-band crops) are searched too. Calls without url
+    are all assigned to the '' host.
+    """
+    for a in args:
+        for x in (a if isinstance(a, (list, tuple)) else [a]):
+            if isinstance(x, str) and x.startswith(('http://', 'https://')):
+                return http_session.host(x)
+    return ''
+
+
+def aimd_state(maximum):
+    """
+    Initial state of the concurrency controller of a host.
+    """
+    return {'limit': float(min(AIMD_START, maximum)), 'max': maximum,
+            'latency': None, 'min_latency': None, 'last_decrease': 0,
+            'throttled': None, 'calls': 0, 'failures': 0, 'peak': 0,
+            'window': None, 'throughput': None, 'best_throughput': 0.,
+            'best_limit': None}
+
+
+def aimd_update(state, host, latency, ok):
+    """
+    Adjust the concurrency limit of a host after a call, AIMD-style.
+
+    The limit is halved on congestion (failed call, or 429/503 answers seen
+    by http_session since the last update), at most once per call latency.
+    Otherwise it grows by one per window of calls, as long as the latency
+    stays close to its minimum.
+
+    The throughput of the host is measured over windows of as many calls as
+    the limit, from the bytes read from the host. The limit giving the best
+    throughput is kept: when the limit grew past it by AIMD_PLATEAU without
+    throughput gain, or when the throughput drops, more concurrency doesn't
+    pay and the limit falls back to it.
+    """
+    s = state
+    s['calls'] += 1
+    s['latency'] = latency if s['latency'] is None else .8 * s['latency'] + .2 * latency
+    s['min_latency'] = latency if s['min_latency'] is None else min(s['min_latency'], latency)
+    throttled = http_session.host_stats[host]['throttled']
+    congestion = not ok or (s['throttled'] is not None and throttled > s['throttled'])
+    s['throttled'] = throttled
+    if not ok:
+        s['failures'] += 1
+
+    now = time.time()
+    if congestion:
+        if now - s['last_decrease'] > s['latency']:
+            s['limit'] = max(1., s['limit'] * AIMD_DECREASE)
+            s['last_decrease'] = now
+    elif s['latency'] <= AIMD_LATENCY_FACTOR * s['min_latency']:
+        s['limit'] = min(float(s['max']), s['limit'] + 1. / s['limit'])
+
+    # throughput of the last window of calls
+    read = http_session.host_stats[host]['read']
+    if s['window'] is None:
+        s['window'] = (now - latency, read, s['calls'] - 1)
+    t, r, c = s['window']
+    if s['calls'] - c < s['limit'] or now <= t:
+        return
+    s['window'] = (now, read, s['calls'])
+    s['throughput'] = (read - r) / (now - t)
+    if s['throughput'] > (1 + AIMD_THROUGHPUT_GAIN) * s['best_throughput']:
+        s['best_throughput'], s['best_limit'] = s['throughput'], s['limit']
+    elif s['best_limit'] is not None and (
+            s['limit'] >= AIMD_PLATEAU * s['best_limit'] or
+            s['throughput'] < (1 - AIMD_THROUGHPUT_GAIN) * s['best_throughput']):
+        s['limit'] = min(s['limit'], s['best_limit'])
+        s['best_throughput'] = s['throughput']  # measured again from there
+
+
+def run_calls_adaptive(fun, list_of_args, extra_args=(), nb_workers=100,
+                       timeout=60, verbose=True):
+    """
+    Run a function several times in parallel, with an adaptive concurrency per
+    host.
+
+    The calls are grouped by the host of their url. Each host has its own
+    limit of in-flight calls, adjusted AIMD-style from the calls latency,
+    failures and throughput, and from the 429/503 answers received from the
+    host. Calls that
+    raise an exception or return a value other than None (eg the failure
+    reason of a crop) are failures. The settled limits are printed at the end
+    and stored in run_calls_adaptive.concurrency.
+
+    Each call runs in its own thread. A call exceeding the timeout frees its
+    slot at once, as a failure with output 'timeout', but its thread can't be
+    interrupted: the function returns once all the timed out calls are over,
+    so that none of them is still writing files, and their late outputs are
+    dropped.
+
+    Args: see run_calls. nb_workers is the max total number of in-flight calls.
+
+    Return:
+        list of outputs
+    """
+    queues = collections.OrderedDict()
+    for i, x in enumerate(list_of_args):
+        args = (x if type(x) == tuple else (x,)) + extra_args
+        queues.setdefault(task_host(args), collections.deque()).append((i, args))
+    states = {h: aimd_state(nb_workers) for h in queues}
+    inflight = {h: {} for h in queues}  # call index -> start time, or None
+    outputs = [None] * len(list_of_args)
+    bytes0 = {h: http_session.host_stats[h]['bytes'] for h in queues}
+    t0 = time.time()
+    cond = threading.Condition()
+    if verbose:
+        show_progress.counter = 0
+        show_progress.total = len(list_of_args)
+
+    def call(h, i, args):
+        with cond:
+            if i in inflight[h]:
+                inflight[h][i] = time.time()
+        try:
+            out = fun(*args)
+            ok = out is None
+        except Exception as e:
+            print('WARNING: call {} failed: {}'.format(i, e), file=sys.stderr)
+            out, ok = None, False
+        with cond:
+            if i in inflight[h]:  # not already counted as timed out
+                outputs[i] = out
+                start = inflight[h].pop(i)
+                aimd_update(states[h], h, time.time() - start, ok)
+                if verbose:
+                    show_progress(None)
+            cond.notify()
+
+    threads = []
+    try:
+        with cond:
+            while any(queues.values()) or any(inflight.values()):
+                # calls that exceed the timeout free their slot, as failures
+                now = time.time()
+                for h in queues:
+                    for i, start in list(inflight[h].items()):
+                        if start is not None and now - start > timeout:
+                            print("Timeout while running call {}".format(i),
+                                  file=sys.stderr)
+                            del inflight[h][i]
+                            outputs[i] = 'timeout'
+                            aimd_update(states[h], h, now - start, False)
+                            if verbose:
+                                show_progress(None)
+
+                # start calls while the limits allow it
+                total = sum(len(x) for x in inflight.values())
+                for h, q in queues.items():
+                    while (q and len(inflight[h]) < int(states[h]['limit']) and
+                           total < nb_workers):
+                        i, args = q.popleft()
+                        inflight[h][i] = None
+                        total += 1
+                        states[h]['peak'] = max(states[h]['peak'], len(inflight[h]))
+                        t = threading.Thread(target=call, args=(h, i, args))
+                        t.daemon = True
+                        t.start()
+                        threads.append(t)
+                cond.wait(.1)
+
+        # wait for the timed out calls
+        late = [t for t in threads if t.is_alive()]
+        if late:
+            print('waiting for {} timed out calls to finish...'.format(len(late)),
+                  file=sys.stderr)
+        for t in late:
+            t.join()
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    # report the settled concurrency of each host
+    dt = time.time() - t0
+    run_calls_adaptive.concurrency = {}
+    for h, s in states.items():
+        rate = (http_session.host_stats[h]['bytes'] - bytes0[h]) / dt / 1e6
+        run_calls_adaptive.concurrency[h] = int(s['limit'])
+        if verbose:
+            print('{}: settled on {} concurrent calls (peak {}, {} failures, '
+                  'latency {:.2f} s, {:.1f} MB/s)'.format(h or 'local',
+                                                               int(s['limit']),
+                                                               s['peak'],
+                                                               s['failures'],
+                                                               s['latency'] or 0,
+                                                               rate))
+    return outputs
+
+
 def run_calls(fun, list_of_args, extra_args=(), pool_type='processes',
               nb_workers=multiprocessing.cpu_count(), timeout=60, verbose=True,
               initializer=None, initargs=None):
@@ -41,8 +247,11 @@ def run_calls(fun, list_of_args, extra_args=(), pool_type='processes',
             per call
         extra_args: tuple containing extra arguments to be passed to fun
             (same value for all calls)
-        pool_type: either 'processes' or 'threads'
-        nb_workers: number of calls run simultaneously
+        pool_type: either 'processes', 'threads' or 'adaptive'. The
+            'adaptive' pool uses threads, with a number of simultaneous calls
+            per host adjusted on the fly (see run_calls_adaptive).
+        nb_workers: number of calls run simultaneously (max number for the
+            'adaptive' pool)
         timeout: number of seconds allowed per function call
         verbose: either True (show the amount of computed calls) or False
         initializer, initargs (optional): if initializer is not None then each
@@ -51,7 +260,10 @@ def run_calls(fun, list_of_args, extra_args=(), pool_type='processes',
     Return:
         list of outputs
     """
-    if pool_type == 'processes':
+    if pool_type == 'adaptive':
+        return run_calls_adaptive(fun, list_of_args, extra_args, nb_workers,
+                                  timeout, verbose)
+    elif pool_type == 'processes':
         pool = multiprocessing.Pool(nb_workers, initializer, initargs)
     elif pool_type == 'threads':
         pool = multiprocessing.pool.ThreadPool(nb_workers)
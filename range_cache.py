@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Persistent on-disk cache of byte ranges of remote rasters.
+
+Remote files are read by fixed-size blocks, stored in files keyed on the file
+url, its ETag and the block offset. A block is thus downloaded only once, even
+by overlapping crops made by different runs, and is invalidated when the
+remote file changes. The least recently used blocks are evicted when the cache
+grows beyond a maximal size. The size of the cache on disk is measured on the
+first write of each process, then every EVICTION_INTERVAL seconds, and kept up
+to date in between with the bytes written by the process.
+
+GDAL reads the remote rasters through a small HTTP server, started in a
+daemon thread on first use, which answers the range requests of /vsicurl/
+from the cache. The urls given to GDAL (in-process or gdal_translate
+subprocesses) are rewritten with local_url, and carry a random token
+generated on server start.
+
+Files are written to a temporary file then renamed, hence the cache can be
+used by many processes at once.
+
+RemoteFile exposes a remote file as a read-only, seekable python file object
+reading through the cache, eg to list the content of a remote zip archive.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import io
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+import socketserver
+import http.server
+import urllib.parse
+
+import backends
+import download
+import http_session
+
+requests = backends.lazy_import('requests')
+
+
+# the cache can be disabled with TSD_RANGE_CACHE=0
+enabled = os.environ.get('TSD_RANGE_CACHE', '1') != '0'
+cache_dir = os.path.join(os.environ.get('TSD_CACHE_DIR',
+                                        os.path.join(os.path.expanduser('~'),
+                                                     '.cache', 'tsd')),
+                         'ranges')
+
+# size (bytes) of the cached blocks
+BLOCK_SIZE = 256 * 1024
+
+# max total size (bytes) of the cache
+MAX_SIZE = int(os.environ.get('TSD_RANGE_CACHE_MAX_SIZE', 5 * 1024**3))
+
+# time (s) during which the size and ETag of a remote file are trusted
+INFO_TTL = 24 * 3600
+
+# max delay (s) between two measures of the size of the cache on disk, to
+# account for the blocks written by other processes
+EVICTION_INTERVAL = 600
+
+# estimated size (bytes) of the cache on disk, None before the first measure,
+# and time of the last measure. Avoids walking the cache at each write.
+_usage = {'bytes': None, 'time': 0}
+_info = {}  # in-memory copy of the remote files info
+_lock = threading.Lock()
+
+
+def url_hash(url):
+    """
+    Identifier of a remote file in the cache.
+    """
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def atomic_write(path, data):
+    """
+    Write bytes in a file through a temporary file and a rename.
+    """
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+    except OSError:  # created by another process in the meantime
+        pass
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        print('WARNING: unable to write the range cache file {}: {}'.format(path, e),
+              file=sys.stderr)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    with _lock:
+        scan = (_usage['bytes'] is None or _usage['bytes'] + len(data) > MAX_SIZE
+                or time.time() - _usage['time'] > EVICTION_INTERVAL)
+        if scan:  # don't let the other threads start another scan meanwhile
+            _usage['bytes'] = 0
+            _usage['time'] = time.time()
+        else:
+            _usage['bytes'] += len(data)
+    if scan:
+        total = evict()
+        with _lock:
+            _usage['bytes'] += total
+
+
+def remote_info(url, refresh=False):
+    """
+    Get the size and ETag of a remote file.
+
+    They are read with the one byte range request of download.probe, since
+    some servers (eg the SciHub OData API) don't answer HEAD requests
+    properly.
+
+    Returns:
+        dict with keys 'size' and 'etag', or None if the file is not available
+    """
+    p = os.path.join(cache_dir, 'info', '{}.json'.format(url_hash(url)))
+    if not refresh:
+        d = _info.get(url)
+        if d is None:
+            try:
+                with open(p, 'r') as f:
+                    d = json.load(f)
+            except (IOError, OSError, ValueError):
+                d = None
+        if d is not None and d['time'] > time.time() - INFO_TTL:
+            _info[url] = d
+            return d
+
+    d = download.probe(url)
+    if d is None or d['size'] is None:
+        return None
+    d = {'size': d['size'], 'etag': d['etag'], 'time': time.time()}
+    _info[url] = d
+    atomic_write(p, json.dumps(d).encode())
+    return d
+
+
+def block_path(url, etag, i):
+    """
+    Path to the cache file of the i-th block of a remote file.
+    """
+    h = hashlib.sha256('{} {}'.format(url, etag).encode()).hexdigest()
+    return os.path.join(cache_dir, 'blocks', h[:2], h,
+                        '{}'.format(i * BLOCK_SIZE))
+
+
+def load_block(path):
+    """
+    Read a cached block.
+
+    Returns:
+        bytes, or None if the block is not in the cache
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):  # missing, or evicted by another process
+        return None
+    try:
+        os.utime(path, None)  # mark as recently used
+    except OSError:
+        pass
+    return data
+
+
+def fetch_blocks(url, info, first, last):
+    """
+    Download a run of consecutive blocks in one request and cache them.
+
+    Servers ignoring the range request and answering with the whole file are
+    handled by streaming the body up to the end of the range only, then
+    closing the connection.
+
+    Returns:
+        list of bytes, one per block, or None if the request failed
+    """
+    start = first * BLOCK_SIZE
+    end = min((last + 1) * BLOCK_SIZE, info['size']) - 1
+    try:
+        r = http_session.get(url, headers={'Range': 'bytes={}-{}'.format(start, end)},
+                             stream=True, timeout=120)
+        if r.status_code == 206:
+            data = r.content
+            http_session.count_read(url, len(data))
+        elif r.status_code == 200:  # range ignored: the body is the whole file
+            chunks = []
+            n = 0
+            for chunk in r.iter_content(BLOCK_SIZE):
+                chunks.append(chunk)
+                n += len(chunk)
+                if n > end:
+                    break
+            r.close()
+            data = b''.join(chunks)
+            http_session.count_read(url, len(data))
+            data = data[start:end + 1]
+        else:
+            r.close()
+            print('WARNING: range request on {} returned {}'.format(url,
+                                                                   r.status_code),
+                  file=sys.stderr)
+            return None
+    except requests.exceptions.RequestException as e:
+        print('WARNING: range request on {} failed: {}'.format(url, e),
+              file=sys.stderr)
+        return None
+    blocks = [data[k:k + BLOCK_SIZE] for k in range(0, len(data), BLOCK_SIZE)]
+
+    # don't cache the blocks of a file modified since its ETag was read
+    etag = r.headers.get('ETag', r.headers.get('Last-Modified', ''))
+    if etag == info['etag']:
+        for i, b in enumerate(blocks, start=first):
+            atomic_write(block_path(url, info['etag'], i), b)
+    else:
+        remote_info(url, refresh=True)
+    return blocks
+
+
+def read(url, start, end):
+    """
+    Read a byte range of a remote file through the cache.
+
+    Args:
+        url: url of the remote file
+        start, end: first and last (included) bytes of the range
+
+    Returns:
+        bytes, or None if the file is not available
+    """
+    info = remote_info(url)
+    if info is None:
+        return None
+    end = min(end, info['size'] - 1)
+    first, last = start // BLOCK_SIZE, end // BLOCK_SIZE
+
+    blocks = {}
+    missing = []
+    for i in range(first, last + 1):
+        b = load_block(block_path(url, info['etag'], i))
+        if b is None:
+            missing.append(i)
+        else:
+            blocks[i] = b
+
+    # download the missing blocks, one request per run of consecutive blocks
+    runs = []
+    for i in missing:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    for a, b in runs:
+        x = fetch_blocks(url, info, a, b)
+        if x is None:
+            return None
+        blocks.update(zip(range(a, b + 1), x))
+
+    data = b''.join(blocks[i] for i in range(first, last + 1))
+    return data[start - first * BLOCK_SIZE:end + 1 - first * BLOCK_SIZE]
+
+
+def evict(max_size=MAX_SIZE):
+    """
+    Remove the least recently used blocks until the cache fits max_size.
+
+    Returns:
+        total size (bytes) of the remaining blocks
+    """
+    files = []
+    for root, _, names in os.walk(os.path.join(cache_dir, 'blocks')):
+        for n in names:
+            p = os.path.join(root, n)
+            try:
+                s = os.stat(p)
+            except OSError:  # removed by another process
+                continue
+            if not n.endswith('.tmp'):
+                files.append((s.st_mtime, s.st_size, p))
+            elif s.st_mtime < time.time() - 3600:  # leftover temporary file
+                files.append((0, s.st_size, p))
+
+    total = sum(f[1] for f in files)
+    for _, size, p in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+def clear():
+    """
+    Remove all the cached blocks.
+    """
+    evict(max_size=0)
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only seekable file object on a remote file, read through the cache.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.info = remote_info(url)
+        if self.info is None:
+            raise IOError('{} is not available'.format(url))
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.info['size'] + offset
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.info['size'] or not len(b):
+            return 0
+        data = read(self.url, self.pos, self.pos + len(b) - 1)
+        if data is None:
+            raise IOError('range request on {} failed'.format(self.url))
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answer the HEAD and range GET requests of GDAL from the cache.
+
+    The requested path is the server token followed by the quoted url of the
+    remote file, without its query string, which is passed quoted as the query
+    of the request. Requests without the token are refused, so that other
+    local processes can't use the credentials of the remote requests.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive connections
+
+    def remote_url(self):
+        """
+        Remote url of the request, or None if the token is wrong.
+        """
+        path, _, query = self.path.partition('?')
+        token, _, path = path.lstrip('/').partition('/')
+        if token != _server['token']:
+            return None
+        url = urllib.parse.unquote(path)
+        if query:
+            url += '?' + urllib.parse.unquote(query)
+        return url
+
+    def send_headers(self, code, length, extra={}):
+        self.send_response(code)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        for k, v in extra.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def do_HEAD(self):
+        url = self.remote_url()
+        if url is None:
+            self.send_headers(403, 0)
+            return
+        info = remote_info(url)
+        if info is None:
+            self.send_headers(404, 0)
+        else:
+            self.send_headers(200, info['size'], {'ETag': info['etag']})
+
+    def do_GET(self):
+        url = self.remote_url()
+        if url is None:
+            self.send_headers(403, 0)
+            return
+        info = remote_info(url)
+        if info is None:
+            self.send_headers(404, 0)
+            return
+
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else info['size'] - 1
+        else:
+            start, end = 0, info['size'] - 1
+        end = min(end, info['size'] - 1)
+        if start > end:
+            self.send_headers(416, 0, {'Content-Range':
+                                       'bytes */{}'.format(info['size'])})
+            return
+
+        data = read(url, start, end)
+        if data is None:
+            self.send_headers(502, 0)
+            return
+        if m:
+            self.send_headers(206, len(data), {
+                'Content-Range': 'bytes {}-{}/{}'.format(start, end, info['size'])})
+        else:
+            self.send_headers(200, len(data))
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+_server = {}
+
+
+def server_address():
+    """
+    Start the local cache server if needed, and return its base url, made of
+    its address and its access token.
+    """
+    with _lock:
+        if 'address' not in _server:
+            _server['token'] = uuid.uuid4().hex
+            s = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+            t = threading.Thread(target=s.serve_forever)
+            t.daemon = True
+            t.start()
+            _server['address'] = 'http://127.0.0.1:{}/{}'.format(s.server_address[1],
+                                                                 _server['token'])
+    return _server['address']
+
+
+def local_url(url):
+    """
+    Rewrite the url of a remote file to read it through the cache.
+
+    The returned url ends with the same file extension as the input url, as
+    needed by CPL_VSIL_CURL_ALLOWED_EXTENSIONS. Urls are returned unchanged if
+    the cache is disabled.
+    """
+    if not enabled or not url.startswith(('http://', 'https://')):
+        return url
+    base, _, query = url.partition('?')
+    out = '{}/{}'.format(server_address(), urllib.parse.quote(base, safe=''))
+    if query:
+        out += '?' + urllib.parse.quote(query, safe='')
+    return out
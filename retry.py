@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Retry policy shared by the HTTP requests and the crops.
+
+Failed calls are retried with an exponential backoff with full jitter. Each
+host has a retry budget, so that a failing host doesn't multiply the load by
+the number of retries: retries consume tokens, which are earned back by
+successful calls. Each host also has a circuit breaker, opened after several
+consecutive failures: calls to the host then fail immediately until a cooldown
+has elapsed, after which a single trial call is let through.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import sys
+import time
+import random
+import threading
+
+
+# max number of retries of a call
+RETRIES = 4
+
+# backoff delays (s): random in [0, min(MAX_BACKOFF, BACKOFF * 2^attempt)]
+BACKOFF = 1.
+MAX_BACKOFF = 30.
+
+# retry budget of each host: initial (and max) number of tokens, and tokens
+# earned back by each successful call
+BUDGET = 20.
+BUDGET_RATIO = .2
+
+# consecutive failures opening the circuit breaker of a host, and cooldown (s)
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 30.
+
+_hosts = {}
+_lock = threading.Lock()
+
+
+def host_state(host):
+    """
+    Return the retry budget and circuit breaker state of a host.
+
+    The 'trial' entry is the id of the thread making the trial call of the
+    half-open breaker, or False.
+    """
+    if host not in _hosts:
+        _hosts[host] = {'tokens': BUDGET, 'failures': 0, 'opened': None,
+                        'trial': False}
+    return _hosts[host]
+
+
+def backoff_delay(attempt):
+    """
+    Delay (s) before a retry, exponential with full jitter.
+    """
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+
+
+def circuit_is_open(host):
+    """
+    Tell if the calls to a host must fail without being tried.
+
+    After the cooldown, a single trial call is allowed (half-open breaker).
+    """
+    with _lock:
+        s = host_state(host)
+        if s['opened'] is None:
+            return False
+        if time.time() - s['opened'] < BREAKER_COOLDOWN or s['trial']:
+            return True
+        s['trial'] = threading.current_thread().ident
+        return False
+
+
+def end_trial(host):
+    """
+    Release the trial call of the half-open breaker of a host, if the calling
+    thread holds it, whatever the outcome of the call.
+    """
+    with _lock:
+        s = host_state(host)
+        if s['trial'] == threading.current_thread().ident:
+            s['trial'] = False
+
+
+def record_success(host):
+    """
+    Close the circuit breaker of a host and refill its retry budget.
+    """
+    with _lock:
+        s = host_state(host)
+        s['failures'] = 0
+        s['opened'] = None
+        s['trial'] = False
+        s['tokens'] = min(BUDGET, s['tokens'] + BUDGET_RATIO)
+
+
+def record_failure(host):
+    """
+    Count a failed call to a host, and open its circuit breaker if needed.
+    """
+    with _lock:
+        s = host_state(host)
+        s['failures'] += 1
+        if s['trial'] or s['failures'] >= BREAKER_FAILURES:
+            if s['opened'] is None or s['trial']:
+                print('WARNING: too many failures on {}, pausing requests for '
+                      '{} s'.format(host or 'local', BREAKER_COOLDOWN),
+                      file=sys.stderr)
+            s['opened'] = time.time()
+            s['trial'] = False
+
+
+def spend_retry(host):
+    """
+    Take a token from the retry budget of a host.
+
+    Returns:
+        True if a retry is allowed, False if the budget is exhausted
+    """
+    with _lock:
+        s = host_state(host)
+        if s['tokens'] < 1:
+            return False
+        s['tokens'] -= 1
+        return True
+
+
+def call(fun, args=(), host='', retries=RETRIES, is_failure=None,
+         permanent=None):
+    """
+    Call a function, retrying it on failure.
+
+    Args:
+        fun: function to call as fun(*args)
+        args: tuple of arguments
+        host: host contacted by the function, for its budget and breaker
+        retries: max number of retries
+        is_failure (optional): function telling, from the output of fun, if
+            the call failed and should be retried. It returns a failure reason
+            string, or None. Exceptions raised by fun are failures too.
+        permanent (optional): function telling, from a failure reason, if the
+            failure is permanent (eg missing file), hence not worth a retry
+
+    Returns:
+        output of the last call of fun, and failure reason (None on success)
+
+    Raises:
+        the exception raised by the last call of fun, if any
+    """
+    attempt = 0
+    try:
+        while True:
+            if circuit_is_open(host):
+                return None, 'circuit breaker open for {}'.format(host or 'local')
+            try:
+                out = fun(*args)
+                reason = is_failure(out) if is_failure is not None else None
+                error = None
+            except Exception as e:
+                out, reason, error = None, str(e), e
+
+            if reason is None:
+                record_success(host)
+                return out, None
+            if permanent is not None and permanent(reason):
+                return out, reason
+            record_failure(host)
+            if attempt >= retries or not spend_retry(host):
+                if error is not None:
+                    raise error
+                return out, reason
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+    finally:
+        end_trial(host)  # eg after a permanent failure
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Compiled and memory-mapped spatial index of the Sentinel-2 MGRS tiling grid.
+
+The text file s2_mgrs_grid.txt lists the lon/lat bounding box of each MGRS
+tile. Parsing it takes seconds, thus it is compiled once into a few numpy .npy
+files stored next to it (packed tiles identifiers, float bounding boxes and a
+bucketed spatial index on a regular lon/lat grid). These files are then
+memory-mapped and cached per process, so that a tile lookup only reads the
+handful of tiles registered in the bucket of the queried point.
+
+The true tiles footprints, compiled from the ESA kml file with
+extract_mgrs_tile_coordinates_from_kml.py, are stored in the same binary
+format under the s2_mgrs_footprints prefix. When available, they are used
+instead of the bounding boxes, which over-match near the poles.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import os
+import tempfile
+import threading
+import collections
+import numpy as np
+import shapely
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+s2_mgrs_grid_txt = os.path.join(here, 's2_mgrs_grid.txt')
+s2_mgrs_footprints = os.path.join(here, 's2_mgrs_footprints')
+
+# size, in degrees, of the cells of the bucketed spatial index
+CELL_SIZE = 1
+NB_LON_CELLS = 360 // CELL_SIZE
+NB_LAT_CELLS = 180 // CELL_SIZE
+
+# arrays of a compiled grid. Tiles crossing the antimeridian are split in
+# several parts, hence the same identifier may appear more than once.
+#   ids: packed MGRS identifiers (5 bytes each)
+#   bbx: lon_min, lon_max, lat_min, lat_max of each tile
+#   vertices, vertex_offsets: lon, lat vertices of the footprint of the tile t
+#       are vertices[vertex_offsets[t]:vertex_offsets[t+1]]
+#   cell_offsets, cell_tiles: indices of the tiles intersecting the cell c are
+#       cell_tiles[cell_offsets[c]:cell_offsets[c+1]]
+Grid = collections.namedtuple('Grid', ['ids', 'bbx', 'vertices',
+                                       'vertex_offsets', 'cell_offsets',
+                                       'cell_tiles'])
+
+_grids = {}  # per process cache of loaded grids, indexed by grid path
+_lock = threading.Lock()
+
+# permissions of the created files, as they would be without mkstemp
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+
+def compiled_grid_paths(grid):
+    """
+    Return the paths to the .npy files of the compiled version of a grid.
+
+    Args:
+        grid: path to a text grid, or prefix of a compiled grid
+    """
+    prefix = os.path.splitext(grid)[0]
+    return {k: '{}.{}.npy'.format(prefix, k) for k in Grid._fields}
+
+
+def cell_coordinates(lon, lat):
+    """
+    Compute the column and row of the index cells containing lon, lat points.
+    """
+    i = np.floor((np.asarray(lon, dtype=float) + 180) / CELL_SIZE).astype(np.int64)
+    j = np.floor((np.asarray(lat, dtype=float) + 90) / CELL_SIZE).astype(np.int64)
+    return np.clip(i, 0, NB_LON_CELLS - 1), np.clip(j, 0, NB_LAT_CELLS - 1)
+
+
+def ragged_arange(starts, counts):
+    """
+    Concatenate the ranges [starts[k], starts[k] + counts[k]) for all k.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    offsets = np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts,
+                                                                  counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64), counts) + offsets
+
+
+def build_index(bbx):
+    """
+    Build the bucketed spatial index of a list of lon/lat bounding boxes.
+
+    Args:
+        bbx: numpy array of shape (n, 4) with lon_min, lon_max, lat_min, lat_max
+
+    Returns:
+        cell_offsets, cell_tiles: numpy arrays such that the boxes intersecting
+        the cell c are cell_tiles[cell_offsets[c]:cell_offsets[c+1]]
+    """
+    i0, j0 = cell_coordinates(bbx[:, 0], bbx[:, 2])
+    i1, j1 = cell_coordinates(bbx[:, 1], bbx[:, 3])
+    ni = i1 - i0 + 1
+    nj = j1 - j0 + 1
+
+    # list all the (tile, cell) pairs
+    tiles = np.repeat(np.arange(len(bbx)), ni * nj)
+    k = ragged_arange(np.zeros(len(bbx)), ni * nj)
+    cells = (j0[tiles] + k // ni[tiles]) * NB_LON_CELLS + i0[tiles] + k % ni[tiles]
+
+    # sort them by cell
+    order = np.argsort(cells, kind='mergesort')
+    counts = np.bincount(cells, minlength=NB_LON_CELLS * NB_LAT_CELLS)
+    cell_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return cell_offsets, tiles[order].astype(np.int32)
+
+
+def save_array(path, a):
+    """
+    Atomically write a numpy array to a .npy file.
+    """
+    fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, a)
+        os.chmod(tmp, FILE_MODE)  # mkstemp files are private
+        os.rename(tmp, path)  # atomic on posix: concurrent readers are safe
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def build_grid(ids, rings):
+    """
+    Build a tiling grid from a list of tiles footprints.
+
+    Args:
+        ids: list of MGRS identifiers
+        rings: list of numpy arrays of shape (k, 2), one per tile, containing
+            the lon, lat vertices of the tiles footprints
+
+    Returns:
+        Grid namedtuple with in-memory arrays
+    """
+    vertex_offsets = np.concatenate([[0], np.cumsum([len(r) for r in rings])])
+    vertices = np.concatenate(rings).astype(np.float64)
+    bbx = np.array([[r[:, 0].min(), r[:, 0].max(), r[:, 1].min(), r[:, 1].max()]
+                    for r in rings])
+    cell_offsets, cell_tiles = build_index(bbx)
+    return Grid(ids=np.array(ids, dtype='S5'), bbx=bbx, vertices=vertices,
+                vertex_offsets=vertex_offsets.astype(np.int64),
+                cell_offsets=cell_offsets, cell_tiles=cell_tiles)
+
+
+def save_grid(g, grid):
+    """
+    Write a tiling grid in its memory-mappable binary form.
+
+    Args:
+        g: Grid namedtuple
+        grid: path to a text grid, or prefix of a compiled grid
+    """
+    paths = compiled_grid_paths(grid)
+    for k in Grid._fields:
+        save_array(paths[k], getattr(g, k))
+
+
+def compile_grid(grid=s2_mgrs_grid_txt):
+    """
+    Compile a text tiling grid into its memory-mappable binary form.
+
+    The footprint of each tile is its bounding box.
+
+    Args:
+        grid: path to a text file with one line per tile, containing the MGRS
+            identifier and the lon_min, lon_max, lat_min, lat_max bounding box
+
+    Returns:
+        Grid namedtuple with in-memory arrays
+    """
+    a = np.loadtxt(grid, dtype=[('id', 'S5'), ('bbx', 'f8', 4)])
+    b = a['bbx']
+    rings = np.stack([b[:, [0, 2]], b[:, [0, 3]], b[:, [1, 3]], b[:, [1, 2]],
+                      b[:, [0, 2]]], axis=1)
+    g = build_grid(a['id'], list(rings))
+
+    try:
+        save_grid(g, grid)
+    except (IOError, OSError) as e:
+        print('WARNING: unable to save the compiled tiling grid:', e)
+    return g
+
+
+def is_compiled(grid):
+    """
+    Tell if a grid has an up-to-date compiled binary version.
+    """
+    paths = compiled_grid_paths(grid).values()
+    if not all(os.path.isfile(p) for p in paths):
+        return False
+    if not os.path.isfile(grid):  # only the compiled version is available
+        return True
+    return min(os.path.getmtime(p) for p in paths) >= os.path.getmtime(grid)
+
+
+# use the exact tiles footprints when they have been compiled
+if is_compiled(s2_mgrs_footprints):
+    s2_mgrs_grid = s2_mgrs_footprints
+else:
+    s2_mgrs_grid = s2_mgrs_grid_txt
+
+
+def load(grid=s2_mgrs_grid):
+    """
+    Load a tiling grid, compiling it first if needed.
+
+    Args:
+        grid: path to a text grid, or prefix of a compiled grid
+
+    The grid arrays are memory-mapped and cached, hence only the first call in
+    a process touches the filesystem. If the compiled grid can't be read (eg
+    files of another user), the text grid is compiled in memory instead.
+
+    Returns:
+        Grid namedtuple
+    """
+    g = _grids.get(grid)
+    if g is None:
+        with _lock:
+            g = _grids.get(grid)
+            if g is None:
+                if is_compiled(grid):
+                    paths = compiled_grid_paths(grid)
+                    try:
+                        g = Grid(*[np.load(paths[k], mmap_mode='r') for k in
+                                   Grid._fields])
+                    except (IOError, OSError, ValueError) as e:
+                        print('WARNING: unable to read the compiled tiling '
+                              'grid:', e)
+                        g = compile_grid(grid if os.path.isfile(grid) else
+                                         s2_mgrs_grid_txt)
+                elif os.path.isfile(grid):
+                    g = compile_grid(grid)
+                else:
+                    raise IOError('tiling grid {} not found'.format(grid))
+                _grids[grid] = g
+    return g
+
+
+def candidate_tiles(lons, lats, grid=s2_mgrs_grid):
+    """
+    List the tiles registered in the index cells of a set of points.
+
+    Returns:
+        points, tiles: numpy arrays of the same length. Each (points[k],
+        tiles[k]) pair is the index of a query point and the index in the grid
+        of a tile whose bounding box may contain it.
+    """
+    g = load(grid)
+    i, j = cell_coordinates(lons, lats)
+    cells = np.atleast_1d(j * NB_LON_CELLS + i)
+    starts = g.cell_offsets[cells]
+    counts = g.cell_offsets[cells + 1] - starts
+    points = np.repeat(np.arange(len(cells)), counts)
+    return points, np.asarray(g.cell_tiles[ragged_arange(starts, counts)])
+
+
+def tiles_containing_points(lons, lats, grid=s2_mgrs_grid):
+    """
+    Search the tiles whose footprint contains each point of a set of points.
+
+    Args:
+        lons, lats: arrays of longitudes and latitudes
+
+    Returns:
+        points, tiles: numpy arrays of the same length. Each (points[k],
+        tiles[k]) pair is the index of a query point and the index in the grid
+        of a tile containing it.
+    """
+    lons = np.atleast_1d(np.asarray(lons, dtype=float))
+    lats = np.atleast_1d(np.asarray(lats, dtype=float))
+    points, tiles = candidate_tiles(lons, lats, grid)
+    bbx = load(grid).bbx[tiles]
+    inside = np.logical_and(np.logical_and(bbx[:, 0] < lons[points],
+                                           bbx[:, 1] > lons[points]),
+                            np.logical_and(bbx[:, 2] < lats[points],
+                                           bbx[:, 3] > lats[points]))
+    points, tiles = points[inside], tiles[inside]
+
+    # exact test on the footprints of the remaining candidates
+    inside = shapely.contains_xy(tile_footprints(tiles, grid), lons[points],
+                                 lats[points])
+    return points[inside], tiles[inside]
+
+
+def tiles_intersecting_bboxes(bbx, grid=s2_mgrs_grid):
+    """
+    Search the tiles whose bounding box intersects each box of a set of boxes.
+
+    Args:
+        bbx: numpy array of shape (n, 4) with lon_min, lon_max, lat_min, lat_max
+
+    Returns:
+        boxes, tiles: numpy arrays of the same length. Each (boxes[k],
+        tiles[k]) pair is the index of a query box and the index in the grid of
+        a tile intersecting it. Pairs are unique.
+    """
+    g = load(grid)
+    bbx = np.atleast_2d(np.asarray(bbx, dtype=float))
+    i0, j0 = cell_coordinates(bbx[:, 0], bbx[:, 2])
+    i1, j1 = cell_coordinates(bbx[:, 1], bbx[:, 3])
+    ni = i1 - i0 + 1
+    nj = j1 - j0 + 1
+
+    # list the cells covered by each box
+    boxes = np.repeat(np.arange(len(bbx)), ni * nj)
+    k = ragged_arange(np.zeros(len(bbx)), ni * nj)
+    cells = (j0[boxes] + k // ni[boxes]) * NB_LON_CELLS + i0[boxes] + k % ni[boxes]
+
+    # list the tiles registered in these cells, without duplicates
+    starts = g.cell_offsets[cells]
+    counts = g.cell_offsets[cells + 1] - starts
+    boxes = np.repeat(boxes, counts)
+    tiles = np.asarray(g.cell_tiles[ragged_arange(starts, counts)], dtype=np.int64)
+    pairs = np.unique(boxes * len(g.ids) + tiles)
+    boxes, tiles = pairs // len(g.ids), pairs % len(g.ids)
+
+    # keep the tiles whose bounding box intersects the query box
+    t = g.bbx[tiles]
+    b = bbx[boxes]
+    keep = np.logical_and(np.logical_and(t[:, 0] <= b[:, 1], t[:, 1] >= b[:, 0]),
+                          np.logical_and(t[:, 2] <= b[:, 3], t[:, 3] >= b[:, 2]))
+    return boxes[keep], tiles[keep]
+
+
+def tile_footprints(tiles, grid=s2_mgrs_grid):
+    """
+    Return the lon/lat footprints of a list of tiles as shapely polygons.
+    """
+    g = load(grid)
+    tiles = np.asarray(tiles, dtype=np.int64)
+    if not len(tiles):
+        return np.empty(0, dtype=object)
+    starts = g.vertex_offsets[tiles]
+    counts = g.vertex_offsets[tiles + 1] - starts
+    rings = shapely.linearrings(g.vertices[ragged_arange(starts, counts)],
+                                indices=np.repeat(np.arange(len(tiles)), counts))
+    return shapely.polygons(rings)
+
+
+def mgrs_ids(tiles, grid=s2_mgrs_grid):
+    """
+    Return the MGRS identifiers (as strings) of a list of tiles indices.
+    """
+    return [x.decode() for x in load(grid).ids[np.asarray(tiles, dtype=int)]]
+
+
+def tiles_containing_point(lon, lat, grid=s2_mgrs_grid):
+    """
+    Search the MGRS tiles whose footprint contains a given point.
+
+    Args:
+        lon, lat: geographic coordinates of the input location
+
+    Returns:
+        list of MGRS identifiers
+    """
+    ids = mgrs_ids(tiles_containing_points(lon, lat, grid)[1], grid)
+    return sorted(set(ids), key=ids.index)  # remove antimeridian duplicates
+
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:] or [s2_mgrs_grid_txt]:
+        compile_grid(path)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Persistent on-disk cache of search results, shared by all search modules.
+
+Results are stored in json files named after a hash of the normalized search
+parameters (AOI, date range, satellite, product type, API...). Results of
+searches over closed historical date ranges never expire, the others expire
+after a time to live. Searches without end date are keyed on the current
+date. The least recently used files are evicted when the cache grows beyond a
+maximal size, checked at most every EVICTION_INTERVAL seconds by each process.
+
+Files are written to a temporary file then renamed, hence the cache can be
+used by many processes at once: a reader sees either a complete file or no
+file at all.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import os
+import json
+import time
+import hashlib
+import inspect
+import datetime
+import tempfile
+import functools
+import shapely.geometry
+import shapely.wkt
+
+
+# the cache can be disabled with TSD_SEARCH_CACHE=0
+enabled = os.environ.get('TSD_SEARCH_CACHE', '1') != '0'
+cache_dir = os.path.join(os.environ.get('TSD_CACHE_DIR',
+                                        os.path.join(os.path.expanduser('~'),
+                                                     '.cache', 'tsd')),
+                         'search')
+
+# time to live (s) of the results of searches over open date ranges
+TTL = 24 * 3600
+
+# products may be ingested by the archives a few weeks after their
+# acquisition: date ranges ending before that delay are considered closed
+HISTORICAL_DELAY = datetime.timedelta(days=30)
+
+# max total size (bytes) of the cache
+MAX_SIZE = int(os.environ.get('TSD_SEARCH_CACHE_MAX_SIZE', 500 * 1024**2))
+
+# min delay (s) between two evictions by the same process
+EVICTION_INTERVAL = 3600
+
+_last_eviction = {'time': 0}
+
+
+def normalize(x):
+    """
+    Convert a search parameter to a canonical json-serializable value.
+    """
+    if isinstance(x, (datetime.datetime, datetime.date)):
+        return x.isoformat()
+    if isinstance(x, dict) and 'type' in x and 'coordinates' in x:  # geojson
+        shape = shapely.geometry.shape(x).normalize()
+        return shapely.wkt.dumps(shape, rounding_precision=6)
+    if isinstance(x, dict):
+        return {str(k): normalize(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple, set)):
+        return [normalize(v) for v in x]
+    return x
+
+
+def key(api, **params):
+    """
+    Compute the content address of a search.
+
+    Args:
+        api: name of the search API
+        params: search parameters (aoi, start_date, end_date, satellite...)
+
+    Returns:
+        hexadecimal string
+    """
+    params = normalize(params)
+    for k in ['item_types']:  # order doesn't matter for these parameters
+        if isinstance(params.get(k), list):
+            params[k] = sorted(params[k])
+    s = json.dumps({'api': api, 'params': params}, sort_keys=True)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+
+def path(k):
+    """
+    Path to the cache file of a given key.
+    """
+    return os.path.join(cache_dir, k[:2], '{}.json'.format(k))
+
+
+def is_closed_date_range(end_date):
+    """
+    Tell if a search date range is closed, ie if its results won't change.
+    """
+    if end_date is None:
+        return False
+    if not isinstance(end_date, datetime.datetime):
+        end_date = datetime.datetime.combine(end_date, datetime.time())
+    return end_date < datetime.datetime.now() - HISTORICAL_DELAY
+
+
+def load(k):
+    """
+    Read the cached value of a key.
+
+    Returns:
+        the cached value, or None if it is not in the cache or expired
+    """
+    p = path(k)
+    try:
+        with open(p, 'r') as f:
+            d = json.load(f)
+    except (IOError, OSError, ValueError):  # missing, evicted or corrupted
+        return None
+
+    if d['expires'] is not None and d['expires'] < time.time():
+        return None
+
+    try:
+        os.utime(p, None)  # mark as recently used
+    except OSError:
+        pass
+    return d['value']
+
+
+def save(k, value, ttl=TTL):
+    """
+    Atomically write a value in the cache.
+
+    Args:
+        k: key
+        value: json-serializable value
+        ttl: time to live in seconds, or None for a never expiring value
+    """
+    p = path(k)
+    try:
+        if not os.path.isdir(os.path.dirname(p)):
+            os.makedirs(os.path.dirname(p))
+    except OSError:  # created by another process in the meantime
+        pass
+
+    d = {'created': time.time(),
+         'expires': None if ttl is None else time.time() + ttl,
+         'value': value}
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(p))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(d, f)
+        os.rename(tmp, p)
+    except (IOError, OSError, TypeError, ValueError) as e:
+        print('WARNING: unable to write the search cache file {}: {}'.format(p, e))
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    if time.time() - _last_eviction['time'] > EVICTION_INTERVAL:
+        _last_eviction['time'] = time.time()
+        evict()
+
+
+def evict(max_size=MAX_SIZE):
+    """
+    Remove the least recently used cache files until the cache fits max_size.
+    """
+    files = []
+    for root, _, names in os.walk(cache_dir):
+        for n in names:
+            p = os.path.join(root, n)
+            try:
+                s = os.stat(p)
+            except OSError:  # removed by another process
+                continue
+            if n.endswith('.json'):
+                files.append((s.st_mtime, s.st_size, p))
+            elif s.st_mtime < time.time() - 3600:  # leftover temporary file
+                files.append((0, s.st_size, p))
+
+    total = sum(f[1] for f in files)
+    for _, size, p in sorted(files):
+        if total <= max_size:
+            break
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+        total -= size
+
+
+def clear():
+    """
+    Remove all the cached search results.
+    """
+    evict(max_size=0)
+
+
+def memoize(api):
+    """
+    Decorator caching the results of a search function.
+
+    The cache key is built from all the arguments of the decorated function,
+    including default values. A None end_date (search up to now) is replaced
+    by the current date in the key. None results (failed searches) are not
+    cached.
+
+    Args:
+        api: name of the search API
+    """
+    def decorator(search):
+        @functools.wraps(search)
+        def cached_search(*args, **kwargs):
+            if not enabled:
+                return search(*args, **kwargs)
+
+            params = inspect.getcallargs(search, *args, **kwargs)
+            if 'end_date' in params and params['end_date'] is None:
+                params['end_date'] = datetime.date.today()
+            k = key(api, **params)
+            value = load(k)
+            if value is None:
+                value = search(*args, **kwargs)
+                if value is not None:
+                    closed = is_closed_date_range(params.get('end_date'))
+                    save(k, value, ttl=None if closed else TTL)
+            return value
+        return cached_search
+    return decorator
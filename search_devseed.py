@@ -9,20 +9,22 @@ Copyright (C) 2016-17, Carlo de Franchis <carlo.de-franchis@m4x.org>
 """
 
 from __future__ import print_function
-import os
 import argparse
 import datetime
 import json
-import requests
+import shapely
 import shapely.geometry
 import numpy as np
 
 import utils
+import http_session
+import search_cache
+import s2_tiling_grid
 
 
 api_url = 'https://api.developmentseed.org/satellites/landsat'
 api_url = 'https://api.developmentseed.org/satellites/'
-s2_mgrs_grid = os.path.join(os.path.dirname(os.path.abspath(__file__)), 's2_mgrs_grid.txt')
+s2_mgrs_grid = s2_tiling_grid.s2_mgrs_grid
 
 
 def query_l8(lat, lon, start_date=None, end_date=None):
@@ -74,16 +76,9 @@ def parse_s2_tiling_grid(lon, lat, grid=s2_mgrs_grid):
         latitude band, and the last two are two uppercase letters giving a
         100,000-meter square MGRS identifier.
     """
-    # load the list of lon lat bounding boxes of MGRS tiles used by sentinel-2
-    mgrsid = np.loadtxt(grid, usecols=[0], converters={0:bytes2str}, dtype=np.str)
-    ll_bbx = np.loadtxt(grid, usecols=[1, 2, 3, 4])
-
-    # search the ones for which our point is inside the bounding box
-    idx = np.logical_and(np.logical_and(ll_bbx[:, 0] < lon,
-                                        ll_bbx[:, 1] > lon),
-                         np.logical_and(ll_bbx[:, 2] < lat,
-                                        ll_bbx[:, 3] > lat))
-    mgrsid = mgrsid[idx].tolist()
+    # search the tiles for which our point is inside the bounding box, using
+    # the compiled and cached spatial index of the grid
+    mgrsid = s2_tiling_grid.tiles_containing_point(lon, lat, grid)
 
     if not mgrsid:
         print('WARNING: lat, lon ({}, {}) not located in any tile'.format(lat, lon))
@@ -91,6 +86,72 @@ def parse_s2_tiling_grid(lon, lat, grid=s2_mgrs_grid):
     return mgrsid
 
 
+def mgrs_tiles_of_points(lons, lats, grid=s2_mgrs_grid):
+    """
+    Search in the sentinel-2 tiling grid the MGRS tiles containing many points.
+
+    All the points are processed at once with the compiled spatial index of
+    the tiling grid.
+
+    Args:
+        lons, lats: arrays of longitudes and latitudes
+
+    Returns:
+        list of lists of MGRS identifiers, one list per input point
+    """
+    points, tiles = s2_tiling_grid.tiles_containing_points(lons, lats, grid)
+    out = [[] for _ in range(np.size(lons))]
+    for p, m in zip(points, s2_tiling_grid.mgrs_ids(tiles, grid)):
+        if m not in out[p]:  # tiles split on the antimeridian appear twice
+            out[p].append(m)
+    return out
+
+
+def mgrs_tiles_of_aois(aois, grid=s2_mgrs_grid):
+    """
+    Search in the sentinel-2 tiling grid the MGRS tiles intersecting many AOIs.
+
+    All the AOIs are processed at once: candidate tiles are retrieved with the
+    compiled spatial index of the tiling grid, then intersections with the
+    tiles footprints are computed with vectorized shapely operations.
+
+    Args:
+        aois: list of geojson.Polygon or geojson.Point objects
+
+    Returns:
+        list of lists, one list per input AOI, of (mgrs_id, coverage, contains)
+        tuples sorted by decreasing coverage. coverage is the fraction of the
+        AOI area covered by the tile (for a point it is 1), and contains tells
+        if the tile fully contains the AOI.
+    """
+    shapes = np.array([shapely.geometry.shape(a) for a in aois], dtype=object)
+    bounds = shapely.bounds(shapes)  # minx, miny, maxx, maxy
+    idx, tiles = s2_tiling_grid.tiles_intersecting_bboxes(bounds[:, [0, 2, 1, 3]],
+                                                          grid)
+    footprints = s2_tiling_grid.tile_footprints(tiles, grid)
+
+    # fraction of each AOI covered by each tile
+    areas = shapely.area(shapes)[idx]
+    intersects = shapely.intersects(footprints, shapes[idx])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage = np.where(areas > 0,
+                            shapely.area(shapely.intersection(footprints,
+                                                              shapes[idx])) / areas,
+                            intersects.astype(float))
+    contains = shapely.covers(footprints, shapes[idx])
+
+    # merge the parts of the tiles split on the antimeridian
+    merged = [{} for _ in range(len(shapes))]
+    keep = np.logical_and(intersects, coverage > 0)
+    for i, m, c, f in zip(idx[keep], s2_tiling_grid.mgrs_ids(tiles[keep], grid),
+                          coverage[keep], contains[keep]):
+        c0, f0 = merged[i].get(m, (0, False))
+        merged[i][m] = (min(1.0, c0 + float(c)), f0 or bool(f))
+
+    return [sorted(((m, c, f) for m, (c, f) in d.items()),
+                   key=lambda t: t[1], reverse=True) for d in merged]
+
+
 def mgrs_id_query_string(m):
     """
     """
@@ -125,6 +186,7 @@ def query_s2(lat, lon, start_date=None, end_date=None):
     return x
 
 
+@search_cache.memoize('devseed')
 def search(aoi, start_date=None, end_date=None, satellite='Landsat-8'):
     """
     List images covering an area of interest (AOI) using Development Seed’s API.
@@ -145,7 +207,7 @@ def search(aoi, start_date=None, end_date=None, satellite='Landsat-8'):
     url = '{}?search={}&limit=1000'.format(api_url, search_string)
 
     # query Development Seed’s API
-    r = requests.get(url)
+    r = http_session.get(url)
     if r.ok:
         d = r.json()
     else:
@@ -153,16 +215,18 @@ def search(aoi, start_date=None, end_date=None, satellite='Landsat-8'):
         return
 
     # check if the image footprint contains the area of interest
-    aoi = shapely.geometry.shape(aoi)
-    not_covering = []
-    for x in d['results']:
-        if 'data_geometry' in x:
-            if not shapely.geometry.shape(x['data_geometry']).contains(aoi):
-                not_covering.append(x)
-
-    for x in not_covering:
-        d['results'].remove(x)
-        d['meta']['found'] -= 1
+    footprints = [shapely.geometry.shape(x['data_geometry']) if 'data_geometry'
+                  in x else None for x in d['results']]
+    contains, coverage = utils.footprints_coverage(aoi, footprints)
+    results = []
+    for x, fp, inside, c in zip(d['results'], footprints, contains, coverage):
+        if fp is None:  # no footprint: keep the image
+            results.append(x)
+        elif inside:
+            x['aoi_coverage'] = float(c)
+            results.append(x)
+    d['meta']['found'] -= len(d['results']) - len(results)
+    d['results'] = results
 
     # remove 'crs' fields to make the json dict compatible with geojsonio
     if satellite == 'Landsat-8':
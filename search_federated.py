@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8
+# pylint: disable=C0103
+
+"""
+Federated search of Sentinel-2 and Landsat-8 images on several APIs at once.
+
+Development Seed, SciHub and Planet APIs are queried concurrently, each with
+its own timeout, and the answers are collected as they arrive. Once an API has
+returned images, the slower ones are waited for at most GRACE seconds more,
+within an overall deadline. Results are merged on a canonical key (acquisition date and
+MGRS tile for Sentinel-2, acquisition date and WRS path/row for Landsat-8),
+so that an image found by several APIs appears only once.
+
+Copyright (C) 2017, Carlo de Franchis <carlo.de-franchis@m4x.org>
+"""
+
+from __future__ import print_function
+import re
+import sys
+import time
+import json
+import queue
+import argparse
+import threading
+import dateutil.parser
+
+import utils
+import backends
+
+
+# APIs queried for each satellite, in order of preference for duplicates
+APIS = {
+    'Sentinel-2': ['devseed', 'scihub', 'planet'],
+    'Landsat-8': ['devseed', 'planet']
+}
+
+# max time (s) allowed to each API to answer
+TIMEOUTS = {'devseed': 30, 'scihub': 120, 'planet': 60}
+
+# time (s) the other APIs are waited for once a first API returned images
+GRACE = 5
+
+
+def search_backend(api, aoi, start_date=None, end_date=None,
+                   satellite='Sentinel-2'):
+    """
+    Search images with one API.
+
+    Returns:
+        list of images metadata dicts, or None if the API is not usable (eg
+        missing credentials) or the request failed
+    """
+    try:
+        m = backends.search_module(api)
+        if api == 'devseed':
+            d = m.search(aoi, start_date, end_date, satellite)
+            return d['results'] if d is not None else None
+        elif api == 'scihub':
+            return m.search(aoi, start_date, end_date, satellite=satellite)
+        elif api == 'planet':
+            item_type = {'Sentinel-2': 'Sentinel2L1C',
+                         'Landsat-8': 'Landsat8L1G'}[satellite]
+            return m.search(aoi, start_date, end_date, item_types=[item_type])
+    except Exception as e:
+        print('WARNING: {} search failed: {}'.format(api, e), file=sys.stderr)
+        return None
+
+
+def canonical_key(d, api, satellite='Sentinel-2'):
+    """
+    Build an API-independent identifier of an image from its metadata.
+
+    Returns:
+        (acquisition date, MGRS tile id) tuple for Sentinel-2 images, and
+        (acquisition date, WRS path, WRS row) for Landsat-8 images
+    """
+    if satellite == 'Sentinel-2':
+        if api == 'devseed':
+            date = d['timestamp']
+            tile = '{}{}{}'.format(d['utm_zone'], d['latitude_band'],
+                                   d['grid_square'])
+        elif api == 'scihub':
+            date = [a['content'] for a in d['date'] if a['name'] == 'beginposition'][0]
+            tile = re.findall(r"_T([0-9]{2}[A-Z]{3})_", d['title'])[0]
+        elif api == 'planet':
+            date = d['properties']['acquired']
+            tile = d['properties']['mgrs_grid_id']
+        return dateutil.parser.parse(date).date().isoformat(), tile.lstrip('0')
+    elif satellite == 'Landsat-8':
+        if api == 'devseed':
+            date, path, row = d['date'], d['path'], d['row']
+        elif api == 'planet':
+            p = d['properties']
+            date, path, row = p['acquired'], p['wrs_path'], p['wrs_row']
+        return dateutil.parser.parse(date).date().isoformat(), int(path), int(row)
+
+
+def search(aoi, start_date=None, end_date=None, satellite='Sentinel-2',
+           apis=None, timeouts=TIMEOUTS, deadline=None, grace=GRACE):
+    """
+    Search images on several APIs concurrently and merge the results.
+
+    Args:
+        aoi: geojson.Polygon or geojson.Point object
+        satellite: either Sentinel-2 or Landsat-8
+        apis: list of APIs to query, in order of preference for duplicates.
+            Default is all the APIs available for the satellite.
+        timeouts: dict giving the max time (s) allowed to each API. APIs
+            that don't answer in time are ignored.
+        deadline: max total time (s) of the search, default the largest
+            timeout of the queried APIs
+        grace: time (s) the other APIs are waited for once an API returned
+            images
+
+    Returns:
+        list of (api, metadata dict) tuples, without duplicates
+    """
+    if apis is None:
+        apis = APIS[satellite]
+
+    if deadline is None:
+        deadline = max(timeouts.get(a, 60) for a in apis)
+
+    # one daemon thread per API, so that a stalled API doesn't block the others
+    answers = queue.Queue()
+    for api in apis:
+        t = threading.Thread(target=lambda a=api: answers.put(
+            (a, search_backend(a, aoi, start_date, end_date, satellite))))
+        t.daemon = True
+        t.start()
+
+    # collect the results as they arrive
+    t0 = time.time()
+    first = None  # time of the first answer with images
+    results = {}
+    while True:
+        now = time.time()
+        for api in [a for a in apis if a not in results]:
+            if now >= t0 + timeouts.get(api, 60):
+                print('WARNING: {} search timed out'.format(api), file=sys.stderr)
+                results[api] = None
+        pending = [a for a in apis if a not in results]
+        if not pending:
+            break
+        end = min([t0 + deadline] + [t0 + timeouts.get(a, 60) for a in pending] +
+                  ([first + grace] if first is not None else []))
+        if now >= t0 + deadline or (first is not None and now >= first + grace):
+            print('WARNING: ignoring the slow {} search'.format(', '.join(pending)),
+                  file=sys.stderr)
+            break
+        try:
+            api, x = answers.get(timeout=max(0, end - now))
+        except queue.Empty:
+            continue
+        results[api] = x
+        if x and first is None:
+            first = time.time()
+
+    # merge the results on their canonical key
+    seen = set()
+    out = []
+    for api in apis:
+        for x in results.get(api) or []:
+            try:
+                k = canonical_key(x, api, satellite)
+            except (KeyError, IndexError, ValueError):
+                print('WARNING: unable to identify a {} result'.format(api),
+                      file=sys.stderr)
+                continue
+            if k not in seen:
+                seen.add(k)
+                out.append((api, x))
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Federated search of '
+                                                  'Sentinel-2 and Landsat-8 '
+                                                  'images'))
+    parser.add_argument('--satellite', choices=['Sentinel-2', 'Landsat-8'],
+                        default='Sentinel-2',
+                        help=('either "Sentinel-2" or "Landsat-8"'))
+    parser.add_argument('--geom', type=utils.valid_geojson,
+                        help=('path to geojson file'))
+    parser.add_argument('--lat', type=utils.valid_lat,
+                        help=('latitude of the center of the rectangle AOI'))
+    parser.add_argument('--lon', type=utils.valid_lon,
+                        help=('longitude of the center of the rectangle AOI'))
+    parser.add_argument('-w', '--width', type=int, default=5000,
+                        help='width of the AOI (m), default 5000 m')
+    parser.add_argument('-l', '--height', type=int, default=5000,
+                        help='height of the AOI (m), default 5000 m')
+    parser.add_argument('-s', '--start-date', type=utils.valid_datetime,
+                        help='start date, YYYY-MM-DD')
+    parser.add_argument('-e', '--end-date', type=utils.valid_datetime,
+                        help='end date, YYYY-MM-DD')
+    parser.add_argument('--apis', nargs='*', choices=['devseed', 'scihub', 'planet'],
+                        help='APIs to query, default all')
+    args = parser.parse_args()
+
+    if args.geom and (args.lat or args.lon):
+        parser.error('--geom and {--lat, --lon} are mutually exclusive')
+
+    if not args.geom and (not args.lat or not args.lon):
+        parser.error('either --geom or {--lat, --lon} must be defined')
+
+    if args.geom:
+        aoi = args.geom
+    else:
+        aoi = utils.geojson_geometry_object(args.lat, args.lon, args.width,
+                                            args.height)
+
+    print(json.dumps([{'api': api, 'result': x} for api, x in
+                      search(aoi, args.start_date, args.end_date,
+                             satellite=args.satellite, apis=args.apis)]))
@@ -13,29 +13,40 @@ import os
 import argparse
 import datetime
 import json
-import sys
 import shapely.geometry
-from planet import api
 
 import utils
+import backends
+import search_cache
 
+api = backends.lazy_import('planet.api')
+_client = None
 
-# check the Planet API key
-try:
-    os.environ['PL_API_KEY']
-except KeyError:
-    print("The {} module requires the PL_API_KEY".format(__file__),
-          "environment variable to be defined with valid",
-          "credentials for https://www.planet.com/. Create an account if",
-          "you don't have one (it's free) then edit the relevant configuration",
-          "files (eg .bashrc) to define this environment variable.")
-    sys.exit(1)
-
-client = api.ClientV1()
 ITEM_TYPES = ['PSScene3Band', 'PSScene4Band', 'PSOrthoTile', 'REScene', 'REOrthoTile',
               'Sentinel2L1C', 'Landsat8L1G']
 
 
+def get_client():
+    """
+    Return the Planet API client, created on first use.
+
+    The PL_API_KEY environment variable is checked here rather than at
+    import, so that importing this module never fails.
+    """
+    global _client
+    if _client is None:
+        if 'PL_API_KEY' not in os.environ:
+            raise RuntimeError(' '.join([
+                "The {} module requires the PL_API_KEY".format(__file__),
+                "environment variable to be defined with valid",
+                "credentials for https://www.planet.com/. Create an account if",
+                "you don't have one (it's free) then edit the relevant configuration",
+                "files (eg .bashrc) to define this environment variable."]))
+        _client = api.ClientV1()
+    return _client
+
+
+@search_cache.memoize('planet')
 def search(aoi, start_date=None, end_date=None, item_types=ITEM_TYPES):
     """
     Search for images using Planet API.
@@ -58,13 +69,17 @@ def search(aoi, start_date=None, end_date=None, item_types=ITEM_TYPES):
     request = api.filters.build_search_request(query, item_types)
 
     # this will cause an exception if there are any API related errors
-    response = client.quick_search(request)
+    response = get_client().quick_search(request)
 
-    # keep only the images that actually contain the full AOI
-    aoi = shapely.geometry.shape(aoi)
+    # keep only the images that actually contain the full AOI, and store the
+    # fraction of the AOI covered by each image in the 'aoi_coverage' field
+    items = list(response.items_iter(limit=None))
+    footprints = [shapely.geometry.shape(x['geometry']) for x in items]
+    contains, coverage = utils.footprints_coverage(aoi, footprints)
     results = []
-    for x in response.items_iter(limit=None):
-        if shapely.geometry.shape(x['geometry']).contains(aoi):
+    for x, inside, c in zip(items, contains, coverage):
+        if inside:
+            x['aoi_coverage'] = float(c)
             results.append(x)
 
     return results
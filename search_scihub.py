@@ -10,28 +10,22 @@ Copyright (C) 2016-17, Carlo de Franchis <carlo.de-franchis@ens-cachan.fr>
 
 from __future__ import print_function
 import os
-import sys
 import argparse
 import datetime
 import json
+import time
+import functools
+import threading
+import multiprocessing.pool
+import shapely
 import shapely.geometry
-import shapely.wkt
-import requests
 
 import utils
+import backends
+import http_session
+import search_cache
 
-
-# check the Copernicus Open Access Hub credentials
-try:
-    login = os.environ['COPERNICUS_LOGIN']
-    password = os.environ['COPERNICUS_PASSWORD']
-except KeyError:
-    print("The {} module requires the COPERNICUS_LOGIN and".format(__file__),
-          "COPERNICUS_PASSWORD environment variables to be defined with valid",
-          "credentials for https://scihub.copernicus.eu/. Create an account if",
-          "you don't have one (it's free) then edit the relevant configuration",
-          "files (eg .bashrc) to define these environment variables.")
-    sys.exit(1)
+requests = backends.lazy_import('requests')
 
 # http://sentinel-s2-l1c.s3-website.eu-central-1.amazonaws.com
 aws_url = 'http://sentinel-s2-l1c.s3.amazonaws.com'
@@ -41,25 +35,220 @@ api_urls = {
     'finland': 'https://finhub.nsdc.fmi.fi/'
 }
 
+# max number of result pages requested simultaneously
+PARALLEL_PAGES = 4
+
+# mirrors health statistics: latency and error rate are exponential moving
+# averages with weight ALPHA on the last request. After n consecutive errors a
+# mirror is avoided during COOLDOWN * 2**(n-1) seconds.
+ALPHA = .3
+COOLDOWN = 30
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+class ScihubError(Exception):
+    """
+    Raised when a request to a SciHub mirror fails.
+    """
+    pass
+
+
+class ScihubAuthError(ScihubError):
+    """
+    Raised when the credentials are rejected by a SciHub mirror. The mirrors
+    share the same accounts, hence this error is not worth a failover.
+    """
+    pass
+
 
-def post_scihub(url, query, user=login, password=password):
+def credentials():
+    """
+    Read the Copernicus Open Access Hub credentials.
+
+    They are checked on first use rather than at import, so that importing
+    this module never fails.
+
+    Returns:
+        login, password
+    """
+    try:
+        return os.environ['COPERNICUS_LOGIN'], os.environ['COPERNICUS_PASSWORD']
+    except KeyError:
+        raise ScihubError(' '.join([
+            "The {} module requires the COPERNICUS_LOGIN and".format(__file__),
+            "COPERNICUS_PASSWORD environment variables to be defined with valid",
+            "credentials for https://scihub.copernicus.eu/. Create an account if",
+            "you don't have one (it's free) then edit the relevant configuration",
+            "files (eg .bashrc) to define these environment variables."]))
+
+
+def post_scihub(url, query, user=None, password=None, timeout=120):
     """
     Send a POST request to scihub.
+
+    Raises:
+        ScihubError if the request fails
     """
-    r = requests.post(url, dict(q=query), auth=(user, password))
+    if user is None:
+        user, password = credentials()
+    try:
+        r = http_session.post(url, dict(q=query), auth=(user, password),
+                              timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        raise ScihubError('request to {} failed: {}'.format(url, e))
+
     if r.ok:
         return r
+    elif r.status_code == 503:
+        msg = 'The Sentinels Scientific Data Hub is down'
+    elif r.status_code == 401:
+        raise ScihubAuthError('Authentication failed with user {} '
+                              '({})'.format(user, url))
     else:
-        print('ERROR:', end=' ')
-        if r.status_code == 503:
-            print('The Sentinels Scientific Data Hub is down. Check on'
-                  ' https://scihub.copernicus.eu/dhus/#/home')
-        elif r.status_code == 401:
-            print('Authentication failed with', user, password)
+        msg = 'Scientific Data Hub returned error {}'.format(r.status_code)
+    raise ScihubError('{} ({})'.format(msg, url))
+
+
+def mirror_url(mirror):
+    """
+    Return the url of a mirror given by its name (or already by its url).
+    """
+    return api_urls.get(mirror, mirror)
+
+
+def record_request(mirror, latency=None, ok=True):
+    """
+    Update the health statistics of a mirror after a request.
+
+    Args:
+        mirror: mirror name (or url)
+        latency: duration of the request, in seconds
+        ok: False if the request failed
+    """
+    with _stats_lock:
+        s = _stats.setdefault(mirror, {'latency': None, 'error_rate': 0.,
+                                       'requests': 0, 'errors': 0,
+                                       'consecutive_errors': 0,
+                                       'last_error': None})
+        s['requests'] += 1
+        s['error_rate'] = (1 - ALPHA) * s['error_rate'] + ALPHA * (not ok)
+        if ok:
+            s['consecutive_errors'] = 0
+            if latency is not None:
+                if s['latency'] is None:
+                    s['latency'] = latency
+                else:
+                    s['latency'] = (1 - ALPHA) * s['latency'] + ALPHA * latency
         else:
-            print('Scientific Data Hub returned error', r.status_code)
-        #r.raise_for_status()
-        sys.exit(1)
+            s['errors'] += 1
+            s['consecutive_errors'] += 1
+            s['last_error'] = time.time()
+
+
+def mirror_stats():
+    """
+    Return a copy of the health statistics of the mirrors.
+
+    Returns:
+        dict indexed by mirror names. Values are dicts with the average
+        latency (s), error rate, number of requests and errors, number of
+        consecutive errors and the time of the last error.
+    """
+    with _stats_lock:
+        return {k: dict(v) for k, v in _stats.items()}
+
+
+def probe_mirrors(mirrors=None, timeout=5):
+    """
+    Measure the latency of mirrors with concurrent HEAD requests.
+
+    Args:
+        mirrors: list of mirrors names (or urls), default all the known mirrors
+        timeout: max time (s) allowed to each request
+    """
+    def probe(m):
+        t0 = time.time()
+        try:
+            ok = http_session.head(mirror_url(m), timeout=timeout).status_code < 500
+        except requests.exceptions.RequestException:
+            ok = False
+        record_request(m, time.time() - t0, ok)
+
+    threads = [threading.Thread(target=probe, args=(m,)) for m in
+               mirrors or list(api_urls)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def is_cooling_down(mirror):
+    """
+    Tell if a mirror is temporarily avoided after consecutive errors.
+    """
+    s = _stats.get(mirror)
+    if s is None or not s['consecutive_errors']:
+        return False
+    return time.time() - s['last_error'] < COOLDOWN * 2**(s['consecutive_errors'] - 1)
+
+
+def ranked_mirrors(api='auto'):
+    """
+    List the mirrors to try for a request, healthiest first.
+
+    Args:
+        api: either 'auto' (all the known mirrors), or a mirror name or url
+
+    Returns:
+        list of mirrors names (or urls)
+    """
+    if api != 'auto':
+        return [api]
+
+    mirrors = list(api_urls)
+    unknown = [m for m in mirrors if m not in _stats]
+    if unknown:
+        probe_mirrors(unknown)
+
+    def score(m):
+        s = _stats[m]
+        latency = s['latency'] if s['latency'] is not None else float('inf')
+        return is_cooling_down(m), latency * (1 + 10 * s['error_rate'])
+
+    with _stats_lock:
+        return sorted(mirrors, key=score)
+
+
+def post_scihub_mirrors(path, query, api='auto'):
+    """
+    Send a POST request to the healthiest scihub mirror, with failover.
+
+    Args:
+        path: url path, relative to the mirror url
+        query: query string
+        api: either 'auto' (healthiest mirror), or a mirror name or url
+
+    Raises:
+        ScihubError if the request failed on all the mirrors, ScihubAuthError
+        at once if the credentials are rejected
+    """
+    user, password = credentials()
+    errors = []
+    for m in ranked_mirrors(api):
+        t0 = time.time()
+        try:
+            r = post_scihub('{}{}'.format(mirror_url(m), path), query, user,
+                            password)
+        except ScihubAuthError:
+            raise
+        except ScihubError as e:
+            record_request(m, ok=False)
+            errors.append(str(e))
+            continue
+        record_request(m, time.time() - t0)
+        return r
+    raise ScihubError('; '.join(errors))
 
 
 def build_scihub_query(aoi, start_date=None, end_date=None,
@@ -88,16 +277,18 @@ def build_scihub_query(aoi, start_date=None, end_date=None,
     return query
 
 
-def load_query(query, api_url, start_row=0, page_size=100):
+def load_page(query, api='auto', start_row=0, page_size=100):
     """
-    Do a full-text query on the SciHub API using the OpenSearch format.
+    Load one page of results of a full-text query on the SciHub API.
 
-    https://scihub.copernicus.eu/twiki/do/view/SciHubUserGuide/3FullTextSearch
+    Args:
+        api: either 'auto' (healthiest mirror), or a mirror name or url
+
+    Returns:
+        total number of results of the query, list of entries of the page
     """
-    # load query results
-    url = '{}search?format=json&rows={}&start={}'.format(api_url, page_size,
-                                                         start_row)
-    r = post_scihub(url, query)
+    path = 'search?format=json&rows={}&start={}'.format(page_size, start_row)
+    r = post_scihub_mirrors(path, query, api)
 
     # parse response content
     d = r.json()['feed']
@@ -107,38 +298,154 @@ def load_query(query, api_url, start_row=0, page_size=100):
     # if the query returns only one product entries will be a dict, not a list
     if isinstance(entries, dict):
         entries = [entries]
+    return total_results, entries
 
-    # repeat query until all results have been loaded
-    output = entries
-    if total_results > start_row + page_size:
-        output += load_query(query, api_url, start_row=(start_row + page_size))
-    return output
 
+def iter_mirror_pages(query, mirror, start_row=0, page_size=100,
+                      parallel_pages=PARALLEL_PAGES):
+    """
+    Iterate over the pages of results of a full-text query on one mirror.
+
+    The first page gives the total number of results, then the remaining pages
+    are loaded concurrently. Pages are yielded in order, as soon as they are
+    loaded.
+
+    Args:
+        query: query string, as built by build_scihub_query
+        mirror: mirror name or url. All the pages are loaded from the same
+            mirror since the results offsets differ between mirrors.
+        start_row: index of the first result to load
+        page_size: number of results per page
+        parallel_pages: max number of pages requested simultaneously
+
+    Raises:
+        ScihubError if a page request failed
+    """
+    total_results, entries = load_page(query, mirror, start_row, page_size)
+    yield entries
 
-def search(aoi, start_date=None, end_date=None, satellite='Sentinel-1',
-           product_type='GRD', operational_mode='IW', api='copernicus'):
+    starts = list(range(start_row + page_size, total_results, page_size))
+    if not starts:
+        return
+
+    pool = multiprocessing.pool.ThreadPool(min(parallel_pages, len(starts)))
+    try:
+        f = functools.partial(load_page, query, mirror, page_size=page_size)
+        for _, entries in pool.imap(f, starts):
+            yield entries
+    finally:
+        pool.terminate()
+
+
+def iter_query_pages(query, api='auto', start_row=0, page_size=100,
+                     parallel_pages=PARALLEL_PAGES):
     """
-    List the Sentinel images covering a location using Copernicus Scihub API.
+    Iterate over the pages of results of a full-text query on the SciHub API.
+
+    With api='auto', the query is paged on the healthiest mirror. If a page
+    fails, the whole query is restarted on the next mirror, skipping the
+    entries already yielded.
+
+    Args:
+        query: query string, as built by build_scihub_query
+        api: either 'auto' (healthiest mirror), or a mirror name or url
+        start_row: index of the first result to load
+        page_size: number of results per page
+        parallel_pages: max number of pages requested simultaneously
+
+    Raises:
+        ScihubError if the query failed on all the mirrors
+    """
+    if api != 'auto':
+        for entries in iter_mirror_pages(query, api, start_row, page_size,
+                                         parallel_pages):
+            yield entries
+        return
+
+    seen = set()
+    errors = []
+    for m in ranked_mirrors():
+        try:
+            for entries in iter_mirror_pages(query, m, start_row, page_size,
+                                             parallel_pages):
+                new = [x for x in entries if x['id'] not in seen]
+                seen.update(x['id'] for x in entries)
+                if new:
+                    yield new
+            return
+        except ScihubAuthError:
+            raise
+        except ScihubError as e:
+            print('WARNING: query failed on {}, restarting it on the next '
+                  'mirror: {}'.format(m, e))
+            errors.append(str(e))
+    raise ScihubError('; '.join(errors))
+
+
+def iter_query(query, api='auto', start_row=0, page_size=100,
+               parallel_pages=PARALLEL_PAGES):
+    """
+    Iterate over the results of a full-text query on the SciHub API.
+
+    Entries are yielded in order, as soon as their page is loaded.
+    """
+    for entries in iter_query_pages(query, api, start_row, page_size,
+                                    parallel_pages):
+        for x in entries:
+            yield x
+
+
+def load_query(query, api_url='auto', start_row=0, page_size=100):
+    """
+    Do a full-text query on the SciHub API using the OpenSearch format.
+
+    https://scihub.copernicus.eu/twiki/do/view/SciHubUserGuide/3FullTextSearch
+
+    Args:
+        api_url: either 'auto' (healthiest mirror), or a mirror name or url
+    """
+    return list(iter_query(query, api_url, start_row, page_size))
+
+
+def iter_search(aoi, start_date=None, end_date=None, satellite='Sentinel-1',
+                product_type='GRD', operational_mode='IW', api='auto'):
+    """
+    Iterate over the Sentinel images covering a location using Copernicus
+    Scihub API.
+
+    Results are yielded while the next pages of results are being loaded.
+    With api='auto', the query is paged on the healthiest mirror, and
+    restarted on the other mirrors if it fails.
+    The fraction of the AOI covered by each image footprint is stored in the
+    'aoi_coverage' field of the results.
     """
     if satellite == 'Sentinel-2' and product_type not in ['S2MSI1C', 'S2MSI2Ap']:
         product_type = 'S2MSI1C'
 
     query = build_scihub_query(aoi, start_date, end_date, satellite,
                                product_type, operational_mode)
-    results = load_query(query, api_urls[api])
 
-    # check if the image footprint contains the area of interest
-    not_covering = []
-    aoi_shape = shapely.geometry.shape(aoi)
-    for x in results:
-        footprint = [a['content'] for a in x['str'] if a['name'] == 'footprint'][0]
-        if not shapely.wkt.loads(footprint).contains(aoi_shape):
-            not_covering.append(x)
+    # check if the images footprints contain the area of interest, one page at
+    # a time
+    for entries in iter_query_pages(query, api):
+        footprints = shapely.from_wkt([[a['content'] for a in x['str'] if
+                                        a['name'] == 'footprint'][0] for x in
+                                       entries])
+        contains, coverage = utils.footprints_coverage(aoi, footprints)
+        for x, inside, c in zip(entries, contains, coverage):
+            if inside:
+                x['aoi_coverage'] = float(c)
+                yield x
 
-    for x in not_covering:
-        results.remove(x)
 
-    return results
+@search_cache.memoize('scihub')
+def search(aoi, start_date=None, end_date=None, satellite='Sentinel-1',
+           product_type='GRD', operational_mode='IW', api='auto'):
+    """
+    List the Sentinel images covering a location using Copernicus Scihub API.
+    """
+    return list(iter_search(aoi, start_date, end_date, satellite, product_type,
+                            operational_mode, api))
 
 
 if __name__ == '__main__':
@@ -163,8 +470,10 @@ if __name__ == '__main__':
                         help='type of image: RAW, SLC, GRD, OCN (for S1), S2MSI1C, S2MSI2Ap (for S2)')
     parser.add_argument('--operational-mode', default='IW',
                         help='(for S1) acquisiton mode: SM, IW, EW or WV')
-    parser.add_argument('--api', default='copernicus',
-                        help='mirror to use: copernicus, austria of finland')
+    parser.add_argument('--api', default='auto',
+                        choices=['auto'] + sorted(api_urls),
+                        help=('mirror to use: copernicus, austria or finland. '
+                              'Default is auto (healthiest mirror)'))
     args = parser.parse_args()
 
     if args.geom and (args.lat or args.lon):
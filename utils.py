@@ -10,17 +10,27 @@ import argparse
 import datetime
 import subprocess
 import tempfile
-import tifffile
-from osgeo import gdal, osr
+import threading
+import uuid
 import numpy as np
 import utm
 import traceback
 import warnings
 import sys
 import geojson
-import requests
+import shapely
 import shapely.geometry
-gdal.UseExceptions()
+
+import backends
+import retry
+import http_session
+import range_cache
+
+# heavy dependencies, imported on first use
+gdal = backends.lazy_import('osgeo.gdal', init=lambda m: m.UseExceptions())
+osr = backends.lazy_import('osgeo.osr')
+tifffile = backends.lazy_import('tifffile')
+requests = backends.lazy_import('requests')
 
 
 def valid_datetime(s):
@@ -221,7 +231,18 @@ def inplace_utm_reprojection_with_gdalwarp(src, utm_zone, ulx, uly, lrx, lry):
         fd, dst = tempfile.mkstemp(suffix='.tif', dir=os.path.dirname(src))
         os.close(fd)
 
-        cmd = ['gdalwarp', '-t_srs', '+proj=utm +zone={}'.format(utm_zone),
+        srs = '+proj=utm +zone={}'.format(utm_zone)
+        if gdal_in_process():
+            try:
+                gdal.Warp(dst, src, dstSRS=srs,
+                          outputBounds=(ulx, lry, lrx, uly),  # xmin ymin xmax ymax
+                          format='GTiff')
+                shutil.move(dst, src)
+            except RuntimeError as e:
+                print('ERROR: gdal.Warp failed on {}: {}'.format(src, e))
+            return
+
+        cmd = ['gdalwarp', '-t_srs', srs,
                '-te', str(ulx), str(lry), str(lrx), str(uly),  # xmin ymin xmax ymax
                '-overwrite', src, dst]
         print(' '.join(cmd))
@@ -265,16 +286,91 @@ def crop_georeferenced_image(out_path, in_path, lon, lat, w, h):
                                  str(lrx), str(lry)])
 
 
+# crop engine: 'auto' uses the GDAL python bindings in-process when they are
+# recent enough, 'subprocess' always runs the gdal command line tools
+GDAL_ENGINE = os.environ.get('TSD_GDAL_ENGINE', 'auto')
+
+# results of the GDAL version and drivers checks, done once per process
+_gdal_checks = {}
+_gdal_checks_lock = threading.Lock()
+
+
 def gdal_translate_version():
     """
+    Return the version of the gdal_translate command line tool.
+
+    The gdal_translate process is run only once per process.
+    """
+    with _gdal_checks_lock:
+        if 'cli_version' not in _gdal_checks:
+            v = subprocess.check_output(['gdal_translate', '--version'])
+            _gdal_checks['cli_version'] = v.decode().split()[1].split(',')[0]
+    return _gdal_checks['cli_version']
+
+
+def gdal_in_process():
+    """
+    Tell if the crops can be done in-process with the GDAL python bindings.
+
+    This needs gdal >= 2.1 (for gdal.Translate and gdal.Warp) with the GTiff
+    driver. The check is done only once per process.
+    """
+    if GDAL_ENGINE == 'subprocess':
+        return False
+    with _gdal_checks_lock:
+        if 'in_process' not in _gdal_checks:
+            try:
+                ok = (int(gdal.VersionInfo()) >= 2010000 and
+                      gdal.GetDriverByName('GTiff') is not None)
+            except ImportError:
+                ok = False
+            if not ok:
+                print('WARNING: GDAL python bindings >= 2.1 not available,',
+                      'falling back to the gdal command line tools',
+                      file=sys.stderr)
+            _gdal_checks['in_process'] = ok
+    return _gdal_checks['in_process']
+
+
+def set_vsicurl_allowed_extensions(ext):
+    """
+    Restrict the files probed by /vsicurl/ for the calling thread.
+
+    Without this, GDAL tries to list the remote directory and to open sidecar
+    files (.aux.xml, .ovr...) before reading the image.
+    """
+    if hasattr(gdal, 'SetThreadLocalConfigOption'):  # gdal >= 2.2
+        gdal.SetThreadLocalConfigOption('CPL_VSIL_CURL_ALLOWED_EXTENSIONS', ext)
+    else:
+        gdal.SetConfigOption('CPL_VSIL_CURL_ALLOWED_EXTENSIONS', ext)
+
+
+def vsicurl_extension(path):
+    """
+    Extension of the remote file read by a /vsicurl/ GDAL path.
+
+    For a file of a remote archive (eg /vsizip/{/vsicurl/...zip}/x.tiff, or a
+    /vsisubfile/ path) it is the extension of the archive url.
     """
-    v = subprocess.check_output(['gdal_translate', '--version'])
-    return v.decode().split()[1].split(',')[0]
+    url = re.search(r'/vsicurl/([^{}]*)', path).group(1)
+    return os.path.splitext(url.split('?')[0])[1].lstrip('.')
 
 
 def crop_with_gdal_translate(outpath, inpath, ulx, uly, lrx, lry,
                              utm_zone=None, lat_band=None, output_type=None):
     """
+    Crop an image with gdal_translate, in-process if possible.
+
+    Args:
+        outpath: path to the output (cropped) image file
+        inpath: path or http(s) url of the input image
+        ulx, uly, lrx, lry: projected coordinates of the crop corners
+        utm_zone, lat_band (optional): UTM zone and latitude band of the crop
+            coordinates, when they are not expressed in the image projection
+        output_type (optional): output pixel type, eg 'UInt16'
+
+    Returns:
+        None if the crop succeeded, a failure reason string otherwise
     """
     if outpath == inpath:  # hack to allow the output to overwrite the input
         fd, out = tempfile.mkstemp(suffix='.tif', dir=os.path.dirname(inpath))
@@ -282,41 +378,354 @@ def crop_with_gdal_translate(outpath, inpath, ulx, uly, lrx, lry,
     else:
         out = outpath
 
-    env = os.environ.copy()
     if inpath.startswith(('http://', 'https://')):
-        env['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = inpath[-3:]
-        path = '/vsicurl/{}'.format(inpath)
+        path = '/vsicurl/{}'.format(range_cache.local_url(inpath))
     else:
         path = inpath
 
+    srs = None
+    if utm_zone is not None:
+        srs = '+proj=utm +zone={}'.format(utm_zone)
+        # latitude bands in the southern hemisphere range from 'C' to 'M'
+        if lat_band and lat_band < 'N':
+            srs += ' +south'
+
+    if gdal_in_process():
+        crop = crop_with_gdal_python
+    else:
+        crop = crop_with_gdal_translate_subprocess
+    reason = retry_crop(crop, (out, path, ulx, uly, lrx, lry, srs, output_type),
+                        [inpath])
+    if reason is not None:
+        return reason
+
+    if outpath == inpath:  # hack to allow the output to overwrite the input
+        shutil.move(out, outpath)
+
+
+def crop_with_gdal_python(out, path, ulx, uly, lrx, lry, srs=None,
+                          output_type=None):
+    """
+    Crop an image with gdal.Translate, without starting a new process.
+
+    Each call opens its own datasets, hence it can be run concurrently from
+    several threads.
+
+    Returns:
+        None if the crop succeeded, an error message otherwise
+    """
+    if path.startswith('/vsicurl/'):
+        set_vsicurl_allowed_extensions(vsicurl_extension(path))
+    kwargs = {'format': 'GTiff', 'projWin': [ulx, uly, lrx, lry]}
+    if output_type is not None:
+        kwargs['outputType'] = gdal.GetDataTypeByName(output_type)
+    if srs is not None:
+        kwargs['projWinSRS'] = srs
+    try:
+        ds = gdal.Translate(out, path, **kwargs)
+        del ds  # gdal way of closing files
+    except RuntimeError as e:
+        print('ERROR: gdal.Translate failed on {}: {}'.format(path, e))
+        return 'gdal.Translate failed: {}'.format(e)
+
+
+def crop_with_gdal_translate_subprocess(out, path, ulx, uly, lrx, lry, srs=None,
+                                        output_type=None):
+    """
+    Crop an image with the gdal_translate command line tool.
+
+    Returns:
+        None if the crop succeeded, an error message otherwise
+    """
+    env = os.environ.copy()
+    if path.startswith('/vsicurl/'):
+        env['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = vsicurl_extension(path)
+
     cmd = ['gdal_translate', path, out, '-of', 'GTiff', '-projwin', str(ulx),
            str(uly), str(lrx), str(lry)]
     if output_type is not None:
         cmd += ['-ot', output_type]
-    if utm_zone is not None:
+    if srs is not None:
         if gdal_translate_version() < '2.0':
             print('WARNING: utils.crop_with_gdal_translate argument utm_zone requires gdal >= 2.0')
         else:
-            srs = '+proj=utm +zone={}'.format(utm_zone)
-            # latitude bands in the southern hemisphere range from 'C' to 'M'
-            if lat_band and lat_band < 'N':
-                srs += ' +south'
             cmd += ['-projwin_srs', srs]
     try:
         #print(' '.join(cmd))
         subprocess.check_output(cmd, stderr=subprocess.STDOUT, env=env)
     except subprocess.CalledProcessError as e:
-        if inpath.startswith(('http://', 'https://')):
-            if not requests.head(inpath).ok:
-                print('{} is not available'.format(inpath))
-                return
         print('ERROR: this command failed')
         print(' '.join(cmd))
         print(e.output)
+        return 'gdal_translate failed: {}'.format(e.output.decode(errors='replace').strip().split('\n')[-1])
+
+
+def crop_pixel_window(outpath, path, xoff, yoff, xsize, ysize,
+                      output_type=None):
+    """
+    Crop a pixel window of an image, in-process if possible.
+
+    Unlike crop_with_gdal_translate, the window is given in pixel coordinates,
+    hence images georeferenced with GCPs only (eg Sentinel-1 measurements)
+    can be cropped. The GCPs are kept, shifted to the crop.
+
+    Args:
+        outpath: path to the output (cropped) image file
+        path: GDAL path of the input image (eg a /vsicurl/ or /vsizip/ path)
+        xoff, yoff, xsize, ysize: window offset and size, in pixels
+        output_type (optional): output pixel type, eg 'UInt16'
+
+    Returns:
+        None if the crop succeeded, an error message otherwise
+    """
+    if gdal_in_process():
+        if '/vsicurl/' in path:
+            set_vsicurl_allowed_extensions(vsicurl_extension(path))
+        kwargs = {'format': 'GTiff', 'srcWin': [xoff, yoff, xsize, ysize]}
+        if output_type is not None:
+            kwargs['outputType'] = gdal.GetDataTypeByName(output_type)
+        try:
+            ds = gdal.Translate(outpath, path, **kwargs)
+            del ds  # gdal way of closing files
+        except RuntimeError as e:
+            print('ERROR: gdal.Translate failed on {}: {}'.format(path, e))
+            return 'gdal.Translate failed: {}'.format(e)
         return
 
-    if outpath == inpath:  # hack to allow the output to overwrite the input
-        shutil.move(out, outpath)
+    env = os.environ.copy()
+    if '/vsicurl/' in path:
+        env['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = vsicurl_extension(path)
+    cmd = ['gdal_translate', path, outpath, '-of', 'GTiff', '-srcwin',
+           str(xoff), str(yoff), str(xsize), str(ysize)]
+    if output_type is not None:
+        cmd += ['-ot', output_type]
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT, env=env)
+    except subprocess.CalledProcessError as e:
+        print('ERROR: this command failed')
+        print(' '.join(cmd))
+        print(e.output)
+        return 'gdal_translate failed: {}'.format(e.output.decode(errors='replace').strip().split('\n')[-1])
+
+
+def is_available(url):
+    """
+    Tell if a remote file exists, with a one byte range request.
+
+    A range request is used rather than a HEAD request, which some servers (eg
+    the SciHub OData API) don't answer properly.
+
+    Returns:
+        True if it exists, False if the server answered that it doesn't (404,
+        403 or 410), None if it couldn't be told (connection error, timeout,
+        5xx answer or open circuit breaker)
+    """
+    try:
+        r = http_session.get(url, headers={'Range': 'bytes=0-0'}, stream=True,
+                             retries=0)
+    except requests.exceptions.RequestException:
+        return None
+    r.close()
+    if r.ok:
+        return True
+    if r.status_code in (403, 404, 410):
+        return False
+
+
+def retry_crop(crop, args, inpaths):
+    """
+    Run a crop function, retrying it on failure with the retry module policy.
+
+    The retries use the budget and circuit breaker of the host of the input
+    images. When the inputs are read through the range cache, the byte ranges
+    fetched by a failed attempt are not downloaded again. A crop isn't retried
+    if one of its remote inputs doesn't exist. That is checked once, after the
+    first failure, and transient errors of the check don't stop the retries.
+    Crops of local files only are run once, without retry.
+
+    Args:
+        crop: function returning None on success, an error message otherwise
+        args: tuple of arguments of crop
+        inpaths: list of paths or http(s) urls of the input images
+
+    Returns:
+        None if the crop succeeded, a failure reason string otherwise
+    """
+    urls = [p for p in inpaths if p.startswith(('http://', 'https://'))]
+    if not urls:
+        try:
+            return crop(*args)
+        except Exception as e:
+            return str(e)
+    host = http_session.host(urls[0])
+
+    missing = []
+    checked = []
+
+    def permanent(reason):
+        if not checked:
+            checked.append(True)
+            missing.extend(u for u in urls if is_available(u) is False)
+            for u in missing:
+                print('{} is not available'.format(u))
+        return bool(missing)
+
+    try:
+        _, reason = retry.call(crop, args, host=host, is_failure=lambda x: x,
+                               permanent=permanent)
+    except Exception as e:
+        return str(e)
+    return 'not available' if missing else reason
+
+
+def crop_bands_with_vrt(outpath, inpaths, ulx, uly, lrx, lry, utm_zone=None,
+                        lat_band=None, output_type=None, band_names=None):
+    """
+    Crop several bands of an image into a single multi-band GeoTIFF.
+
+    The bands are stacked in a virtual dataset (VRT), which is cropped in one
+    pass. With the GDAL python bindings all the bands are read in the calling
+    thread, which reuses its HTTP connection and the /vsicurl/ headers cache.
+    Bands with different resolutions are resampled on the grid of the finest
+    one.
+
+    Args:
+        outpath: path to the output multi-band image file
+        inpaths: list of paths or http(s) urls of the input mono-band images
+        ulx, uly, lrx, lry: projected coordinates of the crop corners
+        utm_zone, lat_band (optional): UTM zone and latitude band of the crop
+            coordinates, when they are not expressed in the image projection
+        output_type (optional): output pixel type, eg 'UInt16'
+        band_names (optional): list of band names, stored as bands descriptions
+
+    Returns:
+        None if the crop succeeded, a failure reason string otherwise
+    """
+    paths = ['/vsicurl/{}'.format(range_cache.local_url(p)) if
+             p.startswith(('http://', 'https://')) else p for p in inpaths]
+    srs = None
+    if utm_zone is not None:
+        srs = '+proj=utm +zone={}'.format(utm_zone)
+        # latitude bands in the southern hemisphere range from 'C' to 'M'
+        if lat_band and lat_band < 'N':
+            srs += ' +south'
+
+    return retry_crop(crop_bands_once, (outpath, paths, ulx, uly, lrx, lry, srs,
+                                        output_type, band_names), inpaths)
+
+
+def crop_bands_once(outpath, paths, ulx, uly, lrx, lry, srs=None,
+                    output_type=None, band_names=None):
+    """
+    Single attempt of crop_bands_with_vrt, on GDAL paths.
+
+    Returns:
+        None if the crop succeeded, an error message otherwise
+    """
+    if gdal_in_process():
+        if paths[0].startswith('/vsicurl/'):
+            set_vsicurl_allowed_extensions(vsicurl_extension(paths[0]))
+        kwargs = {'format': 'GTiff', 'projWin': [ulx, uly, lrx, lry]}
+        if output_type is not None:
+            kwargs['outputType'] = gdal.GetDataTypeByName(output_type)
+        if srs is not None:
+            kwargs['projWinSRS'] = srs
+        try:
+            vrt = gdal.BuildVRT('', paths, separate=True, resolution='highest')
+            ds = gdal.Translate(outpath, vrt, **kwargs)
+            for i, name in enumerate(band_names or []):
+                ds.GetRasterBand(i + 1).SetDescription(str(name))
+            ds = vrt = None  # gdal way of closing files
+            return
+        except RuntimeError as e:
+            print('ERROR: multi-band crop failed on {}: {}'.format(paths[0], e))
+            return 'multi-band crop failed: {}'.format(e)
+
+    # fallback: two gdal processes per image instead of one per band
+    fd, vrt = tempfile.mkstemp(suffix='.vrt', dir=os.path.dirname(outpath) or '.')
+    os.close(fd)
+    env = os.environ.copy()
+    if paths[0].startswith('/vsicurl/'):
+        env['CPL_VSIL_CURL_ALLOWED_EXTENSIONS'] = vsicurl_extension(paths[0])
+    try:
+        subprocess.check_output(['gdalbuildvrt', '-overwrite', '-separate',
+                                 '-resolution', 'highest', vrt] + paths,
+                                stderr=subprocess.STDOUT, env=env)
+        return crop_with_gdal_translate_subprocess(outpath, vrt, ulx, uly, lrx,
+                                                   lry, srs, output_type)
+    except subprocess.CalledProcessError as e:
+        print('ERROR: gdalbuildvrt failed on {}'.format(paths[0]))
+        print(e.output)
+        return 'gdalbuildvrt failed'
+    finally:
+        os.remove(vrt)
+
+
+def union_window(windows, utm_zone, lat_band):
+    """
+    Compute a window containing several crop windows, in a given UTM zone.
+
+    Args:
+        windows: list of (ulx, uly, lrx, lry, utm_zone, lat_band) tuples, as
+            returned by utm_bbx
+        utm_zone, lat_band: UTM zone and latitude band of the output window
+
+    Returns:
+        ulx, uly, lrx, lry, utm_zone, lat_band tuple
+    """
+    xs = []
+    ys = []
+    for ulx, uly, lrx, lry, z, b in windows:
+        for x, y in [(ulx, uly), (lrx, uly), (lrx, lry), (ulx, lry)]:
+            lat, lon = utm.to_latlon(x, y, z, b, strict=False)
+            x, y = utm.from_latlon(lat, lon, force_zone_number=utm_zone)[:2]
+            xs.append(x)
+            ys.append(y)
+    m = 60  # margin (m) for the curvature of the windows edges across zones
+    return min(xs) - m, max(ys) + m, max(xs) + m, min(ys) - m, utm_zone, lat_band
+
+
+def crop_aois_from_scene(inpath, outpaths, windows, union, output_type=None):
+    """
+    Crop several windows of a remote image with a single remote read.
+
+    The union window is cropped first into a local temporary file (in memory
+    with the GDAL python bindings), then each window is cropped from it.
+
+    Args:
+        inpath: path or http(s) url of the input image
+        outpaths: list of paths to the output (cropped) image files
+        windows: list of (ulx, uly, lrx, lry, utm_zone, lat_band) tuples, one
+            per output file
+        union: (ulx, uly, lrx, lry, utm_zone, lat_band) tuple of a window
+            containing all the others, as returned by union_window
+        output_type (optional): output pixel type, eg 'UInt16'
+
+    Returns:
+        None if all the crops succeeded, a failure reason string otherwise
+    """
+    in_memory = gdal_in_process()
+    if in_memory:
+        tmp = '/vsimem/{}.tif'.format(uuid.uuid4().hex)
+    else:
+        tmp = tmpfile('.tif')
+    try:
+        reason = crop_with_gdal_translate(tmp, inpath, *union,
+                                          output_type=output_type)
+        if reason is not None:
+            return reason
+        if not (gdal.VSIStatL(tmp) is not None if in_memory else
+                os.path.getsize(tmp) > 0):
+            return 'empty crop'
+        reasons = [crop_with_gdal_translate(outpath, tmp, *w,
+                                            output_type=output_type)
+                   for outpath, w in zip(outpaths, windows)]
+        return next((r for r in reasons if r is not None), None)
+    finally:
+        if in_memory:
+            gdal.Unlink(tmp)
+        elif os.path.isfile(tmp):
+            os.remove(tmp)
 
 
 def crop_with_gdalwarp(outpath, inpath, geojson_path):
@@ -369,6 +778,42 @@ def utm_bbx(aoi):
     return bbx[0], bbx[3], bbx[2], bbx[1], utm_zone, lat_band  # minx, maxy, maxx, miny
 
 
+def footprints_coverage(aoi, footprints):
+    """
+    Compute which footprints contain an AOI, and the fraction of the AOI they cover.
+
+    The footprints are indexed in a STRtree queried with the prepared AOI,
+    then the intersection areas are computed only for the intersecting
+    footprints, with vectorized shapely operations.
+
+    Args:
+        aoi: geojson.Polygon or geojson.Point object
+        footprints: list of shapely geometries (None values are allowed)
+
+    Returns:
+        contains: numpy array of booleans telling if each footprint contains
+            the AOI
+        coverage: numpy array with the fraction of the AOI area covered by each
+            footprint (for a point AOI, it is 1 if the footprint intersects it)
+    """
+    aoi = shapely.geometry.shape(aoi)
+    footprints = np.asarray(footprints, dtype=object).reshape(-1)
+    contains = np.zeros(len(footprints), dtype=bool)
+    coverage = np.zeros(len(footprints))
+    if not len(footprints):
+        return contains, coverage
+
+    tree = shapely.STRtree(footprints)
+    contains[tree.query(aoi, predicate='within')] = True
+    hits = tree.query(aoi, predicate='intersects')
+    if aoi.area > 0:
+        coverage[hits] = shapely.area(shapely.intersection(footprints[hits],
+                                                           aoi)) / aoi.area
+    else:
+        coverage[hits] = 1
+    return contains, coverage
+
+
 def latlon_to_pix(img, lat, lon):
    """
    Get the pixel coordinates of a geographic location in a georeferenced image.